@@ -1,6 +1,7 @@
 import os
-import timeit
-from typing import Tuple, Callable, Dict, Optional
+from typing import Tuple, Callable, Dict, Optional, Union
+
+import numpy
 
 from avatar2 import OpenOCDTarget, Avatar, ARM_CORTEX_M3, Target
 from avatar2.plugins.mmf_dispatcher import MemFaultDispatcher
@@ -8,6 +9,20 @@ from capstone import CsInsn
 
 from utilities import TimeOut
 from . import InstructionEffect
+from .instruction_cache import InstructionCache, DecodedInstruction
+from .register_file import RegisterFile, FAULT_REGISTERS, gdb_register_numbers
+
+# Snapshot using OpenOCD's dump_image, this goes through a file on disk. Works with every OpenOCD release.
+SNAPSHOT_MODE_DUMP_IMAGE = "dump_image"
+# Snapshot by streaming the region over the OpenOCD TCL connection using read_memory. The command only exists since
+# OpenOCD 0.12, older releases fall back to dump_image.
+SNAPSHOT_MODE_READ_MEMORY = "read_memory"
+# Snapshot using bulk memory reads through the GDB connection of the target.
+SNAPSHOT_MODE_GDB = "gdb"
+SNAPSHOT_MODES = [SNAPSHOT_MODE_DUMP_IMAGE, SNAPSHOT_MODE_READ_MEMORY, SNAPSHOT_MODE_GDB]
+
+SNAPSHOT_WORDS_PER_READ = 0x1000
+SNAPSHOT_SCRATCH_FILE = "snapshot_scratch.bin"
 
 
 class Avatar2Handler:
@@ -20,15 +35,34 @@ class Avatar2Handler:
     region_snapshot: Tuple[int, int]
     region_protect: Tuple[int, int]
 
+    snapshot_mode: str
+    instruction_cache: InstructionCache
+    __openocd_commands: Dict[str, bool]
+    __register_numbers: Optional[Dict[str, int]]
+
+    register_file: Optional[RegisterFile]
+    round_trips: int
+
     dispatcher: MemFaultDispatcher
     on_mmf: Optional[Callable[[], bool]]
 
     def __init__(self, cfg_path: str, protect: Tuple[int, int], snapshot: Tuple[int, int],
-                 avatar_output_directory: str, arch):
+                 avatar_output_directory: str, arch, snapshot_mode: str = SNAPSHOT_MODE_DUMP_IMAGE,
+                 instruction_cache: Optional[InstructionCache] = None):
+
+        if snapshot_mode not in SNAPSHOT_MODES:
+            raise Exception("Unknown snapshot mode: %s" % snapshot_mode)
 
         self.arch = arch
+        self.snapshot_mode = snapshot_mode
+        self.instruction_cache = InstructionCache() if instruction_cache is None else instruction_cache
+
+        self.register_file = None
+        self.round_trips = 0
 
         self.__avatar_output_directory = avatar_output_directory
+        self.__openocd_commands = dict()
+        self.__register_numbers = None
         self.avatar = Avatar(arch=arch, output_directory=avatar_output_directory)
         self.target = self.avatar.add_target(OpenOCDTarget, openocd_script=cfg_path)
 
@@ -97,11 +131,41 @@ class Avatar2Handler:
         self.on_mmf = on_fault
         return old_callback
 
+    def _count_round_trip(self, amount: int = 1) -> None:
+        self.round_trips += amount
+
+    def begin_fault(self) -> None:
+        """ Start handling a new fault, forgets the registers and round-trips of the previous one. """
+        self.register_file = None
+        self.round_trips = 0
+
+    def fetch_registers(self) -> RegisterFile:
+        """ Fetch all registers needed to handle the current fault at once. """
+        if self.__register_numbers is None:
+            # Asked once, so msp and psp are fetched in the same request as the other registers.
+            self.__register_numbers = dict(getattr(self.arch, 'registers', {}))
+            for name, number in gdb_register_numbers(self.target, self._count_round_trip).items():
+                self.__register_numbers.setdefault(name, number)
+        self.register_file = RegisterFile(self.target, self.__register_numbers, self._count_round_trip)
+        self.register_file.fetch(FAULT_REGISTERS)
+        return self.register_file
+
+    def read_memory(self, address: int, size: int, num_words: int = 1, raw: bool = False):
+        self._count_round_trip()
+        return self.target.read_memory(address, size, num_words, raw=raw)
+
+    def write_memory(self, address: int, size: int, value, num_words: int = 1, raw: bool = False):
+        self._count_round_trip()
+        return self.target.write_memory(address, size, value, num_words, raw=raw)
+
     def get_mm_faulting_addr(self) -> Optional[int]:
         try:
+            self._count_round_trip()
             if self.arch.CFSR.read(self.target) & self.arch.CFSR.MASK_MMF_ADDR_STILL_VALID != 0:
                 mmf_addr = self.arch.MMFAR.read(self.target)
                 self.arch.CFSR.set_bit(self.target, self.arch.CFSR.MASK_MMF_ADDR_STILL_VALID, 0)
+                # set_bit reads and writes CFSR
+                self._count_round_trip(3)
             else:
                 mmf_addr = None
         except AttributeError:
@@ -109,31 +173,96 @@ class Avatar2Handler:
             mmf_addr = None
         return mmf_addr
 
-    def make_snapshot(self, mem_range: Tuple[int, int], path: str) -> bytes:
-
-        t_start = timeit.default_timer()
+    def fill_memory(self, address: int, pattern: int, num_words: int) -> None:
+        """ Fill num_words 32-bit words starting at address with pattern, in one OpenOCD command. """
+        self.target.protocols.monitor.execute_command("mww 0x%X 0x%X %d" % (address, pattern & 0xFFFFFFFF, num_words))
+        self._count_round_trip()
+
+    def make_snapshot(self, mem_range: Tuple[int, int], path: Optional[str] = None,
+                      buffer: Optional[bytearray] = None) -> Union[bytes, memoryview]:
+        """
+        Capture the contents of a memory range.
+
+        :param mem_range: (start, size) of the region to capture.
+        :param path: Optional file to persist the snapshot in (required for the dump_image mode).
+        :param buffer: Optional preallocated buffer of at least the region size that is reused for the snapshot.
+        :return: The captured memory, a view on the buffer when one was used.
+        """
+        if self.snapshot_mode == SNAPSHOT_MODE_READ_MEMORY and not self._has_openocd_command("read_memory"):
+            print("OpenOCD has no read_memory command (added in 0.12), falling back to dump_image snapshots.")
+            self.snapshot_mode = SNAPSHOT_MODE_DUMP_IMAGE
+
+        if self.snapshot_mode == SNAPSHOT_MODE_DUMP_IMAGE:
+            return self._make_snapshot_dump_image(mem_range, path)
+
+        if buffer is None:
+            buffer = bytearray(mem_range[1])
+        view = memoryview(buffer)[:mem_range[1]]
+
+        if self.snapshot_mode == SNAPSHOT_MODE_READ_MEMORY:
+            self._read_region_openocd(mem_range, view)
+        elif self.snapshot_mode == SNAPSHOT_MODE_GDB:
+            view[:] = self.target.read_memory(mem_range[0], 1, mem_range[1], raw=True)
+            # Avatar2 reads through GDB in blocks of 0x100 bytes
+            self._count_round_trip((mem_range[1] + 0xFF) // 0x100)
+        else:
+            raise Exception("Unknown snapshot mode: %s" % self.snapshot_mode)
+
+        if path is not None:
+            with open(path, mode='wb') as bin_file:
+                bin_file.write(view)
+        return view
+
+    def _has_openocd_command(self, command: str) -> bool:
+        """ Whether the OpenOCD TCL interpreter knows the command, checked once per command. """
+        known = self.__openocd_commands.get(command, None)
+        if known is None:
+            response = self.target.protocols.monitor.execute_command("info commands %s" % command)
+            self._count_round_trip()
+            known = response is not None and command in response.split()
+            self.__openocd_commands[command] = known
+        return known
+
+    def _make_snapshot_dump_image(self, mem_range: Tuple[int, int], path: Optional[str]) -> bytes:
+        if path is None:
+            path = os.path.join(self.__avatar_output_directory, SNAPSHOT_SCRATCH_FILE)
 
         command = "dump_image %s 0x%X 0x%X" % (path, mem_range[0], mem_range[1])
         openocd = self.target.protocols.monitor
         openocd.execute_command(command)
-
-        t_done_ocd = timeit.default_timer()
+        self._count_round_trip()
 
         with open(path, mode='rb') as bin_file:
             bin_data = bin_file.read()
-
-        t_done_all = timeit.default_timer()
-        # TODO remove timekeeping when done with it.
-        with open(os.path.join(self.__avatar_output_directory, 'timer.txt'), mode='a') as timings:
-            timings.write("Snapshot time: %d, %d\n" % (t_done_ocd - t_start, t_done_all - t_done_ocd))
-
         return bin_data
 
+    def _read_region_openocd(self, mem_range: Tuple[int, int], view: memoryview) -> None:
+        """ Stream a region over the OpenOCD TCL connection in word sized chunks, straight into the given view. """
+        openocd = self.target.protocols.monitor
+        words = numpy.frombuffer(view, dtype='<u4', count=mem_range[1] // 4)
+        for word_index in range(0, len(words), SNAPSHOT_WORDS_PER_READ):
+            count = min(SNAPSHOT_WORDS_PER_READ, len(words) - word_index)
+            response = openocd.execute_command(
+                "read_memory 0x%X 32 %d" % (mem_range[0] + 4 * word_index, count)
+            )
+            self._count_round_trip()
+            values = response.split()
+            if len(values) != count:
+                raise Exception("OpenOCD returned %d words where %d were requested." % (len(values), count))
+            words[word_index:word_index + count] = [int(x, 16) for x in values]
+
+        # A region that is not word aligned has a few trailing bytes.
+        for offset in range(4 * len(words), mem_range[1]):
+            response = openocd.execute_command("read_memory 0x%X 8 1" % (mem_range[0] + offset))
+            self._count_round_trip()
+            view[offset] = int(response.strip(), 16)
+
     def get_stack_frame_location(self, offset=0) -> int:
         sp = None
-        lr_value = self.target.read_register('lr')
-        msp_value = self.target.read_register('msp')
-        psp_value = self.target.read_register('psp')
+        registers = self.target if self.register_file is None else self.register_file
+        lr_value = registers.read_register('lr')
+        msp_value = registers.read_register('msp')
+        psp_value = registers.read_register('psp')
 
         if lr_value == 0xFFFFFFF1:
             # Handler mode MSP
@@ -165,17 +294,37 @@ class Avatar2Handler:
         return sp + offset
 
     def read_context(self, stack_frame_location: int) -> Dict[str, int]:
-        values = self.target.read_memory(stack_frame_location, 4, 8)
+        values = self.read_memory(stack_frame_location, 4, 8)
         context = {self.arch.REGISTERS_ON_STACK[i]: values[i] for i in range(len(self.arch.REGISTERS_ON_STACK))}
         return context
 
     def write_context(self, stack_frame_location: int, context: Dict[str, int]) -> None:
         values = [context[reg] for reg in self.arch.REGISTERS_ON_STACK]
-        self.target.write_memory(stack_frame_location, 4, values, 8)
-
-    def get_instruction_effect(self, addr: int) -> Tuple[InstructionEffect, CsInsn]:
-        instruction = self._disassemble_one(addr)
-        effect = InstructionEffect.from_cs_insn(instruction)
+        self.write_memory(stack_frame_location, 4, values, 8)
+
+    def write_back(self, stack_frame_location: int, context: Dict[str, int], pc: int) -> None:
+        """ Write the stacked context, the changed registers and the handler's new PC back at the end of a fault. """
+        self.write_context(stack_frame_location, context)
+        if self.register_file is None:
+            self.target.write_register('pc', pc)
+            self._count_round_trip()
+        else:
+            self.register_file.write_register('pc', pc)
+            self.register_file.flush()
+
+    def get_instruction_effect(self, addr: int) -> Tuple[InstructionEffect, DecodedInstruction]:
+        cached = self.instruction_cache.get(addr)
+        if cached is not None:
+            return cached
+
+        unsupported = self.instruction_cache.get_unsupported(addr)
+        if unsupported is not None:
+            raise Exception("Faulting instruction %s can not be replayed: %s" % (unsupported[1], unsupported[0]))
+
+        cs_instruction = self._disassemble_one(addr)
+        instruction = DecodedInstruction.from_cs_insn(cs_instruction)
+        effect = InstructionEffect.from_cs_insn(cs_instruction)
+        self.instruction_cache.put(addr, effect, instruction)
         return effect, instruction
 
     def continue_and_wait(self, timeout: Optional[int] = None):
@@ -233,6 +382,7 @@ class Avatar2Handler:
     def _disassemble_one(self, addr: int) -> CsInsn:
         if hasattr(self.target, 'disassemble'):
             instructions = self.target.disassemble(addr, detail=True)
+            self._count_round_trip()
             if len(instructions) != 1:
                 raise Exception("Failed to disassemble exactly one instruction")
             return instructions[0]
@@ -0,0 +1,126 @@
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+from . import InstructionEffect
+
+# Only code in this region is cached, it is flash on every supported device and does not change during a run.
+CACHEABLE_REGION: Tuple[int, int] = (0x00000000, 0x20000000)
+
+
+class DecodedInstruction:
+    """ The part of a capstone CsInsn that outlives the decoding, for logging and error messages. """
+    address: int
+    size: int
+    bytes: bytes
+    mnemonic: str
+    op_str: str
+
+    def __init__(self, address: int, size: int, instruction_bytes: bytes, mnemonic: str, op_str: str):
+        self.address = address
+        self.size = size
+        self.bytes = instruction_bytes
+        self.mnemonic = mnemonic
+        self.op_str = op_str
+
+    @classmethod
+    def from_cs_insn(cls, instruction) -> 'DecodedInstruction':
+        return DecodedInstruction(
+            instruction.address, instruction.size, bytes(instruction.bytes), instruction.mnemonic, instruction.op_str
+        )
+
+    def __repr__(self):
+        return "<CsInsn 0x%x [%s]: %s %s>" % (self.address, self.bytes.hex(), self.mnemonic, self.op_str)
+
+
+class InstructionCache:
+    """
+    Decoded instructions by PC.
+
+    Code in flash does not change while the firmware runs, so every PC only has to be read and decoded once.
+    """
+    firmware_digest: Optional[str]
+    hits: int
+    misses: int
+
+    __entries: Dict[int, Tuple[InstructionEffect, DecodedInstruction]]
+    __unsupported: Dict[int, Tuple[str, DecodedInstruction]]
+
+    def __init__(self, firmware_digest: Optional[str] = None):
+        self.firmware_digest = firmware_digest
+        self.hits = 0
+        self.misses = 0
+        self.__entries = dict()
+        self.__unsupported = dict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @staticmethod
+    def is_cacheable(pc: int) -> bool:
+        return CACHEABLE_REGION[0] <= pc < CACHEABLE_REGION[0] + CACHEABLE_REGION[1]
+
+    def get(self, pc: int) -> Optional[Tuple[InstructionEffect, DecodedInstruction]]:
+        cached = self.__entries.get(pc, None)
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    def put(self, pc: int, effect: InstructionEffect, instruction: DecodedInstruction) -> None:
+        if self.is_cacheable(pc):
+            self.__entries[pc] = (effect, instruction)
+
+    def mark_unsupported(self, pc: int, reason: str, instruction: DecodedInstruction) -> None:
+        """ Remember a memory access at pc that cannot be replayed, so a fault on it can be reported right away. """
+        if self.is_cacheable(pc):
+            self.__unsupported[pc] = (reason, instruction)
+
+    def get_unsupported(self, pc: int) -> Optional[Tuple[str, DecodedInstruction]]:
+        return self.__unsupported.get(pc, None)
+
+    @property
+    def unsupported(self) -> Dict[int, Tuple[str, DecodedInstruction]]:
+        return self.__unsupported
+
+    def to_file(self, path: str) -> None:
+        rows = []
+        for pc, (effect, instruction) in sorted(self.__entries.items()):
+            rows.append({
+                'pc': pc,
+                'effect': effect.__dict__,
+                'instruction': [instruction.size, instruction.bytes.hex(), instruction.mnemonic, instruction.op_str],
+            })
+        unsupported_rows = []
+        for pc, (reason, instruction) in sorted(self.__unsupported.items()):
+            unsupported_rows.append({
+                'pc': pc,
+                'reason': reason,
+                'instruction': [instruction.size, instruction.bytes.hex(), instruction.mnemonic, instruction.op_str],
+            })
+        with open(path, mode='w') as out_file:
+            json.dump({'firmware': self.firmware_digest, 'entries': rows, 'unsupported': unsupported_rows}, out_file)
+
+    @classmethod
+    def from_file(cls, path: str, firmware_digest: Optional[str] = None) -> 'InstructionCache':
+        """ Load a cache, returns an empty cache if the file does not exist or belongs to different firmware. """
+        cache = InstructionCache(firmware_digest)
+        if not os.path.exists(path):
+            return cache
+
+        with open(path, mode='r') as in_file:
+            payload = json.load(in_file)
+        if firmware_digest is not None and payload['firmware'] != firmware_digest:
+            return cache
+
+        cache.firmware_digest = payload['firmware']
+        for row in payload['entries']:
+            size, instruction_bytes, mnemonic, op_str = row['instruction']
+            instruction = DecodedInstruction(row['pc'], size, bytes.fromhex(instruction_bytes), mnemonic, op_str)
+            cache.put(row['pc'], InstructionEffect(**row['effect']), instruction)
+        for row in payload.get('unsupported', []):
+            size, instruction_bytes, mnemonic, op_str = row['instruction']
+            instruction = DecodedInstruction(row['pc'], size, bytes.fromhex(instruction_bytes), mnemonic, op_str)
+            cache.mark_unsupported(row['pc'], row['reason'], instruction)
+        return cache
@@ -1,10 +1,12 @@
-from typing import Dict
+from typing import Dict, Union
 
 from avatar2 import Target
 from capstone import CsInsn
 from capstone.arm_const import ARM_INS_STR, ARM_INS_LDR, ARM_INS_STRB, ARM_INS_LDRB, ARM_OP_REG, ARM_OP_MEM, \
     ARM_SFT_LSL, ARM_SFT_INVALID, ARM_INS_STRH, ARM_INS_LDRH
 
+from .register_file import RegisterFile
+
 RENAME = {
     "ip": "r12",
     "fp": "r11",
@@ -33,7 +35,7 @@ def clean_reg_name(reg_name):
     return reg_name
 
 
-def load_reg_value(reg_name: str, target: Target, context: Dict[str, int]) -> int:
+def load_reg_value(reg_name: str, target: Union[Target, RegisterFile], context: Dict[str, int]) -> int:
     # TODO remove when Avatar2 supports 'ip' name.
     reg_name = clean_reg_name(reg_name)
     if reg_name in context:
@@ -42,7 +44,7 @@ def load_reg_value(reg_name: str, target: Target, context: Dict[str, int]) -> in
         return target.read_register(reg_name)
 
 
-def store_reg_value(reg_name: str, target: Target, context: Dict[str, int], value: int) -> None:
+def store_reg_value(reg_name: str, target: Union[Target, RegisterFile], context: Dict[str, int], value: int) -> None:
     reg_name = clean_reg_name(reg_name)
     if reg_name in context:
         context[reg_name] = value
@@ -87,7 +89,7 @@ class InstructionEffect:
         self.mem_offset = mem_offset
         self.mem_shift_amount = mem_shift_amount
 
-    def compute_memory_address(self, target: Target, context: Dict[str, int]) -> int:
+    def compute_memory_address(self, target: Union[Target, RegisterFile], context: Dict[str, int]) -> int:
         base = load_reg_value(self.mem_base, target, context)
         index = 0 if self.mem_index is None else load_reg_value(self.mem_index, target, context)
         offset = 0 if self.mem_offset is None else self.mem_offset
@@ -98,10 +100,10 @@ class InstructionEffect:
             raise Exception("Cannot have both index and immediate.")
         return base + index + offset
 
-    def get_register_value(self, target: Target, context: Dict[str, int]) -> int:
+    def get_register_value(self, target: Union[Target, RegisterFile], context: Dict[str, int]) -> int:
         return load_reg_value(self.reg, target, context)
 
-    def set_register_value(self, target: Target, context: Dict[str, int], value: int) -> None:
+    def set_register_value(self, target: Union[Target, RegisterFile], context: Dict[str, int], value: int) -> None:
         store_reg_value(self.reg, target, context, value)
 
     @classmethod
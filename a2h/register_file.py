@@ -0,0 +1,84 @@
+from typing import Dict, List, Callable
+
+from avatar2 import Target
+
+# The registers that are needed to handle a fault, fetched together as soon as the fault is handled.
+# r0-r3, r12, lr, pc and xpsr of the faulting code are on the stack, the rest is still in the register file.
+FAULT_REGISTERS = ['r4', 'r5', 'r6', 'r7', 'r8', 'r9', 'r10', 'r11', 'sp', 'lr', 'msp', 'psp']
+
+
+def gdb_register_numbers(target: Target, count_round_trip: Callable[[], None]) -> Dict[str, int]:
+    """
+    GDB's numbers of all registers of the target, by name. Avatar2's architecture only knows the numbers of the
+    general purpose registers, the numbers of e.g. msp and psp depend on the target description of the stub.
+
+    :return: Empty if the target is not controlled through GDB or GDB does not answer.
+    """
+    gdb = getattr(target.protocols, 'registers', None)
+    if not hasattr(gdb, '_sync_request'):
+        return dict()
+    from avatar2.protocols.gdb import GDB_PROT_DONE
+
+    success, response = gdb._sync_request(["-data-list-register-names"], GDB_PROT_DONE)
+    count_round_trip()
+    if not success:
+        return dict()
+    # Names are listed by number, registers that do not exist have an empty name.
+    return {x: i for i, x in enumerate(response['payload']['register-names']) if x != ""}
+
+
+class RegisterFile:
+    """
+    A copy of the core registers for the handling of a single fault.
+
+    Registers are fetched in one request where the protocol allows it, reads are served from the copy, and writes are
+    kept until flush() is called. It can be used in place of a target for InstructionEffect.
+    """
+    target: Target
+    values: Dict[str, int]
+    dirty: Dict[str, int]
+
+    def __init__(self, target: Target, register_numbers: Dict[str, int], count_round_trip: Callable[[], None]):
+        self.target = target
+        self.values = dict()
+        self.dirty = dict()
+        self.__register_numbers = register_numbers
+        self.__count_round_trip = count_round_trip
+
+    def fetch(self, names: List[str]) -> None:
+        """ Fetch the given registers, in one GDB request if the target is controlled through GDB. """
+        gdb = getattr(self.target.protocols, 'registers', None)
+        numbered = {self.__register_numbers[x]: x for x in names if x in self.__register_numbers}
+        special = getattr(getattr(gdb, '_arch', None), 'special_registers', {})
+        numbered = {k: v for k, v in numbered.items() if v not in special}
+
+        if len(numbered) > 0 and hasattr(gdb, '_sync_request'):
+            from avatar2.protocols.gdb import GDB_PROT_DONE
+
+            request = ["-data-list-register-values", "x"] + ["%d" % x for x in sorted(numbered.keys())]
+            success, response = gdb._sync_request(request, GDB_PROT_DONE)
+            self.__count_round_trip()
+            if success:
+                for register in response['payload']['register-values']:
+                    self.values[numbered[int(register['number'])]] = int(register['value'], 16)
+
+        for name in names:
+            if name not in self.values:
+                self.read_register(name)
+
+    def read_register(self, name: str) -> int:
+        if name not in self.values:
+            self.values[name] = self.target.read_register(name)
+            self.__count_round_trip()
+        return self.values[name]
+
+    def write_register(self, name: str, value: int) -> None:
+        self.values[name] = value
+        self.dirty[name] = value
+
+    def flush(self) -> None:
+        """ Write all changed registers back to the target. """
+        for name, value in self.dirty.items():
+            self.target.write_register(name, value)
+            self.__count_round_trip()
+        self.dirty = dict()
@@ -0,0 +1,128 @@
+import hashlib
+import struct
+from typing import List, Tuple, Dict
+
+from capstone import Cs, CS_ARCH_ARM, CS_MODE_THUMB, CS_MODE_MCLASS, CsInsn
+from capstone.arm_const import ARM_INS_STR, ARM_INS_LDR, ARM_INS_STRB, ARM_INS_LDRB, ARM_INS_STRH, ARM_INS_LDRH
+
+from . import InstructionEffect
+from .instruction_cache import InstructionCache, DecodedInstruction
+
+SUPPORTED_INSTRUCTIONS = [ARM_INS_STR, ARM_INS_LDR, ARM_INS_STRB, ARM_INS_LDRB, ARM_INS_STRH, ARM_INS_LDRH]
+
+# Mnemonic prefixes of all other instructions that access memory, these cannot be replayed after a fault.
+UNSUPPORTED_MEMORY_ACCESSES = ["ldr", "str", "ldm", "stm", "push", "pop", "tbb", "tbh"]
+
+ELF_MAGIC = b"\x7fELF"
+ELF_CLASS_32 = 1
+ELF_DATA_LITTLE_ENDIAN = 1
+
+SHT_SYMTAB = 2
+SHF_EXECINSTR = 0x4
+
+
+def firmware_digest(firmware_path: str) -> str:
+    with open(firmware_path, mode='rb') as firmware_file:
+        return hashlib.sha256(firmware_file.read()).hexdigest()
+
+
+def _read_string(table: bytes, offset: int) -> str:
+    return table[offset:table.index(b"\x00", offset)].decode('ascii', errors='replace')
+
+
+def read_code_sections(elf: bytes) -> List[Tuple[int, bytes, List[Tuple[int, bool]]]]:
+    """
+    Find the executable sections in a 32-bit little-endian ELF file.
+
+    :param elf: Contents of the ELF file.
+    :return: A list of (address, contents, mapping) per section, where mapping is a sorted list of (address, is_code)
+             taken from the ARM mapping symbols ($t, $a and $d) inside of that section.
+    """
+    if elf[:4] != ELF_MAGIC or elf[4] != ELF_CLASS_32 or elf[5] != ELF_DATA_LITTLE_ENDIAN:
+        raise Exception("Only 32-bit little-endian ELF files are supported.")
+
+    e_shoff, = struct.unpack_from("<I", elf, 0x20)
+    e_shentsize, e_shnum, e_shstrndx = struct.unpack_from("<HHH", elf, 0x2E)
+
+    sections = []
+    for i in range(e_shnum):
+        # name, type, flags, addr, offset, size, link, info, addralign, entsize
+        sections.append(struct.unpack_from("<IIIIIIIIII", elf, e_shoff + i * e_shentsize))
+
+    code_sections = [i for i, x in enumerate(sections) if x[2] & SHF_EXECINSTR and x[5] > 0]
+
+    mapping_symbols: Dict[int, List[Tuple[int, bool]]] = {i: [] for i in code_sections}
+    for section in sections:
+        if section[1] != SHT_SYMTAB:
+            continue
+        string_table = sections[section[6]]
+        strings = elf[string_table[4]:string_table[4] + string_table[5]]
+        for offset in range(section[4], section[4] + section[5], 16):
+            st_name, st_value, st_size, st_info, st_other, st_shndx = struct.unpack_from("<IIIBBH", elf, offset)
+            if st_shndx not in mapping_symbols:
+                continue
+            name = _read_string(strings, st_name)
+            if name in ("$t", "$a") or name.startswith("$t.") or name.startswith("$a."):
+                mapping_symbols[st_shndx].append((st_value & ~1, True))
+            elif name == "$d" or name.startswith("$d."):
+                mapping_symbols[st_shndx].append((st_value, False))
+
+    result = []
+    for i in code_sections:
+        address, offset, size = sections[i][3], sections[i][4], sections[i][5]
+        result.append((address, elf[offset:offset + size], sorted(mapping_symbols[i])))
+    return result
+
+
+def _code_ranges(address: int, size: int, mapping: List[Tuple[int, bool]]) -> List[Tuple[int, int]]:
+    """ Split a section in (start, end) ranges of code, without mapping symbols the entire section is code. """
+    if len(mapping) == 0:
+        return [(address, address + size)]
+    ranges = []
+    bounds = mapping + [(address + size, False)]
+    for (start, is_code), (end, _) in zip(bounds, bounds[1:]):
+        if is_code and start < end:
+            ranges.append((start, end))
+    return ranges
+
+
+def _disassemble_range(disassembler: Cs, code: bytes, start: int, end: int, section_address: int) -> List[CsInsn]:
+    instructions = []
+    current = start
+    while current < end:
+        offset = current - section_address
+        for instruction in disassembler.disasm(code[offset:end - section_address], current):
+            instructions.append(instruction)
+            current = instruction.address + instruction.size
+        if current < end:
+            # Capstone stopped at a half-word it could not decode, skip it and resynchronize.
+            current += 2
+    return instructions
+
+
+def decode_firmware(firmware_path: str) -> InstructionCache:
+    """
+    Decode every load and store of the firmware offline.
+
+    :param firmware_path: Path to the ELF file that is flashed onto the device.
+    :return: A cache with an InstructionEffect for every supported site and all other memory accesses as unsupported.
+    """
+    with open(firmware_path, mode='rb') as firmware_file:
+        elf = firmware_file.read()
+
+    disassembler = Cs(CS_ARCH_ARM, CS_MODE_THUMB | CS_MODE_MCLASS)
+    disassembler.detail = True
+
+    cache = InstructionCache(hashlib.sha256(elf).hexdigest())
+    for section_address, code, mapping in read_code_sections(elf):
+        for start, end in _code_ranges(section_address, len(code), mapping):
+            for instruction in _disassemble_range(disassembler, code, start, end, section_address):
+                decoded = DecodedInstruction.from_cs_insn(instruction)
+                if instruction.id in SUPPORTED_INSTRUCTIONS:
+                    try:
+                        cache.put(instruction.address, InstructionEffect.from_cs_insn(instruction), decoded)
+                    except Exception as err:
+                        cache.mark_unsupported(instruction.address, str(err), decoded)
+                elif any(instruction.mnemonic.startswith(x) for x in UNSUPPORTED_MEMORY_ACCESSES):
+                    cache.mark_unsupported(instruction.address, "Unsupported instruction.", decoded)
+    return cache
@@ -2,6 +2,13 @@
 #BASE_DIR="./D4A2/04_recording_addr_size/run_test/snapshots"
 BASE_DIR="./D4A2/02_recording/snapshots"
 
+# Runs using the deduplicated snapshot store keep manifests instead of images, rebuild the images first.
+if [ -f "$BASE_DIR/store.json" ]; then
+  IMAGE_DIR="$BASE_DIR/images"
+  python -m phases.recorder.snapshot_store "$BASE_DIR" "$IMAGE_DIR" || exit 1
+  BASE_DIR="$IMAGE_DIR"
+fi
+
 for ante in "$BASE_DIR"/*anterior.bin; do
   if [ -f "$ante" ]; then
     post="${ante%anterior.bin}posterior.bin"
@@ -11,4 +18,4 @@ for ante in "$BASE_DIR"/*anterior.bin; do
       (*) ;;
     esac
   fi
-done
\ No newline at end of file
+done
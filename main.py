@@ -4,8 +4,9 @@ import os
 import signal
 import subprocess
 from subprocess import Popen
-from typing import Tuple, Dict, List
+from typing import Tuple, Dict, List, Optional
 
+from a2h.static_decoder import firmware_digest
 from utilities import auto_int, naming_things
 
 GRACE_STEPS = 32
@@ -18,18 +19,20 @@ class Controller:
     peripheral_region: Tuple[int, int]
     work_dir: str
     epsilon: int
+    epsilon_range: Optional[str]
 
     living_processes: Dict[str, Popen]
 
     def __init__(self, firmware_path: str, openocd_config_path: str,
                  ram_region: Tuple[int, int], peripheral_region: Tuple[int, int],
-                 work_dir: str, epsilon: int):
+                 work_dir: str, epsilon: int, epsilon_range: Optional[str] = None):
         self.firmware_path = firmware_path
         self.config_path = openocd_config_path
         self.ram_region = ram_region
         self.peripheral_region = peripheral_region
         self.work_dir = work_dir
         self.epsilon = epsilon
+        self.epsilon_range = epsilon_range
 
         self.living_processes = dict()
         signal.signal(signal.SIGINT, self.handle_sigint)
@@ -63,6 +66,10 @@ class Controller:
     def get_phase_directory(self, phase_no: int):
         return naming_things.setup_directory(self.work_dir, phase_no)
 
+    def get_instruction_cache_path(self) -> str:
+        cache_name = naming_things.create_instruction_cache_name(firmware_digest(self.firmware_path))
+        return os.path.join(self.get_phase_directory(1), cache_name)
+
     def device_needs_flashing(self):
         last_flash_mark = os.path.join(self.get_phase_directory(1), naming_things.LAST_FLASH_MARKER)
         identifying_information = self.firmware_path + self.config_path
@@ -84,13 +91,13 @@ class Controller:
         process.wait()
         del self.living_processes[args[1]]
 
-    def flash_firmware_step01(self):
+    def flash_firmware_step01(self, decode_only: bool = False):
         self.run_phase([
             'python', './phases/01_preparation.py',
             self.firmware_path,
             self.config_path,
             self.get_phase_directory(1),
-        ])
+        ] + (["--decode-only"] if decode_only else []))
 
     def record_step02(self):
         self.run_phase([
@@ -100,16 +107,20 @@ class Controller:
             '%d' % self.peripheral_region[0], '%d' % self.peripheral_region[1],
             self.get_phase_directory(2),
             "--grace", '%d' % GRACE_STEPS,
+            "--instruction-cache", self.get_instruction_cache_path(),
         ])
 
     def analyze_step03(self):
-        self.run_phase([
+        arguments = [
             'python', './phases/03_global_analysis.py',
             self.get_phase_directory(2),
             "%d" % self.ram_region[0],
             "%d" % self.epsilon,
             self.get_phase_directory(3),
-        ])
+        ]
+        if self.epsilon_range is not None:
+            arguments += ["--epsilon-range", self.epsilon_range]
+        self.run_phase(arguments)
 
     def record_peripherals_step04(self):
         self.run_phase([
@@ -121,6 +132,7 @@ class Controller:
             '%d' % self.peripheral_region[0], '%d' % self.peripheral_region[1],
             self.get_phase_directory(4),
             "--grace", '%d' % GRACE_STEPS,
+            "--instruction-cache", self.get_instruction_cache_path(),
         ])
 
     def analyze_peripherals_step05(self):
@@ -144,6 +156,7 @@ class Controller:
             '%d' % self.peripheral_region[0], '%d' % self.peripheral_region[1],
             self.get_phase_directory(6),
             "--grace", '%d' % GRACE_STEPS,
+            "--instruction-cache", self.get_instruction_cache_path(),
         ])
 
     def summarize_step07(self):
@@ -174,8 +187,11 @@ class Controller:
                 print("Warning, stop < start, assuming stop == start.")
                 stop_after = skip_to
 
-        if skip_to <= 1 <= stop_after and self.device_needs_flashing():
-            self.flash_firmware_step01()
+        if skip_to <= 1 <= stop_after:
+            if self.device_needs_flashing():
+                self.flash_firmware_step01()
+            elif not os.path.exists(self.get_instruction_cache_path()):
+                self.flash_firmware_step01(decode_only=True)
 
         if skip_to <= 2 <= stop_after:
             self.record_step02()
@@ -211,6 +227,8 @@ def main():
 
     parser.add_argument('-d', '--working-directory', dest="work_dir", type=str, default='./D4A2')
     parser.add_argument('-e', '--set-epsilon', dest="epsilon", type=auto_int, default=0x300)
+    parser.add_argument('-r', '--epsilon-range', dest="epsilon_range", type=str, default=None,
+                        help="LOW:HIGH[:STEP], let phase 03 pick the most stable epsilon of this range.")
 
     parser.add_argument('-s', '--start', dest="start_at", type=int, default=0)
     parser.add_argument('-t', '--stop', dest="stop_after", type=int, default=-1)
@@ -246,6 +264,7 @@ def main():
         peripheral_region=intercept_region,
         work_dir=work_dir,
         epsilon=epsilon,
+        epsilon_range=args.epsilon_range,
     )
     controller.start(skip_to=args.start_at, stop_after=args.stop_after)
     # controller.start(skip_to=6, stop_after=args.stop_after)
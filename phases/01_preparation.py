@@ -1,9 +1,11 @@
 import argparse
+import collections
 import os
 
 from avatar2 import Avatar, ARM_CORTEX_M3, OpenOCDTarget
 
-from utilities import restart_connected_devices
+from a2h.static_decoder import decode_firmware
+from utilities import restart_connected_devices, naming_things
 
 
 def flash_board(firmware_path, openocd_config_path, work_dir_path):
@@ -22,6 +24,23 @@ def flash_board(firmware_path, openocd_config_path, work_dir_path):
     print("Phase 01 done")
 
 
+def decode_instructions(firmware_path, work_dir_path):
+    print("Decoding all loads and stores of %s" % firmware_path)
+    instruction_cache = decode_firmware(firmware_path)
+    cache_path = os.path.join(
+        work_dir_path, naming_things.create_instruction_cache_name(instruction_cache.firmware_digest)
+    )
+    instruction_cache.to_file(cache_path)
+    print("Stored %d decoded instructions in %s" % (len(instruction_cache), cache_path))
+
+    if len(instruction_cache.unsupported) > 0:
+        mnemonics = collections.Counter([x[1].mnemonic for x in instruction_cache.unsupported.values()])
+        print("Warning, %d memory accesses can not be replayed if they touch a peripheral:" %
+              len(instruction_cache.unsupported))
+        for mnemonic, count in mnemonics.most_common():
+            print("\t%8s: %d" % (mnemonic, count))
+
+
 # noinspection DuplicatedCode
 def main():
     parser = argparse.ArgumentParser()
@@ -29,6 +48,8 @@ def main():
     parser.add_argument('firmware', type=str, help="Path to the firmware file (elf) used for analysis.")
     parser.add_argument('openocd_cfg', type=str, help="Path to the openocd configuration file for the DuT.")
     parser.add_argument('work_dir', type=str, help="Working directory.")
+    parser.add_argument('--decode-only', dest='decode_only', action='store_true',
+                        help="Only decode the firmware's instructions, do not flash the device.")
 
     args = parser.parse_args()
 
@@ -47,8 +68,10 @@ def main():
         print("Working directory is not available")
         exit(1)
 
-    restart_connected_devices()
-    flash_board(firmware_path, openocd_config_path, work_dir_path)
+    if not args.decode_only:
+        restart_connected_devices()
+        flash_board(firmware_path, openocd_config_path, work_dir_path)
+    decode_instructions(firmware_path, work_dir_path)
 
 
 if __name__ == '__main__':
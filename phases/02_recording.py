@@ -1,13 +1,20 @@
 import argparse
 import os
-from typing import Tuple
+from typing import Tuple, Optional
 
+from a2h.avatar2handler import SNAPSHOT_MODES, SNAPSHOT_MODE_DUMP_IMAGE
 from phases.recorder import FirmwareRecorder
-from utilities import auto_int, restart_connected_devices
+from phases.recorder.snapshot_store import COMPRESSIONS, COMPRESSION_NONE
+from phases.recorder.trace_logging import FLUSH_EVERY_ENTRY
+from utilities import auto_int, positive_int, restart_connected_devices
 
 
 def record_firmware(openocd_cfg: str, mem_ram: Tuple[int, int], mem_peripheral: Tuple[int, int], work_dir: str,
-                    timeout: int, max_steps: int, grace_steps: int, solve_the_halting_problem: int):
+                    timeout: int, max_steps: int, grace_steps: int, solve_the_halting_problem: int,
+                    snapshot_mode: str = SNAPSHOT_MODE_DUMP_IMAGE, persist_snapshots: bool = True,
+                    deduplicate_snapshots: bool = True, snapshot_pages: Optional[str] = None,
+                    snapshot_compression: str = COMPRESSION_NONE, instruction_cache: Optional[str] = None,
+                    trace_flush_every: int = FLUSH_EVERY_ENTRY, trace_keep_entries: Optional[int] = None):
     mock_regions = []
     shim_regions = []
     # TODO read configuration for hardcoded parameters
@@ -20,7 +27,15 @@ def record_firmware(openocd_cfg: str, mem_ram: Tuple[int, int], mem_peripheral:
         abort_after_loops=solve_the_halting_problem,
         abort_after_pc=-1,
         abort_at_step=max_steps,
-        abort_per_step_timeout=timeout
+        abort_per_step_timeout=timeout,
+        snapshot_mode=snapshot_mode,
+        persist_snapshots=persist_snapshots,
+        deduplicate_snapshots=deduplicate_snapshots,
+        snapshot_page_directory=snapshot_pages,
+        snapshot_compression=snapshot_compression,
+        instruction_cache_path=instruction_cache,
+        trace_flush_every=trace_flush_every,
+        trace_keep_entries=trace_keep_entries
     )
     # TODO re-enable
     # recorder.poison()
@@ -46,9 +61,27 @@ def main():
     parser.add_argument('--grace', dest='abort_grace_steps', type=int, default=5,
                         help="Keep recording this many steps after aborts.")
     parser.add_argument(
-        '--solve_the_halting_problem', default=4, type=int,
-        help="Abort if peripherals are accessed exactly the same way this many times in a row."
+        '--solve_the_halting_problem', default=-1, type=int,
+        help="Abort if the latest peripheral accesses repeat exactly this many times in a row, any period and "
+             "polling a single register included (-1 to disable, the default)."
     )
+    parser.add_argument('--snapshot-mode', dest='snapshot_mode', choices=SNAPSHOT_MODES,
+                        default=SNAPSHOT_MODE_DUMP_IMAGE,
+                        help="How RAM snapshots are read from the device, read_memory needs OpenOCD 0.12 or later.")
+    parser.add_argument('--no-snapshot-files', dest='persist_snapshots', action='store_false',
+                        help="Keep RAM snapshots in memory only, do not write them to the snapshot directory.")
+    parser.add_argument('--raw-snapshot-files', dest='deduplicate_snapshots', action='store_false',
+                        help="Write every snapshot as a full image file instead of using the deduplicated store.")
+    parser.add_argument('--snapshot-pages', dest='snapshot_pages', type=str, default=None,
+                        help="Page directory of the snapshot store, can be shared between runs.")
+    parser.add_argument('--snapshot-compression', dest='snapshot_compression', choices=COMPRESSIONS,
+                        default=COMPRESSION_NONE, help="Compression of the pages in the snapshot store.")
+    parser.add_argument('--instruction-cache', dest='instruction_cache', type=str, default=None,
+                        help="File to keep decoded instructions in between runs of the same firmware.")
+    parser.add_argument('--trace-flush-every', dest='trace_flush_every', type=int, default=FLUSH_EVERY_ENTRY,
+                        help="Flush the streamed trace after this many entries (0 to only flush at the end).")
+    parser.add_argument('--trace-keep-entries', dest='trace_keep_entries', type=positive_int, default=None,
+                        help="Only keep this many of the latest trace entries in memory (default: all).")
 
     args = parser.parse_args()
 
@@ -73,7 +106,9 @@ def main():
     restart_connected_devices()
 
     record_firmware(openocd_config_path, mem_ram, mem_peripheral, work_dir_path, timeout, max_steps, grace_steps,
-                    solve_the_halting_problem)
+                    solve_the_halting_problem, args.snapshot_mode, args.persist_snapshots,
+                    args.deduplicate_snapshots, args.snapshot_pages, args.snapshot_compression, args.instruction_cache,
+                    args.trace_flush_every, args.trace_keep_entries)
 
 
 if __name__ == '__main__':
@@ -1,11 +1,30 @@
 import argparse
 import os
 
-from phases.analyzer import ClusteringAnalyzer
-from phases.recorder import ExecutionTrace, trace_logging
+from phases.analyzer import ClusteringAnalyzer, StreamingAnalyzer
+from phases.recorder import TraceReference
 from utilities import auto_int
 
 
+def epsilon_type(x):
+    """ An integer like auto_int, or "auto" to let the analyzer suggest one from the accessed addresses. """
+    if x == "auto":
+        return None
+    return auto_int(x)
+
+
+def epsilon_range_type(x):
+    """ LOW:HIGH[:STEP] with auto_int values, HIGH is included. Without a step 64 epsilons are tried. """
+    parts = [auto_int(y) for y in x.split(':')]
+    if len(parts) not in [2, 3]:
+        raise argparse.ArgumentTypeError("Expected LOW:HIGH[:STEP], got %s" % x)
+    low, high = parts[0], parts[1]
+    step = parts[2] if len(parts) == 3 else max(1, (high - low) // 64)
+    if low <= 0 or high < low or step <= 0:
+        raise argparse.ArgumentTypeError("Invalid epsilon range %s" % x)
+    return range(low, high + 1, step)
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -13,16 +32,36 @@ def main():
     parser.add_argument('ram_base', type=auto_int, help="Base address (offset) of the start of the dump snapshots.")
     parser.add_argument(
         'epsilon',
-        type=auto_int,
+        type=epsilon_type,
         help="Specify a minimal size criterion for peripheral clustering. Use 75% of the actual peripheral size for "
-             "best results. (example: 0x300 based on 0x400)."
+             "best results. (example: 0x300 based on 0x400). Use 'auto' to derive it from the gaps between the "
+             "accessed addresses."
     )
     parser.add_argument('work_dir', type=str, help="Working directory.")
+    parser.add_argument(
+        '--epsilon-range',
+        dest="epsilon_range",
+        type=epsilon_range_type,
+        default=None,
+        help="Cluster for every epsilon in LOW:HIGH[:STEP], report the peripherals found per epsilon and use the "
+             "most stable one instead of the given epsilon."
+    )
+    parser.add_argument('--workers', type=int, default=None, help="Number of threads for the epsilon range.")
+    parser.add_argument(
+        '--streaming',
+        action='store_true',
+        help="Stream the trace instead of loading it, for recordings that are too long to have in memory. The "
+             "recording must be finished."
+    )
+    parser.add_argument(
+        '--memory-budget',
+        dest="memory_budget",
+        type=int,
+        default=512,
+        help="Memory in MiB the streaming analysis may use for its aggregates."
+    )
 
     args = parser.parse_args()
-    # dump_dir = os.path.join(args.recording_dir, naming_things.MEMORY_SNAPSHOT_DIRECTORY)
-    recording_json_path = os.path.join(args.recording_dir, trace_logging.RECORDING_JSON)
-    entries: ExecutionTrace = ExecutionTrace.from_file(recording_json_path)
 
     if not os.path.exists(args.work_dir):
         os.mkdir(args.work_dir)
@@ -30,8 +69,18 @@ def main():
     if not os.path.isdir(args.work_dir):
         raise Exception("%s is not a directory." % args.work_dir)
 
-    a = ClusteringAnalyzer(entries, args.ram_base, work_dir=args.work_dir)
-    a.start(epsilon=args.epsilon)
+    if args.streaming:
+        a = StreamingAnalyzer(args.recording_dir, args.ram_base, work_dir=args.work_dir,
+                              memory_budget=args.memory_budget * 1024 * 1024)
+    else:
+        # dump_dir = os.path.join(args.recording_dir, naming_things.MEMORY_SNAPSHOT_DIRECTORY)
+        # The DMA info refers to the trace of the recording instead of holding a copy.
+        trace_reference = TraceReference.of_recording(args.recording_dir)
+        a = ClusteringAnalyzer(trace_reference, args.ram_base, work_dir=args.work_dir)
+    epsilon = args.epsilon
+    if args.epsilon_range is not None:
+        epsilon = a.sweep_epsilon(args.epsilon_range, workers=args.workers)
+    a.start(epsilon=epsilon)
 
 
 if __name__ == '__main__':
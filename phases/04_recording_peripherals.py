@@ -7,6 +7,7 @@ from typing import Dict
 
 from phases.analyzer.peripheral_row import PeripheralRow, Peripheral
 from utilities import auto_int, naming_things
+from utilities.storable import VALIDATION_CHECKSUM
 from phases.recorder import trace_logging, TraceEntry
 from phases.analyzer.dma_info import DmaInfo
 
@@ -33,6 +34,8 @@ def main():
 
     parser.add_argument('--grace', dest='abort_grace_steps', type=int, default=5,
                         help="Keep recording this many steps after aborts.")
+    parser.add_argument('--instruction-cache', dest='instruction_cache', type=str, default=None,
+                        help="File to keep decoded instructions in between runs of the same firmware.")
 
     # TODO perhaps make an argument
     limit_by_pc = False
@@ -62,7 +65,7 @@ def main():
     # endregion handle subprocesses
 
     dma_info_file = os.path.join(args.analysis_dir, naming_things.DMA_INFO_JSON)
-    dma_info: DmaInfo = DmaInfo.from_file(dma_info_file)
+    dma_info: DmaInfo = DmaInfo.from_file(dma_info_file, validation=VALIDATION_CHECKSUM)
     if dma_info.index_of_first_incidence == -1:
         print("No DMA found, abandoning this step.")
         return
@@ -73,7 +76,7 @@ def main():
 
     # original_recording = os.path.join(args.recording_dir, trace_logging.RECORDING_JSON)
     peripherals_path = os.path.join(args.analysis_dir, naming_things.PERIPHERAL_JSON_NAME)
-    peripheral_row: PeripheralRow = PeripheralRow.from_file(peripherals_path)
+    peripheral_row: PeripheralRow = PeripheralRow.from_file(peripherals_path, validation=VALIDATION_CHECKSUM)
 
     test_run_name = "test_run"
     test_proc = single_peripheral(args, first_incidence_index, first_incidence_pc, limit_by_pc, dma_info_file,
@@ -130,7 +133,10 @@ def single_peripheral(
         str(30),  # Wait for at most 30s per step
         run_dir,
         "--poison",
+        "--snapshot-pages", os.path.join(args.work_dir, naming_things.SNAPSHOT_PAGES_DIRECTORY),
     ]
+    if args.instruction_cache is not None:
+        parameters += ["--instruction-cache", args.instruction_cache]
     restart_connected_devices()
     current_proc = Popen(parameters)
     return current_proc
@@ -1,12 +1,13 @@
 import argparse
 import os
-from typing import List, Tuple
 
 import numpy
 
 from phases.analyzer import DmaInfo, PeripheralRow, Peripheral, InfoFlag
-from phases.recorder import ExecutionTrace, TraceEntry, trace_logging
+from phases.recorder import TraceEntry, TraceReference
+from phases.recorder.dma_summary import summarize_trace
 from utilities import auto_int, naming_things
+from utilities.storable import VALIDATION_CHECKSUM
 
 
 def contemplate_differences(peripheral: Peripheral, step_number: int, diff):
@@ -118,21 +119,14 @@ class PeripheralAnalyzer:
             print("\n")
 
     def _debug_print_instances_of_dma(self):
-        global_trace_entries = self.dma_info.execution_trace.entries
-
         print("The full trace contains DMA-like behaviour in the following steps:")
-        global_trace_entries_with_dma = [x for x in global_trace_entries if len(x.async_deltas) > 0]
-        for indexed_entry in global_trace_entries_with_dma:
-            ete_index = global_trace_entries.index(indexed_entry)
-            print("\t - %d" % ete_index)
+        for step in summarize_trace(self.dma_info.execution_trace).dma_steps:
+            print("\t - %d" % step)
         print("\n")
         for p in self.peripheral_row.peripherals:
             print("The trace for the peripheral at address x%08X has DMA-like behaviour in:" % p.start)
-            indexed_dma_entries: List[Tuple[int, TraceEntry]] = [
-                (i, x) for i, x in enumerate(p.execution_trace.entries) if len(x.async_deltas) > 0
-            ]
-            for indexed_entry in indexed_dma_entries:
-                print("\t - %d" % indexed_entry[0])
+            for step in summarize_trace(p.execution_trace).dma_steps:
+                print("\t - %d" % step)
             print("\n")
 
 
@@ -149,10 +143,10 @@ def main():
     args = parser.parse_args()
 
     dma_info_path = os.path.join(args.analysis_dir, naming_things.DMA_INFO_JSON)
-    global_dma_info: DmaInfo = DmaInfo.from_file(dma_info_path)
+    global_dma_info: DmaInfo = DmaInfo.from_file(dma_info_path, validation=VALIDATION_CHECKSUM)
 
     peripheral_path = os.path.join(args.analysis_dir, naming_things.PERIPHERAL_JSON_NAME)
-    peripheral_row: PeripheralRow = PeripheralRow.from_file(peripheral_path)
+    peripheral_row: PeripheralRow = PeripheralRow.from_file(peripheral_path, validation=VALIDATION_CHECKSUM)
 
     if not os.path.exists(args.work_dir):
         os.mkdir(args.work_dir)
@@ -172,9 +166,7 @@ def main():
         run_name = naming_things.create_peripheral_run_name(peripheral_address)
         run_dir = os.path.join(args.peripheral_recording_dir, run_name + "/")
 
-        peripheral_trace_path = os.path.join(run_dir, trace_logging.RECORDING_JSON)
-        peripheral_trace: ExecutionTrace = ExecutionTrace.from_file(peripheral_trace_path)
-        peripheral.execution_trace = peripheral_trace
+        peripheral.execution_trace = TraceReference.of_recording(run_dir)
 
         exit_reason_path = os.path.join(run_dir, naming_things.EXIT_REASON_FILE)
         with open(exit_reason_path, mode='r') as exit_file:
@@ -183,9 +175,7 @@ def main():
 
     dummy_peripheral = Peripheral(-1, -1)
     test_run_dir = os.path.join(args.peripheral_recording_dir, "test_run/")
-    peripheral_trace_path = os.path.join(test_run_dir, trace_logging.RECORDING_JSON)
-    peripheral_trace: ExecutionTrace = ExecutionTrace.from_file(peripheral_trace_path)
-    dummy_peripheral.execution_trace = peripheral_trace
+    dummy_peripheral.execution_trace = TraceReference.of_recording(test_run_dir)
 
     exit_reason_path = os.path.join(test_run_dir, naming_things.EXIT_REASON_FILE)
     with open(exit_reason_path, mode='r') as exit_file:
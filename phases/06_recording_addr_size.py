@@ -8,10 +8,13 @@ from typing import Dict, Tuple, List, Optional
 import numpy
 
 from phases.analyzer import DmaInfo, PeripheralRow, InfoFlag
-from phases.analyzer.clusteringanalyzer import static_find_first_dma_incidence
+from phases.analyzer.candidate_search import base_test, size_test
+from phases.analyzer.clusteringanalyzer import static_find_first_dma_incidence_index
 from phases.recorder import TraceEntry, ExecutionTrace, trace_logging
 from phases.recorder.execution_trace import TraceEntryDiff
-from utilities import auto_int, naming_things, restart_connected_devices
+from phases.recorder.dma_summary import summarize_trace
+from utilities import auto_int, naming_things, restart_connected_devices, RegionIndex
+from utilities.storable import VALIDATION_CHECKSUM
 
 LIST_OF_EXECUTION_AFFECTING_FLAGS = [
     InfoFlag.UNKNOWN,
@@ -65,35 +68,37 @@ def process_diff(diff: TraceEntryDiff) -> List[InfoFlag]:
     return flags
 
 
-def test_entry_address_matches(entry: TraceEntry, test_value: int) -> bool:
-    new_incidence_address = min([x.address for x in entry.async_deltas])
+def test_address_matches(bounds: Tuple[int, int], test_value: int) -> bool:
+    """ :param bounds: Bounds of the DMA of a step, see DmaSummary.bounds. """
+    new_incidence_address = bounds[0]
     if new_incidence_address == test_value:
         return True
     return False
 
 
 def find_first_incidence_with_dma_at_addr(run_dir: str, test_value: int) -> Optional[TraceEntry]:
-    new_trace: ExecutionTrace = ExecutionTrace.from_file(os.path.join(run_dir, trace_logging.RECORDING_JSON))
-    new_first_incidence = static_find_first_dma_incidence(new_trace)
+    new_trace: ExecutionTrace = trace_logging.load_trace(run_dir)
+    dma_summary = summarize_trace(new_trace)
+    new_first_incidence = static_find_first_dma_incidence_index(new_trace)
     if new_first_incidence is None:
         return None
 
-    if test_entry_address_matches(new_first_incidence, test_value):
-        return new_first_incidence
+    if test_address_matches(dma_summary.bounds(new_first_incidence), test_value):
+        return new_trace.entries[new_first_incidence]
 
     print("Warning, DMA may have occurred in a different configuration")
-    for entry in new_trace.entries:
-        if len(entry.async_deltas) > 0:
-            if test_entry_address_matches(entry, test_value):
-                print("Another entry does have the target value.")
-                return entry
+    for step in dma_summary.dma_steps:
+        if test_address_matches(dma_summary.bounds(step), test_value):
+            print("Another entry does have the target value.")
+            return new_trace.entries[step]
 
     return None
 
 
-def test_entry_size_matches(entry: TraceEntry, test_value: int, prior_value: int) -> bool:
-    delta_addresses = [x.address for x in entry.async_deltas]
-    new_incidence_size = max(delta_addresses) - min(delta_addresses)
+def test_size_matches(bounds: Tuple[int, int], test_value: int, prior_value: int) -> bool:
+    """ :param bounds: Bounds of the DMA of a step, see DmaSummary.bounds. """
+    lowest, highest = bounds
+    new_incidence_size = highest - 1 - lowest
 
     # Exact matches are likely good
     if new_incidence_size == test_value:
@@ -115,38 +120,34 @@ def test_entry_size_matches(entry: TraceEntry, test_value: int, prior_value: int
 
 
 def find_first_incidence_with_dma_of_size(run_dir, test_value, prior_value) -> Optional[TraceEntry]:
-    new_trace: ExecutionTrace = ExecutionTrace.from_file(os.path.join(run_dir, trace_logging.RECORDING_JSON))
-    new_first_incidence = static_find_first_dma_incidence(new_trace)
+    new_trace: ExecutionTrace = trace_logging.load_trace(run_dir)
+    dma_summary = summarize_trace(new_trace)
+    new_first_incidence = static_find_first_dma_incidence_index(new_trace)
     if new_first_incidence is None:
         return None
 
-    if test_entry_size_matches(new_first_incidence, test_value, prior_value):
-        return new_first_incidence
+    if test_size_matches(dma_summary.bounds(new_first_incidence), test_value, prior_value):
+        return new_trace.entries[new_first_incidence]
 
     print("Warning, DMA may have occurred in a different configuration")
-    for entry in new_trace.entries:
-        if len(entry.async_deltas) > 0:
-            if test_entry_size_matches(entry, test_value, prior_value):
-                print("Another entry does have the target value.")
-                return entry
+    for step in dma_summary.dma_steps:
+        if test_size_matches(dma_summary.bounds(step), test_value, prior_value):
+            print("Another entry does have the target value.")
+            return new_trace.entries[step]
 
     return None
 
 
 def test_no_dma_near_addr_and_size(run_dir, original_address, original_size):
     """ Returns True IFF no dma was found matching either size or address"""
-    new_trace: ExecutionTrace = ExecutionTrace.from_file(os.path.join(run_dir, trace_logging.RECORDING_JSON))
-    for entry in new_trace.entries:
-        if len(entry.async_deltas) == 0:
-            # This entry has no DMA, check the next
-            continue
-
-        # As we haven't yet left, there is some DMA, check its addr and size.
-        if test_entry_address_matches(entry, original_address):
+    dma_summary = trace_logging.load_dma_summary(run_dir)
+    for step in dma_summary.dma_steps:
+        # There is some DMA, check its addr and size.
+        if test_address_matches(dma_summary.bounds(step), original_address):
             print("Found DMA at original address, assuming cancel failed.")
             return False
         # TODO add a flag to disable this
-        if test_entry_size_matches(entry, original_size, original_size * 1.25):
+        if test_size_matches(dma_summary.bounds(step), original_size, original_size * 1.25):
             print("Found DMA near the original size, assuming cancel failed.")
             return False
 
@@ -180,12 +181,14 @@ class InstanceRunner:
     work_dir: str
 
     dma_info_path: str
+    instruction_cache: Optional[str]
 
     subprocesses: Dict[str, Popen]
 
     def __init__(self, dma_info: DmaInfo, dma_info_path: str, peripheral_info: PeripheralRow, openocd_cfg: str,
                  grace_steps: int,
-                 limit_by_pc: bool, ram_area: Tuple[int, int], intercept_area: Tuple[int, int], work_dir: str):
+                 limit_by_pc: bool, ram_area: Tuple[int, int], intercept_area: Tuple[int, int], work_dir: str,
+                 instruction_cache: Optional[str] = None):
 
         if dma_info.index_of_first_incidence == -1:
             print("No Dma found in earlier step, cancelling current step.")
@@ -214,6 +217,7 @@ class InstanceRunner:
         signal.signal(signal.SIGTERM, self.kill_subprocesses)
 
         self.dma_info_path = dma_info_path
+        self.instruction_cache = instruction_cache
 
         self.always_no = False
 
@@ -302,8 +306,11 @@ class InstanceRunner:
 
             str(30),  # Wait for at most 30s per step
             run_dir,
-            '--poison'
+            '--poison',
+            '--snapshot-pages', os.path.join(self.work_dir, naming_things.SNAPSHOT_PAGES_DIRECTORY),
         ]
+        if self.instruction_cache is not None:
+            parameters += ['--instruction-cache', self.instruction_cache]
         restart_connected_devices()
         current_proc = Popen(parameters)
         self.subprocesses[name] = current_proc
@@ -327,8 +334,7 @@ class InstanceRunner:
     def figure_out_test(self):
         run_name = "test"
         run_dir = self.run_a_run(run_name, -10, new_value=-1)
-        trace_path = os.path.join(run_dir, trace_logging.RECORDING_JSON)
-        trace = ExecutionTrace.from_file(trace_path)
+        trace = trace_logging.load_trace(run_dir)
         diff = self.get_trace_diff(trace)
 
         fail = False
@@ -348,19 +354,29 @@ class InstanceRunner:
         already_processed_addresses: List[int] = []
         candidate: TraceEntry
         valid_entries = []
-        for candidate_index in reversed(self.set_base_candidates):
+        # Candidates are ranked, the most likely ones are tried first.
+        for candidate_index in self.set_base_candidates:
             candidate = self.dma_info.execution_trace.entries[candidate_index]
             run_addr = candidate.address
             if run_addr in already_processed_addresses:
                 continue
 
+            # Derived candidates move the base by their own offset or shift.
+            derivation = self.dma_info.derivation_of_set_base_instruction(candidate_index)
+            test = None if derivation is None else base_test(candidate.value, derivation, self.dma_info.dma_region_base)
+            if test is None:
+                print("Unable to test base candidate %d, 0x%X does not give the base." % (
+                    candidate_index, candidate.value
+                ))
+                continue
+            test_value, expected_base = test
+
             already_processed_addresses.append(run_addr)
 
             run_name = "set_addr_x%08X_%d" % (candidate.address, candidate_index)
-            test_value = candidate.value + 0x4
 
             run_dir = self.run_a_run(run_name, run_addr, new_value=test_value)
-            new_first_incidence = find_first_incidence_with_dma_at_addr(run_dir, test_value)
+            new_first_incidence = find_first_incidence_with_dma_at_addr(run_dir, expected_base)
             if new_first_incidence is not None:
                 valid_entries.append((candidate_index, candidate))
                 if fast:
@@ -375,27 +391,30 @@ class InstanceRunner:
         already_processed_addresses: List[int] = []
         candidate: TraceEntry
         valid_entries = []
-        for candidate_index in reversed(self.set_size_candidates):
+        # Candidates are ranked, the most likely ones are tried first.
+        for candidate_index in self.set_size_candidates:
             candidate = self.dma_info.execution_trace.entries[candidate_index]
             run_addr = candidate.address
             if run_addr in already_processed_addresses:
                 continue
 
+            # Counts minus one and packed counts are not proportional to the size, the derivation says how to test.
+            derivation = self.dma_info.derivation_of_set_size_instruction(candidate_index)
+            prior_size = self.dma_info.dma_region_size
+            test = None if derivation is None else size_test(candidate.value, derivation, prior_size)
+            if test is None:
+                print("Unable to test size candidate %d, 0x%X does not give the size." % (
+                    candidate_index, candidate.value
+                ))
+                continue
+            test_value, expected_size = test
+
             already_processed_addresses.append(run_addr)
 
             run_name = "set_size_x%08X_%d" % (candidate.address, candidate_index)
-            if -64 <= candidate.value <= 64:
-                test_value = candidate.value * 2
-            else:
-                test_value = candidate.value * 2
 
             run_dir = self.run_a_run(run_name, run_addr, new_value=test_value)
-            prior_size = self.dma_info.dma_region_size
-            factor = prior_size / candidate.value
-
-            new_first_incidence = find_first_incidence_with_dma_of_size(
-                run_dir, test_value * factor, candidate.value * factor
-            )
+            new_first_incidence = find_first_incidence_with_dma_of_size(run_dir, expected_size, prior_size)
             if new_first_incidence is not None:
                 valid_entries.append((candidate_index, candidate))
                 if fast:
@@ -447,8 +466,14 @@ class InstanceRunner:
         verified_triggering_entries: List[Tuple[int, TraceEntry]] = self.process_triggers()
 
         verified_bse_indices = [x for x, y in verified_base_set_entries]
+        self.dma_info.derivations_of_set_base_instructions = [
+            self.dma_info.derivation_of_set_base_instruction(x) for x in verified_bse_indices
+        ]
         self.dma_info.indices_of_set_base_instructions = verified_bse_indices
         verified_sse_indices = [x for x, y in verified_size_set_entries]
+        self.dma_info.derivations_of_set_size_instructions = [
+            self.dma_info.derivation_of_set_size_instruction(x) for x in verified_sse_indices
+        ]
         self.dma_info.indices_of_set_size_instructions = verified_sse_indices
 
         self.dma_info.indices_of_trigger_instructions = [
@@ -478,7 +503,7 @@ class InstanceRunner:
             print("\tNo results")
         else:
             for index, entry in verified_size_set_entries:
-                print("\t%d: %s", index, entry.__dict__)
+                print("\t%d: %s" % (index, entry.__getstate__()))
         return verified_size_set_entries
 
     def process_addr(self):
@@ -489,7 +514,7 @@ class InstanceRunner:
             print("\tNo results")
         else:
             for index, entry in verified_base_set_entries:
-                print("\t%d: %s", index, entry.__dict__)
+                print("\t%d: %s" % (index, entry.__getstate__()))
         return verified_base_set_entries
 
     def get_trace_diff(self, trace: ExecutionTrace) -> Dict[InfoFlag, bool]:
@@ -521,40 +546,41 @@ class InstanceRunner:
         return accumulator
 
     def filter_out_irrelevant_peripherals(self):
-        # TODO refresh memory on why this is written the way it is written. It seems the wrong way around but it works?
-        for peripheral in self.peripheral_info.peripherals:
-            if peripheral.has_one_of_flags(LIST_OF_EXECUTION_AFFECTING_FLAGS):
-                # This peripheral has changed execution somehow and IS interesting
-                pass
-            else:
-                # This peripheral has not changed execution, and as such is not interesting.
-                print("Dumping a peripheral")
-                len1 = len(self.set_base_candidates)
-                self.set_base_candidates = [
-                    x for x in self.set_base_candidates
-                    if not (peripheral.start <= self.dma_info.execution_trace.entries[x].address < peripheral.end)
-                ]
-                len2 = len(self.set_base_candidates)
-                if len1 != len2:
-                    print("Set base candidates reduced from %d to %d" % (len1, len2))
-
-                len1 = len(self.set_size_candidates)
-                self.set_size_candidates = [
-                    x for x in self.set_size_candidates
-                    if not (peripheral.start <= self.dma_info.execution_trace.entries[x].address < peripheral.end)
-                ]
-                len2 = len(self.set_size_candidates)
-                if len1 != len2:
-                    print("Set size candidates reduced from %d to %d" % (len1, len2))
-
-                len1 = len(self.trigger_candidates)
-                self.trigger_candidates = [
-                    x for x in self.trigger_candidates
-                    if not (peripheral.start <= self.dma_info.execution_trace.entries[x].address < peripheral.end)
-                ]
-                len2 = len(self.trigger_candidates)
-                if len1 != len2:
-                    print("Trigger candidates reduced from %d to %d" % (len1, len2))
+        # Peripherals that did not change execution are not interesting, drop the candidates that access them.
+        irrelevant_peripherals = RegionIndex(
+            [(x.start, x.size) for x in self.peripheral_info.peripherals
+             if not x.has_one_of_flags(LIST_OF_EXECUTION_AFFECTING_FLAGS)],
+            "peripheral"
+        )
+        if len(irrelevant_peripherals) == 0:
+            return
+        print("Dumping %d peripherals" % len(irrelevant_peripherals))
+
+        entries = self.dma_info.execution_trace.entries
+
+        len1 = len(self.set_base_candidates)
+        self.set_base_candidates = [
+            x for x in self.set_base_candidates if not irrelevant_peripherals.contains(entries[x].address)
+        ]
+        len2 = len(self.set_base_candidates)
+        if len1 != len2:
+            print("Set base candidates reduced from %d to %d" % (len1, len2))
+
+        len1 = len(self.set_size_candidates)
+        self.set_size_candidates = [
+            x for x in self.set_size_candidates if not irrelevant_peripherals.contains(entries[x].address)
+        ]
+        len2 = len(self.set_size_candidates)
+        if len1 != len2:
+            print("Set size candidates reduced from %d to %d" % (len1, len2))
+
+        len1 = len(self.trigger_candidates)
+        self.trigger_candidates = [
+            x for x in self.trigger_candidates if not irrelevant_peripherals.contains(entries[x].address)
+        ]
+        len2 = len(self.trigger_candidates)
+        if len1 != len2:
+            print("Trigger candidates reduced from %d to %d" % (len1, len2))
 
     def populate_triggers(self):
         self.trigger_candidates = list(range(self.dma_info.index_of_first_incidence, -1, -1))
@@ -581,6 +607,11 @@ def main():
 
     parser.add_argument('--grace', dest='abort_grace_steps', type=int, default=5,
                         help="Keep recording this many steps after aborts.")
+    parser.add_argument('--instruction-cache', dest='instruction_cache', type=str, default=None,
+                        help="File to keep decoded instructions in between runs of the same firmware.")
+    parser.add_argument('--incidence', dest='incidence', type=int, default=None,
+                        help="Verify this DMA incidence of the global analysis instead of the largest one. Use a "
+                             "separate working directory per incidence.")
 
     # TODO perhaps make an argument
     limit_by_pc = False
@@ -588,20 +619,24 @@ def main():
     args = parser.parse_args()
     # endregion
 
-    dma_info_file = os.path.join(args.analysis_dir, naming_things.DMA_INFO_JSON)
-    dma_info: DmaInfo = DmaInfo.from_file(dma_info_file)
+    if args.incidence is None:
+        dma_info_file = os.path.join(args.analysis_dir, naming_things.DMA_INFO_JSON)
+    else:
+        dma_info_file = os.path.join(args.analysis_dir, naming_things.create_dma_incidence_name(args.incidence))
+    dma_info: DmaInfo = DmaInfo.from_file(dma_info_file, validation=VALIDATION_CHECKSUM)
 
     # trace_path = os.path.join(args.recording_dir, trace_logging.RECORDING_JSON)
 
     peripheral_info_path = os.path.join(args.peripheral_dir, naming_things.PERIPHERAL_JSON_NAME)
-    peripheral_info: PeripheralRow = PeripheralRow.from_file(peripheral_info_path)
+    peripheral_info: PeripheralRow = PeripheralRow.from_file(peripheral_info_path, validation=VALIDATION_CHECKSUM)
 
     ram_area = (args.ram_start, args.ram_size)
     intercept_area = (args.intercept_start, args.intercept_size)
 
     runner: InstanceRunner = InstanceRunner(dma_info, dma_info_file, peripheral_info, args.openocd_cfg,
                                             args.abort_grace_steps,
-                                            limit_by_pc, ram_area, intercept_area, args.work_dir)
+                                            limit_by_pc, ram_area, intercept_area, args.work_dir,
+                                            instruction_cache=args.instruction_cache)
     runner.start()
     print("Done runner")
 
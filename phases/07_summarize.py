@@ -21,7 +21,9 @@ from typing import Tuple, Optional
 
 from phases.analyzer import DmaInfo, PeripheralRow, InfoFlag
 from phases.recorder import trace_logging, ExecutionTrace
+from phases.recorder.dma_summary import summarize_trace
 from utilities import auto_int, naming_things
+from utilities.storable import VALIDATION_CHECKSUM
 
 LIST_OF_EXECUTION_AFFECTING_FLAGS = [
     InfoFlag.UNKNOWN,
@@ -38,24 +40,11 @@ LIST_OF_EXECUTION_AFFECTING_FLAGS = [
 
 
 def find_dma_ranges(first_trace):
-    ranges = []
-    current_range = None
-    for index, entry in enumerate(first_trace.entries):
-        has_dma = len(entry.async_deltas) > 0
-
-        if has_dma:
-            if current_range is None:
-                current_range = index
-            else:
-                pass  # Extend the range
-        else:
-            if current_range is None:
-                pass  # Do nothing
-            else:
-                ranges.append((current_range, index - current_range))
-                current_range = None
-
-    return ranges
+    """ (first step, length) of every burst of DMA, that ends before the end of the trace. """
+    return [
+        (x.first_step, x.length) for x in summarize_trace(first_trace).bursts
+        if x.last_step + 1 < len(first_trace.entries)
+    ]
 
 
 class Concludermancy:
@@ -350,20 +339,21 @@ def main():
     recording_dir: str = args.recording_dir
     hr_trace_path: str = os.path.join(recording_dir, trace_logging.HUMAN_CSV)
 
-    old_trace_path: str = os.path.join(recording_dir, trace_logging.RECORDING_JSON)
-    old_trace: ExecutionTrace = ExecutionTrace.from_file(old_trace_path)
+    old_trace: ExecutionTrace = trace_logging.load_trace(recording_dir)
 
     # Step 03
     analysis_dir: str = args.analysis_dir
     hr_old_dma_path: str = os.path.join(analysis_dir, naming_things.DMA_INFO_HR_JSON)
 
     old_dma_info_path: str = os.path.join(analysis_dir, naming_things.DMA_INFO_JSON)
-    old_dma_info: DmaInfo = DmaInfo.from_file(old_dma_info_path)
+    old_dma_info: DmaInfo = DmaInfo.from_file(old_dma_info_path, validation=VALIDATION_CHECKSUM)
 
     has_dma = old_dma_info.index_of_first_incidence >= 0
 
     old_peripheral_info_path: str = os.path.join(analysis_dir, naming_things.PERIPHERAL_JSON_NAME)
-    old_peripheral_info: PeripheralRow = PeripheralRow.from_file(old_peripheral_info_path)
+    old_peripheral_info: PeripheralRow = PeripheralRow.from_file(
+        old_peripheral_info_path, validation=VALIDATION_CHECKSUM
+    )
 
     # Step 04
     rec_peripherals_dir: str = args.rec_peripheral_dir
@@ -373,7 +363,7 @@ def main():
     hr_peripherals_path: str = os.path.join(peripheral_dir, naming_things.PERIPHERAL_JSON_HR_NAME)
 
     peripherals_path: str = os.path.join(peripheral_dir, naming_things.PERIPHERAL_JSON_NAME)
-    peripherals: PeripheralRow = PeripheralRow.from_file(peripherals_path)
+    peripherals: PeripheralRow = PeripheralRow.from_file(peripherals_path, validation=VALIDATION_CHECKSUM)
 
     # Step 06
     rec_addr_size_dir: str = args.rec_addr_size_dir
@@ -381,7 +371,7 @@ def main():
 
     dma_info_path: str = os.path.join(rec_addr_size_dir, naming_things.DMA_INFO_JSON)
     if has_dma:
-        dma_info: Optional[DmaInfo] = DmaInfo.from_file(dma_info_path)
+        dma_info: Optional[DmaInfo] = DmaInfo.from_file(dma_info_path, validation=VALIDATION_CHECKSUM)
     else:
         dma_info: Optional[DmaInfo] = None
 
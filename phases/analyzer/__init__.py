@@ -1,3 +1,4 @@
 from .dma_info import DmaInfo
 from .clusteringanalyzer import ClusteringAnalyzer
+from .streaming_analyzer import StreamingAnalyzer
 from .peripheral_row import PeripheralRow, Peripheral, InfoFlag
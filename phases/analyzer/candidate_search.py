@@ -0,0 +1,184 @@
+from typing import List, Tuple, Optional, Dict
+
+from phases.recorder.trace_index import TraceIndex
+
+# Derivations, from the most to the least likely way an instruction sets the value.
+EXACT = "exact"
+ELEMENTS = "elements"
+STRUCT_OFFSET = "struct_offset"
+NEAR = "near"
+MINUS_ONE = "minus_one"
+SHIFT = "shift"
+PACKED = "packed"
+
+RANKS: Dict[str, int] = {
+    EXACT: 0,
+    ELEMENTS: 1,
+    STRUCT_OFFSET: 1,
+    NEAR: 2,
+    MINUS_ONE: 2,
+    SHIFT: 3,
+    PACKED: 4,
+}
+
+# The buffer of a descriptor or struct is often a few words after the pointer that is written.
+STRUCT_OFFSETS = [4, 8, 12, 16, 32]
+NEAR_OFFSETS = [-2, -1, 1, 2]
+MAX_SHIFT = 4
+# Values are packed as a bit field in the high half of a 32 bit register.
+PACKED_SHIFT = 16
+
+# Derived values this small are written all the time, they would only add noise.
+MIN_DERIVED_VALUE = 2
+
+# A base candidate is tested by moving the base a word, which keeps the buffer aligned.
+BASE_TEST_STEP = 4
+
+# (value, derivation) pairs.
+Targets = List[Tuple[int, str]]
+
+
+class Candidate:
+    """ A step that writes a value from which the searched for value can be derived. """
+    __slots__ = ('index', 'value', 'derivation')
+
+    index: int
+    value: int
+    derivation: str
+
+    def __init__(self, index: int, value: int, derivation: str):
+        self.index = index
+        self.value = value
+        self.derivation = derivation
+
+    @property
+    def rank(self) -> int:
+        return RANKS[self.derivation]
+
+    def __repr__(self):
+        return 'Candidate at step %d: 0x%X (%s)' % (self.index, self.value, self.derivation)
+
+
+def base_targets(base: int) -> Targets:
+    """ Values that could set a DMA base address. """
+    targets = [(base, EXACT)]
+    targets += [(base - x, STRUCT_OFFSET) for x in STRUCT_OFFSETS]
+    targets += [(base + x, NEAR) for x in NEAR_OFFSETS]
+    # Word or half word addresses.
+    targets += [(base >> x, SHIFT) for x in range(1, MAX_SHIFT + 1) if base % (1 << x) == 0]
+    return targets
+
+
+def size_targets(size: int) -> Targets:
+    """ Values that could set a DMA size, in bytes or in elements. """
+    element_counts = [
+        size // 2,  # Divide by 2.
+        size // 4,  # Divide by 4
+        (size + 1) // 2,  # Round up to the nearest multiple of 2, divide by 2.
+        (size + 3) // 4,  # Round up to the nearest multiple of 4, divide by 4
+    ]
+    targets = [(size, EXACT)]
+    targets += [(x, ELEMENTS) for x in element_counts]
+    # Counters that hold the number of transfers minus one.
+    targets += [(x - 1, MINUS_ONE) for x in [size] + element_counts]
+    targets += [(size >> 3, SHIFT)]
+    return targets
+
+
+def packed_targets(targets: Targets) -> Targets:
+    """ The values of the targets that fit in the high half of a register. """
+    return [(x, PACKED) for x, derivation in targets if derivation in [EXACT, ELEMENTS] and x < (1 << PACKED_SHIFT)]
+
+
+def _usable(targets: Targets) -> Targets:
+    return [(x, y) for x, y in targets if y == EXACT or x >= MIN_DERIVED_VALUE]
+
+
+def find_candidates(trace_index: TraceIndex, targets: Targets, end: Optional[int] = None) -> List[Candidate]:
+    """
+    Steps that write one of the targets, or one of them packed in the high half of a register.
+
+    :param end: The last step to consider, usually the first incidence of DMA.
+    :return: Candidates ranked by derivation and, within a derivation, the latest step first. Every step is returned
+        once, with its most likely derivation.
+    """
+    candidates: Dict[int, Candidate] = dict()
+
+    def add(index: int, derivation: str):
+        candidate = candidates.get(index, None)
+        if candidate is None or RANKS[derivation] < candidate.rank:
+            candidates[index] = Candidate(index, int(trace_index.values[index]), derivation)
+
+    for value, derivation in _usable(targets):
+        for index in trace_index.indices_with_value(value):
+            if end is None or index <= end:
+                add(index, derivation)
+
+    for value, derivation in _usable(packed_targets(targets)):
+        low = value << PACKED_SHIFT
+        for index in trace_index.indices_with_values_between(low, low | ((1 << PACKED_SHIFT) - 1), end):
+            add(index, derivation)
+
+    return sorted(candidates.values(), key=lambda x: (x.rank, -x.index))
+
+
+def derivation_of(value: int, targets: Targets) -> Optional[str]:
+    """ The most likely derivation of the targets that gives the value, None if there is none. """
+    derivations = [y for x, y in _usable(targets) if x == value]
+    derivations += [y for x, y in _usable(packed_targets(targets)) if x == value >> PACKED_SHIFT and value >> 32 == 0]
+    if len(derivations) == 0:
+        return None
+    return min(derivations, key=lambda x: RANKS[x])
+
+
+def _shift_between(value: int, base: int) -> Optional[int]:
+    """ The shift that turns the value back into the base, None if there is none. """
+    for shift in range(1, MAX_SHIFT + 1):
+        if value << shift == base:
+            return shift
+    return None
+
+
+def base_test(value: int, derivation: str, base: int) -> Optional[Tuple[int, int]]:
+    """
+    How to check a base candidate on the device.
+
+    :return: (value to write instead of the candidate's value, address DMA should then start at), None when the
+        derivation does not give the base for this value.
+    """
+    if derivation in [EXACT, STRUCT_OFFSET, NEAR]:
+        # The base is the value plus an offset, which stays the same.
+        test_value = value + BASE_TEST_STEP
+        return test_value, test_value + (base - value)
+    if derivation == SHIFT:
+        shift = _shift_between(value, base)
+        if shift is None:
+            return None
+        # One more in the shifted value moves the base by one element of 1 << shift bytes.
+        test_value = value + 1
+        return test_value, test_value << shift
+    if derivation == PACKED and value >> PACKED_SHIFT == base:
+        test_value = value + (BASE_TEST_STEP << PACKED_SHIFT)
+        return test_value, base + BASE_TEST_STEP
+    return None
+
+
+def size_test(value: int, derivation: str, size: int) -> Optional[Tuple[int, float]]:
+    """
+    How to check a size candidate on the device, the number of transfers is doubled (halved when a packed count
+    would no longer fit).
+
+    :return: (value to write instead of the candidate's value, size DMA should then have), None when the derivation
+        is unknown.
+    """
+    if derivation in [EXACT, ELEMENTS, SHIFT]:
+        return value * 2, size * 2
+    if derivation == MINUS_ONE:
+        # The value is a count minus one.
+        return (value + 1) * 2 - 1, size * 2
+    if derivation == PACKED:
+        field = value >> PACKED_SHIFT
+        low_half = value & ((1 << PACKED_SHIFT) - 1)
+        test_field = field * 2 if field * 2 < (1 << PACKED_SHIFT) else field // 2
+        return (test_field << PACKED_SHIFT) | low_half, size * test_field / field
+    return None
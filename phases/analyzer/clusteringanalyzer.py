@@ -1,8 +1,18 @@
+import csv
 import os.path
-from typing import Optional, List, Tuple
+from bisect import bisect_left
+from typing import Optional, List, Tuple, Union, Iterable, Callable
 
+import numpy
+
+from phases.analyzer.candidate_search import Candidate, find_candidates, base_targets, size_targets
+from phases.analyzer.gap_clustering import SortedAddresses, suggest_epsilon, NOISE, peripheral_bounds, \
+    sweep_epsilons, most_stable
 from phases.analyzer.peripheral_row import PeripheralRow, Peripheral
-from phases.recorder import ExecutionTrace, TraceEntry
+from phases.recorder import ExecutionTrace, TraceEntry, TraceReference
+from phases.recorder.dma_summary import summarize_trace, DmaRegion
+from phases.recorder.execution_trace import DeltaList
+from phases.recorder.trace_index import index_trace
 from utilities import naming_things
 
 from . import DmaInfo
@@ -21,56 +31,120 @@ def has_value_between(list_of_numbers: List[int], lb: int, ub: int):
     return False
 
 
-def static_find_first_dma_incidence(trace):
-    # First find the largest entry.
-    candidate: Optional[TraceEntry] = None
-    for entry in trace.entries:
-        if candidate is None:
-            if len(entry.async_deltas) <= 0:
-                pass  # There was no candidate, there still is none
-            else:
-                candidate = entry
-        elif len(entry.async_deltas) > len(candidate.async_deltas):
-            candidate = entry
-
-    if candidate is None:
-        return None
-
-    # Then find the first entry that has the same range as this entry.
-    reg_addresses = [x.address for x in candidate.async_deltas]
-    lb = min(reg_addresses)
-    ub = max(reg_addresses)
+def static_find_dma_incidence_indices(trace: ExecutionTrace) -> List[int]:
+    """
+    The first incidence of DMA in every region of memory that DMA wrote to, see DmaSummary.regions.
+
+    :return: Step indices, the incidence with the largest step first, then by decreasing size of the largest step.
+    """
+    dma_summary = summarize_trace(trace)
+    return find_dma_incidence_indices(
+        dma_summary.regions, dma_summary.delta_count, dma_summary.bounds, lambda x: trace.entries[x].async_deltas
+    )
+
+
+def find_dma_incidence_indices(regions: List[DmaRegion], delta_count: Callable[[int], int],
+                               bounds: Callable[[int], Tuple[int, int]],
+                               async_deltas: Callable[[int], DeltaList]) -> List[int]:
+    """
+    See static_find_dma_incidence_indices, for traces that are not in memory.
+
+    :param delta_count: Number of asynchronous deltas of a step.
+    :param bounds: Lowest changed address of a step and one past the highest, see DmaSummary.bounds.
+    :param async_deltas: The asynchronous deltas of a step, only bounds() and overlaps() are used.
+    """
+    incidences = []
+    for region in regions:
+        # First find the largest entry.
+        candidate: Optional[int] = None
+        for step in region.steps:
+            if candidate is None or delta_count(step) > delta_count(candidate):
+                candidate = step
+        incidences.append((candidate, _find_first_of(region.steps, candidate, bounds, async_deltas)))
+
+    # Of equally large steps the earliest one comes first, like a scan over the whole trace would find it.
+    incidences.sort(key=lambda x: (-delta_count(x[0]), x[0]))
+    return [x for _, x in incidences]
+
+
+def _find_first_of(dma_steps: List[int], candidate: int, bounds: Callable[[int], Tuple[int, int]],
+                   async_deltas: Callable[[int], DeltaList]) -> int:
+    """ Find the first entry that has the same range as the candidate, of the sorted steps with DMA. """
+    lb, ub = bounds(candidate)
+    ub -= 1
 
     rough_size = ub - lb
 
-    candidate_index = trace.entries.index(candidate)
-    for entry_index in range(candidate_index - 1, 0 - 1, -1):
-        entry = trace.entries[entry_index]
-        if has_value_between([x.address for x in entry.async_deltas], lb, ub):
-            reg_addresses = [x.address for x in entry.async_deltas]
-            new_lb = min(reg_addresses)
-            new_ub = max(reg_addresses)
+    # Only steps with DMA can overlap the range.
+    for step in reversed(dma_steps[:bisect_left(dma_steps, candidate)]):
+        new_lb, new_ub = bounds(step)
+        new_ub -= 1
+        # The bounds rule out most steps before the deltas themselves have to be checked.
+        if new_lb <= ub and lb <= new_ub and async_deltas(step).overlaps(lb, ub + 1):
             if new_ub - new_lb < rough_size / 2:
                 # The new entry is so much smaller it may be a smaller instance of DMA inside of the old range, ignore.
                 continue
             else:
                 # The new entry is a bit smaller, but within limits, so this is an earlier instance of that entry.
-                candidate = entry
+                candidate = step
                 lb = min(lb, new_lb)
                 ub = max(ub, new_ub)
     return candidate
 
 
+def static_find_first_dma_incidence_index(trace: ExecutionTrace) -> Optional[int]:
+    """ The first incidence of the largest DMA. """
+    incidences = static_find_dma_incidence_indices(trace)
+    return incidences[0] if len(incidences) > 0 else None
+
+
+def static_find_first_dma_incidence(trace: ExecutionTrace) -> Optional[TraceEntry]:
+    index = static_find_first_dma_incidence_index(trace)
+    return None if index is None else trace.entries[index]
+
+
 class ClusteringAnalyzer:
 
-    def __init__(self, execution_trace: ExecutionTrace, ram_base: int, work_dir: str = "."):
-        self.execution_trace = execution_trace
+    def __init__(self, execution_trace: Union[ExecutionTrace, TraceReference], ram_base: int, work_dir: str = "."):
+        """ :param execution_trace: The trace, or a reference to it so the DMA info refers to the stored trace. """
+        self.dma_info = DmaInfo(execution_trace)
+        self.execution_trace = self.dma_info.execution_trace
+        self.trace_index = index_trace(self.execution_trace)
         self.ram_base = ram_base
         self.work_dir = work_dir
-        self.dma_info = DmaInfo(execution_trace)
-
-    def start(self, epsilon: float):
-        number_of_entries = len(self.execution_trace.entries)
+        # Validation of the stored DMA infos, see Storable.to_file.
+        self.store_validation = None
+        self.__sorted_addresses = None
+
+    @property
+    def entry_count(self) -> int:
+        return len(self.execution_trace.entries)
+
+    def async_deltas(self, index: int) -> DeltaList:
+        return self.execution_trace.entries[index].async_deltas
+
+    def sorted_addresses(self) -> SortedAddresses:
+        """ The accessed addresses, sorted once for all clusterings. """
+        if self.__sorted_addresses is None:
+            self.__sorted_addresses = SortedAddresses(self.trace_index.addresses)
+        return self.__sorted_addresses
+
+    def find_incidences(self) -> List[int]:
+        """ See static_find_dma_incidence_indices. """
+        return static_find_dma_incidence_indices(self.execution_trace)
+
+    def prepare_candidates(self, incidences: List[int]):
+        """ Called with the incidences before their candidates are searched, the trace index has every value. """
+        pass
+
+    def start(self, epsilon: Optional[float]):
+        """ :param epsilon: Largest distance between registers of one peripheral, None to use suggest_epsilon. """
+        number_of_entries = self.entry_count
+        if epsilon is None:
+            epsilon = suggest_epsilon(self.sorted_addresses().values)
+            if epsilon is None:
+                raise Exception("Unable to suggest an epsilon, too few different addresses were accessed.")
+            print("Suggested epsilon: 0x%X" % epsilon)
         print("Analysis over %d entries (e = %.4d)" % (number_of_entries, epsilon))
 
         peripherals = self.cluster_peripherals(epsilon)
@@ -78,84 +152,103 @@ class ClusteringAnalyzer:
 
         self.store_peripherals(peripherals)
 
-        # The instruction with the first incidence of the largest incidence
-        triggering_instruction = self.find_dma_incidence()
-        if triggering_instruction is None:
+        # The first incidence of every region DMA wrote to, the one with the largest step first.
+        incidences = self.find_incidences()
+        if len(incidences) == 0:
             self.fail_no_dma()
             return
 
-        triggering_instruction_index = self.execution_trace.entries.index(triggering_instruction)
-        self.dma_info.index_of_first_incidence = triggering_instruction_index
-        self.dma_info.indices_of_trigger_instructions = [triggering_instruction_index]
+        self.prepare_candidates(incidences)
+        self.analyze_incidence(self.dma_info, incidences[0])
 
-        list_of_deltas = triggering_instruction.async_deltas
-        list_of_delta_addresses = [x.address for x in list_of_deltas]
+        out_path = os.path.join(self.work_dir, naming_things.DMA_INFO_JSON)
+        DmaInfo.to_file(out_path, self.dma_info, validation=self.store_validation)
 
-        lb = min(list_of_delta_addresses)
-        ub = max(list_of_delta_addresses)
+        out_path = os.path.join(self.work_dir, naming_things.DMA_INFO_HR_JSON)
+        DmaInfo.to_file(out_path, self.dma_info, max_depth=DmaInfo.MAX_DEPTH_HR, validation=self.store_validation)
+        # with open(out_path, mode='w') as json_file:
+        #     json.dump({
+        #         "start_instruction": TraceEntry.to_dict(triggering_instruction),
+        #         "set_addr_instruction": TraceEntry.to_dict(set_base_candidates[-1]),
+        #         "set_addr_alternatives": [TraceEntry.to_dict(x) for x in set_base_candidates],
+        #         "set_size_instruction": TraceEntry.to_dict(set_size_candidates[-1]),
+        #         "set_size_alternatives": [TraceEntry.to_dict(x) for x in set_size_candidates],
+        #         "dma_region_start": dma_region_base,
+        #         "dma_region_size": dma_region_size,
+        #     }, json_file, indent=4, sort_keys=True)
 
-        # Look up to n instructions ahead and expand the range to catch more slow moving DMA traffic.
-        for i in range(10):
-            next_instruction_index = triggering_instruction_index + 1
-            if next_instruction_index >= len(self.execution_trace.entries):
-                break
-            next_instruction = self.execution_trace.entries[next_instruction_index]
-
-            overlap = False
-            next_instruction_delta_addresses = []
-            for delta in next_instruction.async_deltas:
-                address = delta.address
-                next_instruction_delta_addresses.append(address)
-                if lb <= address <= ub:
-                    overlap = True
-
-            if overlap:
-                list_of_delta_addresses += next_instruction_delta_addresses
-            else:
-                break
+        self.store_incidences(incidences)
 
-            lb = min(list_of_delta_addresses)
-            ub = max(list_of_delta_addresses)
+    def analyze_incidence(self, dma_info: DmaInfo, triggering_instruction_index: int):
+        """ Fill in the region and the candidates of one incidence of DMA, starting at the given step. """
+        dma_info.index_of_first_incidence = triggering_instruction_index
+        dma_info.indices_of_trigger_instructions = [triggering_instruction_index]
+
+        lb, ub = self.incidence_bounds(triggering_instruction_index)
 
         first_diff_address = lb
-        self.dma_info.dma_region_base = first_diff_address
+        dma_info.dma_region_base = first_diff_address
 
-        set_base_candidates, set_base_indices = self.find_set_base_candidates(first_diff_address,
-                                                                              triggering_instruction_index)
+        set_base_candidates = self.find_set_base_candidates(first_diff_address, triggering_instruction_index)
         if len(set_base_candidates) == 0:
             raise Exception("Unable to find instruction responsible for the base.")
-        else:
-            self.dma_info.indices_of_set_base_instructions = set_base_indices
 
-        if set_base_candidates[0].value != first_diff_address:
-            self.dma_info.dma_region_base = set_base_candidates[0].value
+        dma_info.indices_of_set_base_instructions = [x.index for x in set_base_candidates]
+        dma_info.derivations_of_set_base_instructions = [x.derivation for x in set_base_candidates]
 
         last_diff_address = ub
 
         dma_region_size = 1 + (last_diff_address - first_diff_address)
-        self.dma_info.dma_region_size = dma_region_size
-        set_size_candidates, set_size_indices = self.find_set_size_instruction(dma_region_size,
-                                                                               triggering_instruction_index)
+        dma_info.dma_region_size = dma_region_size
+        set_size_candidates = self.find_set_size_instruction(dma_region_size, triggering_instruction_index)
         if len(set_size_candidates) == 0:
             raise Exception("Unable to find instruction responsible for the size.")
-        else:
-            self.dma_info.indices_of_set_size_instructions = set_size_indices
+        dma_info.indices_of_set_size_instructions = [x.index for x in set_size_candidates]
+        dma_info.derivations_of_set_size_instructions = [x.derivation for x in set_size_candidates]
 
-        out_path = os.path.join(self.work_dir, naming_things.DMA_INFO_JSON)
-        DmaInfo.to_file(out_path, self.dma_info)
+    def incidence_bounds(self, triggering_instruction_index: int) -> Tuple[int, int]:
+        """ The lowest and the highest address (inclusive) written by an incidence of DMA. """
+        lb, ub = self.async_deltas(triggering_instruction_index).bounds()
+        ub -= 1
 
-        out_path = os.path.join(self.work_dir, naming_things.DMA_INFO_HR_JSON)
-        DmaInfo.to_file(out_path, self.dma_info, max_depth=DmaInfo.MAX_DEPTH_HR)
-        # with open(out_path, mode='w') as json_file:
-        #     json.dump({
-        #         "start_instruction": TraceEntry.to_dict(triggering_instruction),
-        #         "set_addr_instruction": TraceEntry.to_dict(set_base_candidates[-1]),
-        #         "set_addr_alternatives": [TraceEntry.to_dict(x) for x in set_base_candidates],
-        #         "set_size_instruction": TraceEntry.to_dict(set_size_candidates[-1]),
-        #         "set_size_alternatives": [TraceEntry.to_dict(x) for x in set_size_candidates],
-        #         "dma_region_start": dma_region_base,
-        #         "dma_region_size": dma_region_size,
-        #     }, json_file, indent=4, sort_keys=True)
+        # Look up to n instructions ahead and expand the range to catch more slow moving DMA traffic.
+        for i in range(10):
+            next_instruction_index = triggering_instruction_index + 1
+            if next_instruction_index >= self.entry_count:
+                break
+            next_deltas = self.async_deltas(next_instruction_index)
+
+            if next_deltas.overlaps(lb, ub + 1):
+                next_lb, next_ub = next_deltas.bounds()
+                lb = min(lb, next_lb)
+                ub = max(ub, next_ub - 1)
+            else:
+                break
+        return lb, ub
+
+    def store_incidences(self, incidences: List[int]):
+        """
+        Store every incidence as its own DmaInfo numbered from 0, so phase 06 can verify each of them. Number 0 is the
+        incidence that is also stored as DMA_INFO_JSON, incidences without base or size candidates are skipped.
+        """
+        number = 0
+        for index in incidences:
+            if index == self.dma_info.index_of_first_incidence:
+                dma_info = self.dma_info
+            else:
+                dma_info = DmaInfo(self.dma_info.trace_reference)
+                try:
+                    self.analyze_incidence(dma_info, index)
+                except Exception as err:
+                    print("Skipping DMA incidence at step %d: %s" % (index, err))
+                    continue
+
+            print("DMA incidence %d at step %d: %d bytes from 0x%08X" % (
+                number, index, dma_info.dma_region_size, dma_info.dma_region_base
+            ))
+            out_path = os.path.join(self.work_dir, naming_things.create_dma_incidence_name(number))
+            number += 1
+            DmaInfo.to_file(out_path, dma_info, validation=self.store_validation)
 
     def fail_no_dma(self):
         print("\n")
@@ -164,7 +257,7 @@ class ClusteringAnalyzer:
 
         out_path = os.path.join(self.work_dir, naming_things.DMA_INFO_JSON)
 
-        DmaInfo.to_file(out_path, self.dma_info)
+        DmaInfo.to_file(out_path, self.dma_info, validation=self.store_validation)
         #
         # with open(out_path, mode='w') as json_file:
         #     json.dump({
@@ -175,26 +268,45 @@ class ClusteringAnalyzer:
         #         "dma_region_size": None,
         #     }, json_file, indent=4, sort_keys=True)
 
-    def cluster_peripherals(self, epsilon: float):
-        from numpy import reshape, unique, where
-        from sklearn.cluster import DBSCAN
+    def sweep_epsilon(self, epsilons: Iterable[int], workers: Optional[int] = None) -> int:
+        """
+        Cluster for every epsilon, write a report of the peripherals found per epsilon and pick the most stable one.
+
+        :param workers: Number of threads, None for the default.
+        """
+        results = sweep_epsilons(self.sorted_addresses(), epsilons, min_samples=2, workers=workers)
+        selected = most_stable(results)
+        if selected is None:
+            raise Exception("Unable to sweep over an empty epsilon range.")
+
+        out_path = os.path.join(self.work_dir, naming_things.EPSILON_SWEEP_CSV)
+        with open(out_path, mode='w', newline='') as csv_file:
+            writer = csv.writer(csv_file, delimiter=',', quotechar='"')
+            writer.writerow([
+                'epsilon', 'clusters', 'unclustered', 'boundary_changes', 'stable_for', 'stability', 'selected'
+            ])
+            for result in results:
+                writer.writerow([
+                    '0x%X' % result.epsilon, result.cluster_count, result.noise_count, result.boundary_changes,
+                    result.stable_for, '%.3f' % result.stability, int(result is selected),
+                ])
+
+        print("Swept %d epsilons, selected %s" % (len(results), selected))
+        return selected.epsilon
 
+    def cluster_peripherals(self, epsilon: float):
         peripherals: PeripheralRow = PeripheralRow()
 
-        addresses = [x.address for x in self.execution_trace.entries]
-        big_x = reshape(addresses, (-1, 1))
-        model = DBSCAN(min_samples=2, eps=epsilon)
-        y_hat = model.fit_predict(big_x)
-        cluster_names = unique(y_hat)
-
-        for cluster_name in cluster_names:
-            row_ix = where(y_hat == cluster_name)
+        sorted_addresses = self.sorted_addresses()
+        y_hat = sorted_addresses.cluster_values(epsilon, min_samples=2)
 
-            cluster_addresses_matrix = big_x[row_ix, 0]
-            cluster_addresses = cluster_addresses_matrix[0]
-            registers = unique(sorted(cluster_addresses))
+        # The different registers of every cluster, sorted by cluster and address.
+        by_cluster = numpy.argsort(y_hat, kind='stable')
+        cluster_names, cluster_starts = numpy.unique(y_hat[by_cluster], return_index=True)
+        cluster_registers = numpy.split(sorted_addresses.values[by_cluster], cluster_starts[1:])
 
-            if cluster_name == -1:
+        for cluster_name, registers in zip(cluster_names, cluster_registers):
+            if cluster_name == NOISE:
                 # This is a list of all non-clustered registers.
                 for register in registers:
                     peripheral: Peripheral = Peripheral(int(register), int(1))
@@ -203,16 +315,7 @@ class ClusteringAnalyzer:
 
             else:
                 # This is a regular cluster of registers
-                lo_reg = registers[0]
-                hi_reg = registers[-1]
-                peripheral_size = hi_reg - lo_reg
-                peripheral_p2_sz = 1 << int(peripheral_size - 1).bit_length()
-                peripheral_start = (lo_reg // peripheral_p2_sz) * peripheral_p2_sz
-
-                if not isinstance(peripheral_start, int):
-                    peripheral_start = int(peripheral_start)
-                if not isinstance(peripheral_p2_sz, int):
-                    peripheral_p2_sz = int(peripheral_p2_sz)
+                peripheral_start, peripheral_p2_sz = peripheral_bounds(int(registers[0]), int(registers[-1]))
                 peripheral: Peripheral = Peripheral(peripheral_start, peripheral_p2_sz)
                 for reg in registers:
                     peripheral.append_register(reg)
@@ -231,61 +334,22 @@ class ClusteringAnalyzer:
         entry: TraceEntry
         return static_find_first_dma_incidence(trace)
 
-    def find_set_base_candidates(self, dma_region_base: int, index_limit: int) -> Tuple[List[TraceEntry], List[int]]:
-        entry: TraceEntry
-
-        hard_matches: List[TraceEntry] = []
-        hard_match_indices: List[int] = []
-
-        soft_matches: List[TraceEntry] = []
-        soft_match_indices: List[int] = []
-
-        for i in range(len(self.execution_trace.entries)):
-            # Only instructions before the initial occurrence of DMA can affect it
-            if i > index_limit:
-                break
-
-            entry: TraceEntry = self.execution_trace.entries[i]
-
-            # TODO proxied locations
-            if entry.value == dma_region_base:
-                hard_matches.append(entry)
-                hard_match_indices.append(i)
-            elif abs(entry.value - dma_region_base) <= 2:
-                soft_matches.append(entry)
-                soft_match_indices.append(i)
-
-        if len(hard_matches) > 0:
-            return hard_matches, hard_match_indices
-        elif len(soft_matches) > 0:
-            return soft_matches, soft_match_indices
-        else:
-            return [], []
-
-    def find_set_size_instruction(self, dma_region_size: int, index_limit: int) -> Tuple[List[TraceEntry], List[int]]:
-        size_candidates = [
-            dma_region_size,  # Actual size
-            dma_region_size // 2,  # Divide by 2.
-            dma_region_size // 4,  # Divide by 4
-            (dma_region_size + 1) // 2,  # Round up to the nearest multiple of 2, divide by 2.
-            (dma_region_size + 3) // 4,  # Round up to the nearest multiple of 4, divide by 4
-        ]
-        size_candidates = [x for x in size_candidates if x > 0]
-
-        entry: TraceEntry
-        hard_matches: List[TraceEntry] = []
-        hard_match_indices: List[int] = []
-        for i in range(len(self.execution_trace.entries)):
-            # Only instruction before the start of DMA can affect the DMA operation
-            if i > index_limit:
-                break
-
-            entry: TraceEntry = self.execution_trace.entries[i]
-
-            # TODO soft(er) match heuristics
-            # TODO proxied values
-            if entry.value in size_candidates:
-                hard_matches.append(entry)
-                hard_match_indices.append(i)
-
-        return hard_matches, hard_match_indices
+    def find_set_base_candidates(self, dma_region_base: int, index_limit: int) -> List[Candidate]:
+        """ Candidates ranked from most to least likely, see candidate_search.find_candidates. """
+        # Only instructions before the initial occurrence of DMA can affect it
+        candidates = find_candidates(self.trace_index, base_targets(dma_region_base), end=index_limit)
+        self.print_candidates("base", candidates)
+        return candidates
+
+    def find_set_size_instruction(self, dma_region_size: int, index_limit: int) -> List[Candidate]:
+        """ Candidates ranked from most to least likely, see candidate_search.find_candidates. """
+        # Only instruction before the start of DMA can affect the DMA operation
+        candidates = find_candidates(self.trace_index, size_targets(dma_region_size), end=index_limit)
+        self.print_candidates("size", candidates)
+        return candidates
+
+    @staticmethod
+    def print_candidates(what: str, candidates: List[Candidate]):
+        print("%d set %s candidates" % (len(candidates), what))
+        for candidate in candidates[:8]:
+            print("\t%s" % candidate)
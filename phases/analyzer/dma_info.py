@@ -1,23 +1,32 @@
-from typing import List
+from typing import List, Dict, Any, Union, Optional
 
-from phases.recorder import ExecutionTrace, TraceEntry
+from phases.analyzer.candidate_search import derivation_of, base_targets, size_targets, RANKS, Targets
+from phases.recorder import ExecutionTrace, TraceEntry, TraceReference
 from utilities import Storable
+from utilities.storable import DEFAULT_SAMPLE_SIZE
 
 
 class DmaInfo(Storable):
     MAX_DEPTH_HR = 3
-    execution_trace: ExecutionTrace
+    SCHEMA_VERSION = 4
+
+    trace_reference: TraceReference
 
     index_of_first_incidence: int
 
     indices_of_trigger_instructions: List[int]
+    # Ranked from most to least likely since version 3, in trace order before.
     indices_of_set_base_instructions: List[int]
     indices_of_set_size_instructions: List[int]
+    # How the value written at each of those steps gives the base or size, see candidate_search. Since version 4.
+    derivations_of_set_base_instructions: List[str]
+    derivations_of_set_size_instructions: List[str]
 
     dma_region_base: int
     dma_region_size: int
 
-    def __init__(self, execution_trace: ExecutionTrace):
+    def __init__(self, execution_trace: Union[ExecutionTrace, TraceReference]):
+        """ :param execution_trace: The trace, or a reference to a stored trace which is stored as the reference. """
         self.execution_trace = execution_trace
 
         self.index_of_first_incidence = -1
@@ -25,13 +34,41 @@ class DmaInfo(Storable):
         self.indices_of_trigger_instructions = []
         self.indices_of_set_base_instructions = []
         self.indices_of_set_size_instructions = []
+        self.derivations_of_set_base_instructions = []
+        self.derivations_of_set_size_instructions = []
 
         self.dma_region_base = -1
         self.dma_region_size = -1
 
+    @property
+    def execution_trace(self) -> ExecutionTrace:
+        return self.trace_reference.trace
+
+    @execution_trace.setter
+    def execution_trace(self, execution_trace: Union[ExecutionTrace, TraceReference]):
+        if isinstance(execution_trace, TraceReference):
+            self.trace_reference = execution_trace
+        else:
+            self.trace_reference = TraceReference.of_trace(execution_trace)
+
+    def upgrade_decoded(self):
+        # Files without a header predate version 3, their candidates are in trace order like in from_record.
+        self.indices_of_set_base_instructions.reverse()
+        self.indices_of_set_size_instructions.reverse()
+        if not hasattr(self, 'derivations_of_set_base_instructions'):
+            self.derivations_of_set_base_instructions = []
+        if not hasattr(self, 'derivations_of_set_size_instructions'):
+            self.derivations_of_set_size_instructions = []
+
     # noinspection DuplicatedCode
     def is_sane(self) -> bool:
-        if not self.execution_trace.is_sane():
+        return self.execution_trace.is_sane() and self.__fields_are_sane()
+
+    def is_sane_sampled(self, sample_size: int = DEFAULT_SAMPLE_SIZE) -> bool:
+        return self.execution_trace.is_sane_sampled(sample_size) and self.__fields_are_sane()
+
+    def __fields_are_sane(self) -> bool:
+        if not isinstance(self.trace_reference, TraceReference) or not self.trace_reference.is_sane():
             return False
 
         if not isinstance(self.index_of_first_incidence, int):
@@ -51,7 +88,8 @@ class DmaInfo(Storable):
             if not isinstance(x, int):
                 return False
             if self.dma_region_base != -1:
-                if self.execution_trace.entries[x].value != self.dma_region_base:
+                value = self.execution_trace.entries[x].value
+                if derivation_of(value, base_targets(self.dma_region_base)) is None:
                     print("Mismatch in trace-entry value and actual base address.")
                     return False
 
@@ -59,6 +97,19 @@ class DmaInfo(Storable):
             if not isinstance(x, int):
                 return False
 
+        for indices, derivations in [
+            (self.indices_of_set_base_instructions, self.derivations_of_set_base_instructions),
+            (self.indices_of_set_size_instructions, self.derivations_of_set_size_instructions),
+        ]:
+            if not isinstance(derivations, list):
+                return False
+            # Empty for DMA infos from before version 4.
+            if len(derivations) != 0 and len(derivations) != len(indices):
+                return False
+            for x in derivations:
+                if x not in RANKS:
+                    return False
+
         if not isinstance(self.dma_region_base, int) or self.dma_region_base < -1:
             return False
         if not isinstance(self.dma_region_size, int) or self.dma_region_size < -1:
@@ -66,6 +117,40 @@ class DmaInfo(Storable):
 
         return True
 
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            'trace': self.trace_reference.to_record(),
+            'index_of_first_incidence': self.index_of_first_incidence,
+            'indices_of_trigger_instructions': self.indices_of_trigger_instructions,
+            'indices_of_set_base_instructions': self.indices_of_set_base_instructions,
+            'indices_of_set_size_instructions': self.indices_of_set_size_instructions,
+            'derivations_of_set_base_instructions': self.derivations_of_set_base_instructions,
+            'derivations_of_set_size_instructions': self.derivations_of_set_size_instructions,
+            'dma_region_base': self.dma_region_base,
+            'dma_region_size': self.dma_region_size,
+        }
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any], version: int) -> 'DmaInfo':
+        if version < 2:
+            dma_info = DmaInfo(ExecutionTrace.from_record(record['execution_trace'], ExecutionTrace.SCHEMA_VERSION))
+        else:
+            dma_info = DmaInfo(TraceReference.from_record(record['trace']))
+        dma_info.index_of_first_incidence = record['index_of_first_incidence']
+        dma_info.indices_of_trigger_instructions = record['indices_of_trigger_instructions']
+        dma_info.indices_of_set_base_instructions = record['indices_of_set_base_instructions']
+        dma_info.indices_of_set_size_instructions = record['indices_of_set_size_instructions']
+        if version < 3:
+            # The latest candidates were the most likely ones.
+            dma_info.indices_of_set_base_instructions.reverse()
+            dma_info.indices_of_set_size_instructions.reverse()
+        if version >= 4:
+            dma_info.derivations_of_set_base_instructions = record['derivations_of_set_base_instructions']
+            dma_info.derivations_of_set_size_instructions = record['derivations_of_set_size_instructions']
+        dma_info.dma_region_base = record['dma_region_base']
+        dma_info.dma_region_size = record['dma_region_size']
+        return dma_info
+
     @property
     def entry_of_first_incidence(self) -> TraceEntry:
         return self.execution_trace.entries[self.index_of_first_incidence]
@@ -81,3 +166,18 @@ class DmaInfo(Storable):
     @property
     def entries_of_set_base_instructions(self) -> List[TraceEntry]:
         return [self.execution_trace.entries[x] for x in self.indices_of_set_base_instructions]
+
+    def derivation_of_set_base_instruction(self, index: int) -> Optional[str]:
+        """ How the value written at a base candidate gives the base, worked out again for DMA infos without it. """
+        return self.__derivation(index, self.indices_of_set_base_instructions,
+                                 self.derivations_of_set_base_instructions, base_targets(self.dma_region_base))
+
+    def derivation_of_set_size_instruction(self, index: int) -> Optional[str]:
+        """ How the value written at a size candidate gives the size, worked out again for DMA infos without it. """
+        return self.__derivation(index, self.indices_of_set_size_instructions,
+                                 self.derivations_of_set_size_instructions, size_targets(self.dma_region_size))
+
+    def __derivation(self, index: int, indices: List[int], derivations: List[str], targets: Targets) -> Optional[str]:
+        if index in indices and len(derivations) == len(indices):
+            return derivations[indices.index(index)]
+        return derivation_of(self.execution_trace.entries[index].value, targets)
@@ -0,0 +1,238 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence, Optional, List, Tuple, Iterable, Union
+
+import numpy
+
+NOISE = -1
+
+
+class SortedAddresses:
+    """
+    The different accessed addresses sorted once, so clusterings with different epsilons share the sort.
+
+    DBSCAN over one dimensional data only needs the sorted data: the neighbourhood of a point is a range of the sorted
+    data. A point is a core point when at least min_samples points (itself and duplicates included) are within eps,
+    core points that are at most eps apart form a cluster, and the other points within eps of a core point are border
+    points of that cluster. Duplicates always end up in the same cluster, so only the different addresses and how
+    often they were accessed are clustered. The arrays are only read, so one instance can be used from several threads.
+    """
+    # The different addresses, sorted.
+    values: numpy.ndarray
+    # Number of accesses up to, but not including, every value. One longer than values.
+    cumulative_counts: numpy.ndarray
+    # Position of the first access to every value in the input.
+    first_access: numpy.ndarray
+    # The value of every input address, as an index into values. None when made from_counts.
+    inverse: Optional[numpy.ndarray]
+
+    def __init__(self, addresses: Sequence[int]):
+        addresses = numpy.asarray(addresses, dtype=numpy.int64)
+        self.values, first_access, self.inverse, counts = numpy.unique(
+            addresses, return_index=True, return_inverse=True, return_counts=True
+        )
+        self.first_access = first_access.astype(numpy.int64)
+        self.inverse = self.inverse.reshape(-1)
+        self.cumulative_counts = numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.int64)
+
+    @classmethod
+    def from_counts(cls, values: Sequence[int], counts: Sequence[int],
+                    first_access: Sequence[int]) -> 'SortedAddresses':
+        """ From the different addresses, how often and where first they were accessed, when the input is gone. """
+        sorted_addresses = cls([])
+        order = numpy.argsort(numpy.asarray(values, dtype=numpy.int64), kind='stable')
+        sorted_addresses.values = numpy.asarray(values, dtype=numpy.int64)[order]
+        sorted_addresses.first_access = numpy.asarray(first_access, dtype=numpy.int64)[order]
+        sorted_addresses.cumulative_counts = numpy.concatenate(
+            ([0], numpy.cumsum(numpy.asarray(counts, dtype=numpy.int64)[order]))
+        ).astype(numpy.int64)
+        sorted_addresses.inverse = None
+        return sorted_addresses
+
+    def __len__(self):
+        return int(self.cumulative_counts[-1])
+
+    def cluster_values(self, eps: float, min_samples: int = 2) -> numpy.ndarray:
+        """
+        Clusters of the different addresses, numbered in the order their first core point appears in the input. A
+        border point between two clusters belongs to the lower numbered one, like sklearn's expansion order does.
+
+        :return: The cluster of every value, NOISE for values that are in no cluster.
+        """
+        values = self.values
+        value_labels = numpy.full(len(values), NOISE, dtype=numpy.int64)
+        if len(values) == 0:
+            return value_labels
+
+        # Number of accesses within eps of every value.
+        first = numpy.searchsorted(values, values - eps, side='left')
+        last = numpy.searchsorted(values, values + eps, side='right')
+        is_core = (self.cumulative_counts[last] - self.cumulative_counts[first]) >= min_samples
+        if not numpy.any(is_core):
+            return value_labels
+
+        # Consecutive core points that are at most eps apart are in the same cluster.
+        core_values = values[is_core]
+        core_group = numpy.concatenate(([0], numpy.cumsum(numpy.diff(core_values) > eps)))
+
+        # Clusters are numbered by the first appearance of one of their core points in the input.
+        group_count = int(core_group[-1]) + 1
+        first_appearance = numpy.full(group_count, len(self), dtype=numpy.int64)
+        numpy.minimum.at(first_appearance, core_group, self.first_access[is_core])
+        group_label = numpy.empty(group_count, dtype=numpy.int64)
+        group_label[numpy.argsort(first_appearance, kind='stable')] = numpy.arange(group_count)
+
+        value_labels[is_core] = group_label[core_group]
+
+        # Border points take the lowest label of the nearest core point on either side that is within eps.
+        border = numpy.flatnonzero(~is_core)
+        border_values = values[border]
+        left = numpy.searchsorted(core_values, border_values, side='right') - 1
+        right = left + 1
+
+        has_left = left >= 0
+        left_label = numpy.full(len(border), NOISE, dtype=numpy.int64)
+        left_close = has_left.copy()
+        left_close[has_left] = border_values[has_left] - core_values[left[has_left]] <= eps
+        left_label[left_close] = group_label[core_group[left[left_close]]]
+
+        has_right = right < len(core_values)
+        right_label = numpy.full(len(border), NOISE, dtype=numpy.int64)
+        right_close = has_right.copy()
+        right_close[has_right] = core_values[right[has_right]] - border_values[has_right] <= eps
+        right_label[right_close] = group_label[core_group[right[right_close]]]
+
+        both = left_close & right_close
+        border_labels = numpy.where(left_close, left_label, right_label)
+        border_labels[both] = numpy.minimum(left_label[both], right_label[both])
+        value_labels[border] = border_labels
+        return value_labels
+
+    def cluster(self, eps: float, min_samples: int = 2) -> numpy.ndarray:
+        """ :return: The cluster of every address in input order, NOISE for addresses that are in no cluster. """
+        return self.cluster_values(eps, min_samples)[self.inverse]
+
+    def peripheral_bounds(self, value_labels: numpy.ndarray) -> List[Tuple[int, int]]:
+        """ (start, size) of the peripheral of every cluster of cluster_values, sorted by start. """
+        clustered = value_labels != NOISE
+        if not numpy.any(clustered):
+            return []
+        # Clusters are ranges of the sorted values.
+        values = self.values[clustered]
+        labels = value_labels[clustered]
+        starts = numpy.flatnonzero(numpy.concatenate(([True], labels[1:] != labels[:-1])))
+        ends = numpy.concatenate((starts[1:], [len(labels)])) - 1
+        return sorted(peripheral_bounds(x, y) for x, y in zip(values[starts].tolist(), values[ends].tolist()))
+
+
+def cluster_addresses(addresses: Sequence[int], eps: float, min_samples: int = 2) -> numpy.ndarray:
+    """
+    DBSCAN over one dimensional data, gives the same labels as sklearn's DBSCAN(eps, min_samples).fit_predict.
+
+    :return: The cluster of every address, NOISE for addresses that are in no cluster.
+    """
+    return SortedAddresses(addresses).cluster(eps, min_samples)
+
+
+def peripheral_bounds(lo_reg: int, hi_reg: int) -> Tuple[int, int]:
+    """ (start, size) of a peripheral from its lowest and highest register, the size is a power of two. """
+    peripheral_size = hi_reg - lo_reg
+    peripheral_p2_sz = 1 << int(peripheral_size - 1).bit_length()
+    peripheral_start = (lo_reg // peripheral_p2_sz) * peripheral_p2_sz
+    return int(peripheral_start), int(peripheral_p2_sz)
+
+
+def suggest_epsilon(addresses: Sequence[int]) -> Optional[int]:
+    """
+    Suggest an epsilon from the gaps between the accessed addresses.
+
+    Registers of one peripheral are close together and peripherals are far apart, so the sorted gaps make a jump
+    somewhere. This returns the gap before the largest relative jump, which keeps the registers of a peripheral
+    together and the peripherals apart. None when there are fewer than two different gaps.
+    """
+    gaps = numpy.unique(numpy.diff(numpy.unique(numpy.asarray(addresses, dtype=numpy.int64))))
+    if len(gaps) < 2:
+        return None
+    jumps = gaps[1:] / gaps[:-1]
+    return int(gaps[int(numpy.argmax(jumps))])
+
+
+class EpsilonResult:
+    """ The clustering for one epsilon of a sweep, and how many epsilons of the sweep give the same peripherals. """
+    epsilon: int
+    cluster_count: int
+    noise_count: int
+    boundaries: List[Tuple[int, int]]
+    # Peripherals that were not found with the previous epsilon of the sweep, or no longer are.
+    boundary_changes: int
+    # Number of consecutive epsilons of the sweep, this one included, that give the same peripherals.
+    stable_for: int
+    # Largest divided by smallest epsilon of those. Gaps between registers and peripherals grow geometrically, so a
+    # ratio does not favour large epsilons like stable_for does on an evenly spaced sweep.
+    stability: float
+
+    def __init__(self, epsilon: int, cluster_count: int, noise_count: int, boundaries: List[Tuple[int, int]]):
+        self.epsilon = epsilon
+        self.cluster_count = cluster_count
+        self.noise_count = noise_count
+        self.boundaries = boundaries
+        self.boundary_changes = 0
+        self.stable_for = 1
+        self.stability = 1.0
+
+    def __repr__(self):
+        return 'Epsilon 0x%X: %d clusters, %d unclustered registers, stable for %d epsilons (x%.2f)' % (
+            self.epsilon, self.cluster_count, self.noise_count, self.stable_for, self.stability
+        )
+
+
+def sweep_epsilons(addresses: Union[Sequence[int], 'SortedAddresses'], epsilons: Iterable[int], min_samples: int = 2,
+                   workers: Optional[int] = None) -> List[EpsilonResult]:
+    """
+    Cluster the addresses for every epsilon, in a thread pool over one shared sort of the addresses.
+
+    :param workers: Number of threads, None for the ThreadPoolExecutor default.
+    :return: A result per epsilon, sorted by epsilon.
+    """
+    sorted_addresses = addresses if isinstance(addresses, SortedAddresses) else SortedAddresses(addresses)
+
+    def evaluate(eps: int) -> EpsilonResult:
+        value_labels = sorted_addresses.cluster_values(eps, min_samples)
+        boundaries = sorted_addresses.peripheral_bounds(value_labels)
+        noise_count = int(numpy.count_nonzero(value_labels == NOISE))
+        return EpsilonResult(eps, len(boundaries), noise_count, boundaries)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(evaluate, sorted(set(epsilons))))
+
+    # Walk the plateaus of equal peripherals.
+    plateau_start = 0
+    for i in range(1, len(results) + 1):
+        if i < len(results):
+            results[i].boundary_changes = len(set(results[i].boundaries) ^ set(results[i - 1].boundaries))
+            if results[i].boundary_changes == 0:
+                continue
+        for result in results[plateau_start:i]:
+            result.stable_for = i - plateau_start
+            result.stability = results[i - 1].epsilon / results[plateau_start].epsilon
+        plateau_start = i
+    return results
+
+
+def most_stable(results: List[EpsilonResult]) -> Optional[EpsilonResult]:
+    """
+    The epsilon in the geometric middle of the most stable plateau of equal peripherals.
+
+    Small epsilons leave every register unclustered and large ones put everything in one peripheral, both are stable
+    as well. Plateaus with more than one peripheral are preferred, and of equally stable ones the first is taken.
+    """
+    if len(results) == 0:
+        return None
+    candidates = [x for x in results if x.cluster_count > 1]
+    if len(candidates) == 0:
+        candidates = results
+    best = max(candidates, key=lambda x: x.stability)
+    # Results are sorted by epsilon, so the plateau starts at its first result.
+    plateau_start = results.index(best)
+    plateau = results[plateau_start:plateau_start + best.stable_for]
+    middle = (plateau[0].epsilon * plateau[-1].epsilon) ** 0.5
+    return min(plateau, key=lambda x: abs(x.epsilon - middle))
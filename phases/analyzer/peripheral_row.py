@@ -1,8 +1,9 @@
 from enum import Enum
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Any, Union
 
-from phases.recorder import ExecutionTrace
+from phases.recorder import ExecutionTrace, TraceReference
 from utilities import Storable
+from utilities.storable import DEFAULT_SAMPLE_SIZE
 
 
 class InfoFlag(Enum):
@@ -23,13 +24,16 @@ class InfoFlag(Enum):
 
 
 class Peripheral(Storable):
+    SCHEMA_VERSION = 2
+
     start: int
     size: int
 
     registers: List[int]
     exit_reasons: List[str]
 
-    __execution_trace: Optional[ExecutionTrace]
+    # Files written with jsonpickle hold the trace itself instead of a reference.
+    __execution_trace: Optional[Union[TraceReference, ExecutionTrace]]
     __flags: Dict[int, bool]
 
     def __init__(self, start: int, size: int):
@@ -48,18 +52,27 @@ class Peripheral(Storable):
     def end(self):
         return self.start + self.size
 
+    @property
+    def trace_reference(self) -> Optional[TraceReference]:
+        if isinstance(self.__execution_trace, ExecutionTrace):
+            self.__execution_trace = TraceReference.of_trace(self.__execution_trace)
+        return self.__execution_trace
+
     @property
     def execution_trace(self) -> ExecutionTrace:
-        if self.__execution_trace is None:
+        if self.trace_reference is None:
             raise Exception("Trying to access None-trace")
-        return self.__execution_trace
+        return self.trace_reference.trace
 
     @execution_trace.setter
-    def execution_trace(self, execution_trace: ExecutionTrace):
-        if self.__execution_trace is None:
+    def execution_trace(self, execution_trace: Union[ExecutionTrace, TraceReference]):
+        """ :param execution_trace: The trace, or a reference to a stored trace which is stored as the reference. """
+        if self.__execution_trace is not None:
+            raise Exception("Execution trace ws already set and should not be overwritten.")
+        if isinstance(execution_trace, TraceReference):
             self.__execution_trace = execution_trace
         else:
-            raise Exception("Execution trace ws already set and should not be overwritten.")
+            self.__execution_trace = TraceReference.of_trace(execution_trace)
 
     def append_register(self, reg: int):
         if not isinstance(reg, int):
@@ -70,6 +83,13 @@ class Peripheral(Storable):
         self.exit_reasons.append(line)
 
     def is_sane(self) -> bool:
+        return self.__is_sane(None)
+
+    def is_sane_sampled(self, sample_size: int = DEFAULT_SAMPLE_SIZE) -> bool:
+        return self.__is_sane(sample_size)
+
+    def __is_sane(self, sample_size: Optional[int]) -> bool:
+        """ :param sample_size: Only check a sample of the entries of the trace, or None to check all. """
         if not isinstance(self.start, int) or self.start < -1:
             return False
         if not isinstance(self.size, int) or self.size < -1:
@@ -91,10 +111,12 @@ class Peripheral(Storable):
             if not isinstance(x, str):
                 return False
 
-        if self.__execution_trace is not None:
-            if not isinstance(self.__execution_trace, ExecutionTrace):
+        if self.trace_reference is not None:
+            if not isinstance(self.trace_reference, TraceReference) or not self.trace_reference.is_sane():
                 return False
-            if not self.__execution_trace.is_sane():
+            if sample_size is None and not self.execution_trace.is_sane():
+                return False
+            if sample_size is not None and not self.execution_trace.is_sane_sampled(sample_size):
                 return False
 
         old_dict = self.__flags
@@ -112,6 +134,30 @@ class Peripheral(Storable):
 
         return True
 
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            'start': self.start,
+            'size': self.size,
+            'registers': self.registers,
+            'exit_reasons': self.exit_reasons,
+            'flags': {str(k): v for k, v in self.__flags.items()},
+            'trace': None if self.trace_reference is None else self.trace_reference.to_record(),
+        }
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any], version: int) -> 'Peripheral':
+        peripheral = Peripheral(record['start'], record['size'])
+        peripheral.registers = record['registers']
+        peripheral.exit_reasons = record['exit_reasons']
+        peripheral.__flags = {int(k): v for k, v in record['flags'].items()}
+        if version < 2 and record['execution_trace'] is not None:
+            peripheral.execution_trace = ExecutionTrace.from_record(
+                record['execution_trace'], ExecutionTrace.SCHEMA_VERSION
+            )
+        elif version >= 2 and record['trace'] is not None:
+            peripheral.execution_trace = TraceReference.from_record(record['trace'])
+        return peripheral
+
     def flag(self, flag: InfoFlag, value=True):
         print("\t - %s" % flag.name)
         self.__flags[flag.value] = True
@@ -143,6 +189,8 @@ class Peripheral(Storable):
 
 class PeripheralRow(Storable):
     HUMAN_READABLE_DEPTH = 5
+    # Peripherals are stored with the same version as the row.
+    SCHEMA_VERSION = Peripheral.SCHEMA_VERSION
 
     peripherals: List[Peripheral]
 
@@ -152,6 +200,16 @@ class PeripheralRow(Storable):
     def append(self, peripheral: Peripheral):
         self.peripherals.append(peripheral)
 
+    def to_record(self) -> Dict[str, Any]:
+        return {'peripherals': [x.to_record() for x in self.peripherals]}
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any], version: int) -> 'PeripheralRow':
+        peripheral_row = PeripheralRow()
+        for x in record['peripherals']:
+            peripheral_row.append(Peripheral.from_record(x, version))
+        return peripheral_row
+
     # @classmethod
     # def write_to_csv(cls, peripherals: 'PeripheralRow', store_path: str):
     #     with open(store_path, mode='w', newline='') as csv_file:
@@ -175,3 +233,13 @@ class PeripheralRow(Storable):
                 return False
 
         return True
+
+    def is_sane_sampled(self, sample_size: int = DEFAULT_SAMPLE_SIZE) -> bool:
+        if not isinstance(self.peripherals, list):
+            return False
+
+        for x in self.peripherals:
+            if not isinstance(x, Peripheral) or not x.is_sane_sampled(sample_size):
+                return False
+
+        return True
@@ -0,0 +1,189 @@
+import os
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from phases.analyzer.candidate_search import base_targets, size_targets, packed_targets, PACKED_SHIFT
+from phases.analyzer.clusteringanalyzer import ClusteringAnalyzer, find_dma_incidence_indices
+from phases.analyzer.dma_info import DmaInfo
+from phases.analyzer.gap_clustering import SortedAddresses
+from phases.recorder import TraceEntry, TraceReference, trace_logging
+from phases.recorder.dma_summary import merge_regions
+from utilities.storable import VALIDATION_CHECKSUM
+
+# Rough sizes of the aggregates in bytes, to keep them within the memory budget.
+ADDRESS_COST = 200
+DMA_STEP_COST = 200
+RUN_COST = 8
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+
+
+class DeltaRuns:
+    """ The runs of the asynchronous deltas of a step, without their values. Like DeltaList for bounds and overlaps. """
+    __slots__ = ('run_starts', 'run_lengths')
+
+    run_starts: array
+    run_lengths: array
+
+    def __init__(self, run_starts: array, run_lengths: array):
+        self.run_starts = run_starts
+        self.run_lengths = run_lengths
+
+    def bounds(self) -> Optional[Tuple[int, int]]:
+        """ Lowest changed address and one past the highest, None without runs. """
+        if len(self.run_starts) == 0:
+            return None
+        return min(self.run_starts), max([x + y for x, y in zip(self.run_starts, self.run_lengths)])
+
+    def overlaps(self, start: int, end: int) -> bool:
+        """ Whether any run changes an address in [start, end). """
+        for run_start, run_length in zip(self.run_starts, self.run_lengths):
+            if run_start < end and start < run_start + run_length:
+                return True
+        return False
+
+
+NO_RUNS = DeltaRuns(array('I'), array('I'))
+
+
+class PartialTraceIndex:
+    """ The entries of a trace that have one of the values searched for, with the lookups of TraceIndex they need. """
+    values: Dict[int, int]
+
+    __by_value: Dict[int, List[int]]
+    __entries: Dict[int, TraceEntry]
+
+    def __init__(self):
+        self.values = dict()
+        self.__by_value = dict()
+        self.__entries = dict()
+
+    def add(self, index: int, entry: TraceEntry):
+        self.values[index] = entry.value
+        self.__by_value.setdefault(entry.value, []).append(index)
+        self.__entries[index] = entry
+
+    def entries(self, indices: List[int]) -> List[TraceEntry]:
+        return [self.__entries[x] for x in indices]
+
+    def indices_with_value(self, value: int) -> List[int]:
+        return self.__by_value.get(value, [])
+
+    def indices_with_values_between(self, low: int, high: int, end: Optional[int] = None) -> List[int]:
+        """ Steps with a value in [low, high], up to and including the step `end`. """
+        return sorted(
+            y for x, indices in self.__by_value.items() if low <= x <= high for y in indices if end is None or y <= end
+        )
+
+
+class StreamingAnalyzer(ClusteringAnalyzer):
+    """
+    ClusteringAnalyzer for recordings that are too long to have in memory.
+
+    The trace is streamed twice with trace_logging.iter_trace. The first pass keeps how often and where first every
+    address was accessed, and the bounds and runs of every step with DMA. The second pass only keeps the entries before
+    the incidences of DMA that have a value from which a base or size could be derived. It stores the same peripherals
+    and DMA infos, which refer to the stored trace of the recording.
+    """
+    recording_dir: str
+    memory_budget: int
+
+    __entry_count: int
+    __memory: int
+    __address_counts: Dict[int, List[int]]
+    __dma_steps: Dict[int, Tuple[int, int, int]]
+    __runs: Dict[int, DeltaRuns]
+    __sorted_addresses: Optional[SortedAddresses]
+
+    def __init__(self, recording_dir: str, ram_base: int, work_dir: str = ".",
+                 memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        """
+        :param recording_dir: A finished recording, its trace is referenced by the DMA infos.
+        :param memory_budget: Bytes the aggregates may take, an Exception is raised when they need more.
+        """
+        # The trace is never loaded, so ClusteringAnalyzer.__init__ is not used.
+        self.recording_dir = recording_dir
+        self.dma_info = DmaInfo(TraceReference.of_file(os.path.join(recording_dir, trace_logging.RECORDING_JSON)))
+        self.trace_index = None
+        self.ram_base = ram_base
+        self.work_dir = work_dir
+        # Full validation would load the trace to check the DMA infos.
+        self.store_validation = VALIDATION_CHECKSUM
+        self.memory_budget = memory_budget
+
+        self.__entry_count = 0
+        self.__memory = 0
+        self.__address_counts = dict()
+        self.__dma_steps = dict()
+        self.__runs = dict()
+        self.__sorted_addresses = None
+        self.__aggregate()
+
+    def __spend(self, cost: int):
+        self.__memory += cost
+        if self.__memory > self.memory_budget:
+            raise Exception("Streaming analysis of %s needs more than the memory budget of %d bytes." % (
+                self.recording_dir, self.memory_budget
+            ))
+
+    def __aggregate(self):
+        for index, entry in enumerate(trace_logging.iter_trace(self.recording_dir)):
+            address_count = self.__address_counts.get(entry.address, None)
+            if address_count is None:
+                self.__address_counts[entry.address] = [1, index]
+                self.__spend(ADDRESS_COST)
+            else:
+                address_count[0] += 1
+
+            async_deltas = entry.async_deltas
+            if len(async_deltas) > 0:
+                low, high = async_deltas.bounds()
+                self.__dma_steps[index] = (len(async_deltas), low, high)
+                self.__runs[index] = DeltaRuns(
+                    array('I', async_deltas.run_starts), array('I', async_deltas.run_lengths)
+                )
+                self.__spend(DMA_STEP_COST + RUN_COST * len(async_deltas.run_starts))
+            self.__entry_count = index + 1
+
+    @property
+    def entry_count(self) -> int:
+        return self.__entry_count
+
+    def async_deltas(self, index: int) -> DeltaRuns:
+        return self.__runs.get(index, NO_RUNS)
+
+    def sorted_addresses(self) -> SortedAddresses:
+        if self.__sorted_addresses is None:
+            addresses = list(self.__address_counts.keys())
+            counts = [self.__address_counts[x][0] for x in addresses]
+            first_access = [self.__address_counts[x][1] for x in addresses]
+            self.__sorted_addresses = SortedAddresses.from_counts(addresses, counts, first_access)
+        return self.__sorted_addresses
+
+    def find_incidences(self) -> List[int]:
+        def delta_count(step: int) -> int:
+            return self.__dma_steps[step][0]
+
+        def bounds(step: int) -> Tuple[int, int]:
+            return self.__dma_steps[step][1:]
+
+        regions = merge_regions(sorted(self.__dma_steps.keys()), bounds)
+        return find_dma_incidence_indices(regions, delta_count, bounds, self.async_deltas)
+
+    def prepare_candidates(self, incidences: List[int]):
+        """ Stream the trace again for the entries that could set the base or size of one of the incidences. """
+        targets = []
+        for index in incidences:
+            lb, ub = self.incidence_bounds(index)
+            targets += base_targets(lb)
+            targets += size_targets(1 + (ub - lb))
+        values = set(x for x, _ in targets)
+        packed_values = set(x for x, _ in packed_targets(targets))
+        end = max(incidences)
+
+        self.trace_index = PartialTraceIndex()
+        for index, entry in enumerate(trace_logging.iter_trace(self.recording_dir)):
+            if index > end:
+                break
+            if entry.value in values or (entry.value >> 32 == 0 and entry.value >> PACKED_SHIFT in packed_values):
+                self.trace_index.add(index, entry)
+                self.__spend(ADDRESS_COST)
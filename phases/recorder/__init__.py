@@ -1,3 +1,4 @@
-from .execution_trace import ExecutionTrace, TraceEntry, MemoryDelta
+from .execution_trace import ExecutionTrace, TraceEntry, MemoryDelta, DeltaList, DeltaRun
 from .trace_logging import ExecutionLogger
 from .firmware_recorder import FirmwareRecorder
+from .trace_reference import TraceReference
@@ -0,0 +1,243 @@
+import weakref
+from array import array
+from bisect import bisect_right
+from typing import Dict, List, Tuple, Iterable, Callable
+
+import numpy
+
+from .execution_trace import ExecutionTrace, TraceEntry
+from .trace_columns import LazyEntries
+
+STEP_COLUMNS = ["delta_count", "low", "high", "run_count", "ignored_count"]
+BURST_COLUMNS = ["first_step", "last_step", "low", "high", "byte_count"]
+
+
+class DmaBurst:
+    """ Consecutive steps with asynchronous deltas, with the bounds and size of all of them together. """
+    __slots__ = ('first_step', 'last_step', 'low', 'high', 'byte_count')
+
+    first_step: int
+    last_step: int
+    low: int
+    high: int
+    byte_count: int
+
+    def __init__(self, first_step: int, last_step: int, low: int, high: int, byte_count: int):
+        self.first_step = first_step
+        self.last_step = last_step
+        self.low = low
+        self.high = high
+        self.byte_count = byte_count
+
+    @property
+    def length(self) -> int:
+        """ Number of steps. """
+        return self.last_step + 1 - self.first_step
+
+    def __repr__(self):
+        return 'DMA burst over steps %d-%d: %d bytes in [0x%08X, 0x%08X)' % (
+            self.first_step, self.last_step, self.byte_count, self.low, self.high
+        )
+
+
+class DmaRegion:
+    """
+    Memory that DMA wrote to, with every step that wrote to it. Steps whose bounds overlap or touch are in the same
+    region, so each region is one buffer, or one channel writing to adjacent buffers.
+    """
+    __slots__ = ('low', 'high', 'steps')
+
+    low: int
+    high: int
+    # Sorted.
+    steps: List[int]
+
+    def __init__(self, low: int, high: int, steps: List[int]):
+        self.low = low
+        self.high = high
+        self.steps = steps
+
+    def __repr__(self):
+        return 'DMA region [0x%08X, 0x%08X) written in %d steps' % (self.low, self.high, len(self.steps))
+
+
+class DmaSummary:
+    """
+    Per step of a trace: the number of asynchronous deltas, their bounds (low and one past high, 0 without deltas),
+    the number of contiguous runs they form and the number of ignored deltas.
+
+    This answers where and how much DMA happened at a step without touching the deltas themselves.
+    """
+    columns: Dict[str, array]
+
+    __bursts: List[DmaBurst]
+    __regions: List[DmaRegion]
+
+    def __init__(self):
+        self.columns = {x: array('q') for x in STEP_COLUMNS}
+        self.__bursts = None
+        self.__regions = None
+
+    @classmethod
+    def from_trace(cls, execution_trace: ExecutionTrace) -> 'DmaSummary':
+        if isinstance(execution_trace.entries, LazyEntries):
+            return cls.from_trace_columns(execution_trace.entries.columns)
+        dma_summary = DmaSummary()
+        for entry in execution_trace.entries:
+            dma_summary.append(entry)
+        return dma_summary
+
+    @classmethod
+    def from_trace_columns(cls, columns: Dict[str, numpy.ndarray]) -> 'DmaSummary':
+        """ Summarize a trace stored by trace_columns.write_columns, without building its entries. """
+        run_offsets = numpy.asarray(columns['async_run_offsets'])
+        run_start = numpy.asarray(columns['async_run_start'], dtype=numpy.int64)
+        run_end = run_start + numpy.asarray(columns['async_run_length'], dtype=numpy.int64)
+        run_count = numpy.diff(run_offsets)
+
+        low = numpy.zeros(len(run_count), dtype=numpy.int64)
+        high = numpy.zeros(len(run_count), dtype=numpy.int64)
+        has_runs = run_count > 0
+        if numpy.any(has_runs):
+            # reduceat only gives the right answer for non-empty segments.
+            segment_starts = run_offsets[:-1][has_runs]
+            low[has_runs] = numpy.minimum.reduceat(run_start, segment_starts)
+            high[has_runs] = numpy.maximum.reduceat(run_end, segment_starts)
+
+        return cls.from_arrays({
+            'delta_count': numpy.diff(columns['async_offsets']),
+            'low': low,
+            'high': high,
+            'run_count': run_count,
+            'ignored_count': numpy.diff(columns['ignored_offsets']),
+        })
+
+    @classmethod
+    def from_arrays(cls, columns: Dict[str, numpy.ndarray]) -> 'DmaSummary':
+        dma_summary = DmaSummary()
+        for name in STEP_COLUMNS:
+            dma_summary.columns[name] = array('q', numpy.asarray(columns[name], dtype=numpy.int64).tobytes())
+        return dma_summary
+
+    def append(self, entry: TraceEntry):
+        async_deltas = entry.async_deltas
+        low, high = async_deltas.bounds() if len(async_deltas) > 0 else (0, 0)
+        self.columns['delta_count'].append(len(async_deltas))
+        self.columns['low'].append(low)
+        self.columns['high'].append(high)
+        self.columns['run_count'].append(len(async_deltas.run_starts))
+        self.columns['ignored_count'].append(len(entry.ignored_deltas))
+        self.__bursts = None
+        self.__regions = None
+
+    def __len__(self):
+        return len(self.columns['delta_count'])
+
+    def delta_count(self, step: int) -> int:
+        return self.columns['delta_count'][step]
+
+    def has_dma(self, step: int) -> bool:
+        return self.columns['delta_count'][step] > 0
+
+    def bounds(self, step: int) -> Tuple[int, int]:
+        """ Lowest changed address and one past the highest, like DeltaList.bounds. """
+        return self.columns['low'][step], self.columns['high'][step]
+
+    def run_count(self, step: int) -> int:
+        return self.columns['run_count'][step]
+
+    def ignored_count(self, step: int) -> int:
+        return self.columns['ignored_count'][step]
+
+    @property
+    def dma_steps(self) -> List[int]:
+        return numpy.flatnonzero(numpy.frombuffer(self.columns['delta_count'], dtype=numpy.int64)).tolist()
+
+    @property
+    def bursts(self) -> List[DmaBurst]:
+        """ Runs of consecutive steps with DMA, merged into one interval each. """
+        if self.__bursts is None:
+            bursts = []
+            for step in self.dma_steps:
+                low, high = self.bounds(step)
+                last = bursts[-1] if len(bursts) > 0 else None
+                if last is not None and last.last_step == step - 1:
+                    last.last_step = step
+                    last.low = min(last.low, low)
+                    last.high = max(last.high, high)
+                    last.byte_count += self.delta_count(step)
+                else:
+                    bursts.append(DmaBurst(step, step, low, high, self.delta_count(step)))
+            self.__bursts = bursts
+        return self.__bursts
+
+    @property
+    def regions(self) -> List[DmaRegion]:
+        """ The bounds of all steps with DMA merged into disjoint regions in one pass, sorted by address. """
+        if self.__regions is None:
+            self.__regions = merge_regions(self.dma_steps, self.bounds)
+        return self.__regions
+
+    def to_file(self, path: str):
+        """ Store the steps and the bursts in a numpy .npz file. """
+        arrays = {x: numpy.frombuffer(self.columns[x], dtype=numpy.int64) for x in STEP_COLUMNS}
+        for name in BURST_COLUMNS:
+            arrays["burst_" + name] = numpy.array([getattr(x, name) for x in self.bursts], dtype=numpy.int64)
+        with open(path, mode='wb') as out_file:
+            numpy.savez(out_file, **arrays)
+
+    @classmethod
+    def from_file(cls, path: str) -> 'DmaSummary':
+        with numpy.load(path) as arrays:
+            dma_summary = cls.from_arrays({x: arrays[x] for x in STEP_COLUMNS})
+            dma_summary.__bursts = [
+                DmaBurst(*x) for x in zip(*[arrays["burst_" + y].tolist() for y in BURST_COLUMNS])
+            ]
+        return dma_summary
+
+
+def merge_regions(dma_steps: Iterable[int], bounds: Callable[[int], Tuple[int, int]]) -> List[DmaRegion]:
+    """
+    Merge the bounds of steps with DMA into disjoint regions, see DmaSummary.regions.
+
+    :param dma_steps: Steps with DMA, in trace order.
+    :param bounds: Lowest changed address of a step and one past the highest.
+    """
+    regions: List[DmaRegion] = []
+    lows: List[int] = []
+    for step in dma_steps:
+        low, high = bounds(step)
+        # Regions are disjoint and sorted, so the ones this step touches are right before `end`.
+        end = bisect_right(lows, high)
+        begin = end
+        while begin > 0 and regions[begin - 1].high >= low:
+            begin -= 1
+
+        merged = DmaRegion(low, high, [step])
+        if begin < end:
+            touched = regions[begin:end]
+            merged.low = min(low, touched[0].low)
+            merged.high = max(high, touched[-1].high)
+            merged.steps = sorted([x for region in touched for x in region.steps] + [step])
+        regions[begin:end] = [merged]
+        lows[begin:end] = [merged.low]
+    return regions
+
+
+_summaries: 'weakref.WeakKeyDictionary[ExecutionTrace, DmaSummary]' = weakref.WeakKeyDictionary()
+
+
+def summarize_trace(execution_trace: ExecutionTrace) -> DmaSummary:
+    """ The summary of a trace, it is computed once and again only when the number of entries changed. """
+    dma_summary = _summaries.get(execution_trace, None)
+    if dma_summary is None or len(dma_summary) != len(execution_trace.entries):
+        dma_summary = DmaSummary.from_trace(execution_trace)
+        _summaries[execution_trace] = dma_summary
+    return dma_summary
+
+
+def attach_summary(execution_trace: ExecutionTrace, dma_summary: DmaSummary) -> None:
+    """ Use a stored summary for a trace, instead of computing it again. """
+    if len(dma_summary) != len(execution_trace.entries):
+        raise Exception("The summary does not belong to this trace.")
+    _summaries[execution_trace] = dma_summary
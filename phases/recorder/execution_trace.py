@@ -171,12 +171,20 @@
 #         return et
 
 
-from typing import List, Tuple
+import json
+from array import array
+from collections.abc import Sequence
+from typing import List, Tuple, Iterable, Union, Optional, Any, Dict
+
+import numpy
 
 from utilities import Storable
+from utilities.storable import DEFAULT_SAMPLE_SIZE, VALIDATION_CHECKSUM, validation_mode
 
 
 class MemoryDelta(Storable):
+    __slots__ = ('address', 'anterior_value', 'posterior_value')
+
     address: int
     anterior_value: int
     posterior_value: int
@@ -209,6 +217,209 @@ class MemoryDelta(Storable):
         return addr_match and anterior_match and posterior_match
 
 
+class DeltaRun:
+    """ Deltas of a contiguous range of bytes, starting at start. """
+    __slots__ = ('start', 'anterior_values', 'posterior_values')
+
+    start: int
+    anterior_values: bytes
+    posterior_values: bytes
+
+    def __init__(self, start: int, anterior_values: bytes, posterior_values: bytes):
+        if len(anterior_values) != len(posterior_values):
+            raise Exception("A DeltaRun needs as many anterior as posterior values.")
+        self.start = start
+        self.anterior_values = bytes(anterior_values)
+        self.posterior_values = bytes(posterior_values)
+
+    @property
+    def length(self) -> int:
+        return len(self.anterior_values)
+
+    @property
+    def end(self) -> int:
+        return self.start + self.length
+
+    def overlaps(self, start: int, end: int) -> bool:
+        """ Test if the run overlaps the range [start, end). """
+        return self.start < end and start < self.end
+
+    def to_deltas(self) -> List[MemoryDelta]:
+        return [MemoryDelta(self.start + i, self.anterior_values[i], self.posterior_values[i]) for i in
+                range(self.length)]
+
+    def __repr__(self):
+        return "(0x%08X..0x%08X, %d bytes)" % (self.start, self.end, self.length)
+
+
+class DeltaList(Sequence):
+    """
+    The memory deltas of a trace entry, stored as runs of contiguous bytes instead of one object per delta.
+
+    The run starts and lengths are arrays, the anterior and posterior values of all runs are concatenated in two byte
+    strings. Indexing or iterating gives MemoryDelta objects built on the spot, so it can be used like the list of
+    MemoryDelta it replaces, while runs(), bounds() and overlaps() work per run.
+    """
+    __slots__ = ('run_starts', 'run_lengths', 'anterior_values', 'posterior_values')
+
+    run_starts: array
+    run_lengths: array
+    anterior_values: bytearray
+    posterior_values: bytearray
+
+    def __init__(self, addresses: Iterable[int] = (), anterior_values: Iterable[int] = (),
+                 posterior_values: Iterable[int] = ()):
+        self.run_starts = array('I')
+        self.run_lengths = array('I')
+        self.anterior_values = bytearray()
+        self.posterior_values = bytearray()
+
+        addresses, anterior_values, posterior_values = list(addresses), list(anterior_values), list(posterior_values)
+        if not len(addresses) == len(anterior_values) == len(posterior_values):
+            raise Exception("A DeltaList needs as many anterior and posterior values as addresses.")
+        for address, anterior_value, posterior_value in zip(addresses, anterior_values, posterior_values):
+            self.append(MemoryDelta(address, anterior_value, posterior_value))
+
+    @classmethod
+    def from_deltas(cls, deltas: Iterable[MemoryDelta]) -> 'DeltaList':
+        if isinstance(deltas, DeltaList):
+            return deltas
+        delta_list = DeltaList()
+        for delta in deltas:
+            delta_list.append(delta)
+        return delta_list
+
+    @classmethod
+    def from_runs(cls, runs: Iterable[DeltaRun]) -> 'DeltaList':
+        delta_list = DeltaList()
+        for run in runs:
+            delta_list.append_run(run)
+        return delta_list
+
+    @classmethod
+    def from_run_arrays(cls, run_starts: numpy.ndarray, run_lengths: numpy.ndarray, anterior_values: numpy.ndarray,
+                        posterior_values: numpy.ndarray) -> 'DeltaList':
+        """ Build a DeltaList from the arrays of an existing one, for example as stored by trace_columns. """
+        delta_list = DeltaList()
+        delta_list.run_starts.frombytes(numpy.ascontiguousarray(run_starts, dtype=numpy.uint32).tobytes())
+        delta_list.run_lengths.frombytes(numpy.ascontiguousarray(run_lengths, dtype=numpy.uint32).tobytes())
+        delta_list.anterior_values[:] = numpy.ascontiguousarray(anterior_values, dtype=numpy.uint8).tobytes()
+        delta_list.posterior_values[:] = numpy.ascontiguousarray(posterior_values, dtype=numpy.uint8).tobytes()
+        if not sum(delta_list.run_lengths) == len(delta_list.anterior_values) == len(delta_list.posterior_values):
+            raise Exception("The runs of a DeltaList must cover exactly all of its values.")
+        return delta_list
+
+    @classmethod
+    def from_arrays(cls, addresses: numpy.ndarray, anterior_values: numpy.ndarray,
+                    posterior_values: numpy.ndarray) -> 'DeltaList':
+        """ Build a DeltaList from per byte numpy arrays, with ascending addresses, without python integers. """
+        addresses = numpy.asarray(addresses, dtype=numpy.int64)
+        # A new run starts wherever an address does not directly follow the previous one.
+        breaks = numpy.flatnonzero(numpy.diff(addresses) != 1) + 1
+        run_offsets = numpy.concatenate(([0], breaks, [len(addresses)])) if len(addresses) > 0 else numpy.zeros(1)
+        run_offsets = run_offsets.astype(numpy.int64)
+        return cls.from_run_arrays(addresses[run_offsets[:-1]], numpy.diff(run_offsets), anterior_values,
+                                   posterior_values)
+
+    @property
+    def addresses(self) -> array:
+        """ The address of every delta. """
+        starts = numpy.frombuffer(self.run_starts, dtype=numpy.uint32).astype(numpy.int64)
+        lengths = numpy.frombuffer(self.run_lengths, dtype=numpy.uint32).astype(numpy.int64)
+        offsets = numpy.cumsum(lengths) - lengths
+        per_byte = numpy.repeat(starts - offsets, lengths) + numpy.arange(len(self))
+        addresses = array('I')
+        addresses.frombytes(per_byte.astype(numpy.uint32).tobytes())
+        return addresses
+
+    @property
+    def byte_count(self) -> int:
+        return len(self.anterior_values)
+
+    def to_rows(self) -> List[List[Any]]:
+        """ One [start, anterior hex, posterior hex] row per run, for storing in json. """
+        return [[x.start, x.anterior_values.hex(), x.posterior_values.hex()] for x in self.runs()]
+
+    @classmethod
+    def from_rows(cls, rows: List[List[Any]]) -> 'DeltaList':
+        return cls.from_runs([DeltaRun(x[0], bytes.fromhex(x[1]), bytes.fromhex(x[2])) for x in rows])
+
+    def runs(self) -> List[DeltaRun]:
+        runs = []
+        offset = 0
+        for start, length in zip(self.run_starts, self.run_lengths):
+            runs.append(DeltaRun(
+                start, self.anterior_values[offset:offset + length], self.posterior_values[offset:offset + length]
+            ))
+            offset += length
+        return runs
+
+    def bounds(self) -> Optional[Tuple[int, int]]:
+        """ The lowest changed address and one past the highest, None without deltas. """
+        if len(self.run_starts) == 0:
+            return None
+        return min(self.run_starts), max([x + y for x, y in zip(self.run_starts, self.run_lengths)])
+
+    def overlaps(self, start: int, end: int) -> bool:
+        """ Test if any delta is in the range [start, end). """
+        for run_start, run_length in zip(self.run_starts, self.run_lengths):
+            if run_start < end and start < run_start + run_length:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.anterior_values)
+
+    def __iter__(self):
+        offset = 0
+        for start, length in zip(self.run_starts, self.run_lengths):
+            for i in range(length):
+                yield MemoryDelta(start + i, self.anterior_values[offset + i], self.posterior_values[offset + i])
+            offset += length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DeltaList(self.addresses[index], self.anterior_values[index], self.posterior_values[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("DeltaList index out of range")
+
+        offset = 0
+        for start, length in zip(self.run_starts, self.run_lengths):
+            if index < offset + length:
+                return MemoryDelta(
+                    start + index - offset, self.anterior_values[index], self.posterior_values[index]
+                )
+            offset += length
+
+    def __eq__(self, other):
+        if not isinstance(other, DeltaList):
+            return NotImplemented
+        # Adjacent runs are always merged, so equal deltas have equal runs.
+        return (self.run_starts == other.run_starts and self.run_lengths == other.run_lengths
+                and self.anterior_values == other.anterior_values and self.posterior_values == other.posterior_values)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "[%s]" % ", ".join([str(x) for x in self])
+
+    def append(self, delta: MemoryDelta):
+        self.append_run(DeltaRun(delta.address, bytes([delta.anterior_value]), bytes([delta.posterior_value])))
+
+    def append_run(self, run: DeltaRun):
+        if run.length == 0:
+            return
+        if len(self.run_starts) > 0 and self.run_starts[-1] + self.run_lengths[-1] == run.start:
+            self.run_lengths[-1] += run.length
+        else:
+            self.run_starts.append(run.start)
+            self.run_lengths.append(run.length)
+        self.anterior_values += run.anterior_values
+        self.posterior_values += run.posterior_values
+
+
 class TraceEntryDiff:
     instruction: Tuple[str, str]
     pc: Tuple[int, int]
@@ -278,17 +489,18 @@ class TraceEntryDiff:
 
 
 class TraceEntry(Storable):
+    __slots__ = ('instruction', 'pc', 'value', 'address', '_async_deltas', '_ignored_deltas')
+
     # index: int
 
     instruction: str
     pc: int
     value: int
     address: int
-    async_deltas: List[MemoryDelta]
-    ignored_deltas: List[MemoryDelta]
 
     def __init__(self, instruction: str, pc: int, value: int, address: int,
-                 async_deltas: List[MemoryDelta], ignored_deltas: List[MemoryDelta]):
+                 async_deltas: Union[DeltaList, List[MemoryDelta]],
+                 ignored_deltas: Union[DeltaList, List[MemoryDelta]]):
         self.instruction = instruction
         self.pc = pc
         self.value = value
@@ -296,6 +508,50 @@ class TraceEntry(Storable):
         self.async_deltas = async_deltas
         self.ignored_deltas = ignored_deltas
 
+    @property
+    def async_deltas(self) -> DeltaList:
+        return self._async_deltas
+
+    @async_deltas.setter
+    def async_deltas(self, deltas: Union[DeltaList, List[MemoryDelta]]):
+        self._async_deltas = DeltaList.from_deltas(deltas)
+
+    @property
+    def ignored_deltas(self) -> DeltaList:
+        return self._ignored_deltas
+
+    @ignored_deltas.setter
+    def ignored_deltas(self, deltas: Union[DeltaList, List[MemoryDelta]]):
+        self._ignored_deltas = DeltaList.from_deltas(deltas)
+
+    def __getstate__(self):
+        # Stored with a list of MemoryDelta per kind, the same layout as before the DeltaList.
+        return {
+            'instruction': self.instruction,
+            'pc': self.pc,
+            'value': self.value,
+            'address': self.address,
+            'async_deltas': list(self.async_deltas),
+            'ignored_deltas': list(self.ignored_deltas),
+        }
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def to_row(self) -> List[Any]:
+        return [
+            self.instruction, self.pc, self.value, self.address,
+            self.async_deltas.to_rows(), self.ignored_deltas.to_rows(),
+        ]
+
+    @classmethod
+    def from_row(cls, row: List[Any]) -> 'TraceEntry':
+        instruction, pc, value, address, async_rows, ignored_rows = row
+        return TraceEntry(
+            instruction, pc, value, address, DeltaList.from_rows(async_rows), DeltaList.from_rows(ignored_rows)
+        )
+
     def is_sane(self):
         if not isinstance(self.instruction, str) or self.instruction not in ["str", "ldr"]:
             return False
@@ -305,7 +561,7 @@ class TraceEntry(Storable):
             return False
         if not isinstance(self.address, int) or not self.address >= 0:
             return False
-        if not isinstance(self.async_deltas, list):
+        if not isinstance(self.async_deltas, DeltaList):
             return False
         for async_delta in self.async_deltas:
             if not isinstance(async_delta, MemoryDelta):
@@ -335,15 +591,30 @@ class TraceEntry(Storable):
 
 
 class ExecutionTrace(Storable):
-    entries: List[TraceEntry]
+    SCHEMA_VERSION = 1
+
+    # A list, or a lazily loaded sequence for traces read through trace_columns.
+    entries: Sequence[TraceEntry]
 
     def __init__(self):
         self.entries = []
 
+    def __getstate__(self):
+        # Lazily loaded entries are stored as a plain list.
+        state = self.__dict__.copy()
+        state['entries'] = list(self.entries)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
     def is_sane(self):
-        if not isinstance(self.entries, list):
+        if not isinstance(self.entries, Sequence):
             return False
-        for entry in self.entries:
+        # Entries of a columnar trace are checked without keeping them in memory, see LazyEntries.build.
+        build = getattr(self.entries, 'build', None)
+        entries = self.entries if build is None else (build(x) for x in range(len(self.entries)))
+        for entry in entries:
             if not isinstance(entry, TraceEntry):
                 return False
             if not entry.is_sane():
@@ -351,7 +622,53 @@ class ExecutionTrace(Storable):
 
         return True
 
+    def is_sane_sampled(self, sample_size: int = DEFAULT_SAMPLE_SIZE) -> bool:
+        """ Check about sample_size entries evenly spread over the trace, and the last one. """
+        if not isinstance(self.entries, Sequence):
+            return False
+        if len(self.entries) == 0:
+            return True
+
+        step = max(1, len(self.entries) // sample_size)
+        for index in list(range(0, len(self.entries), step)) + [len(self.entries) - 1]:
+            entry = self.entries[index]
+            if not isinstance(entry, TraceEntry) or not entry.is_sane():
+                return False
+
+        return True
+
+    def to_record(self) -> Dict[str, Any]:
+        return {'entries': [x.to_row() for x in self.entries]}
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any], version: int) -> 'ExecutionTrace':
+        execution_trace = ExecutionTrace()
+        execution_trace.entries = [TraceEntry.from_row(x) for x in record['entries']]
+        return execution_trace
+
+    @classmethod
+    def to_file_streamed(cls, path: str, entries: Iterable[TraceEntry], validation: Optional[str] = None):
+        """
+        Store entries as a trace, the same file to_file writes, without having all of them in memory.
+
+        :param validation: See Storable.to_file, every entry is checked unless it is checksum.
+        """
+        check = validation_mode(validation) != VALIDATION_CHECKSUM
+
+        def chunks():
+            yield b'{"entries":['
+            for index, entry in enumerate(entries):
+                if check and not entry.is_sane():
+                    raise Exception("Refusing to write invalid file.")
+                row = json.dumps(entry.to_row(), separators=(',', ':')).encode('utf-8')
+                yield row if index == 0 else b"," + row
+            yield b']}'
+
+        cls.to_file_chunks(path, chunks())
+
     def append(self, trace_entry: TraceEntry):
+        if not isinstance(self.entries, list):
+            self.entries = list(self.entries)
         self.entries.append(trace_entry)
 
     def __repr__(self):
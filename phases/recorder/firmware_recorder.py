@@ -1,56 +1,25 @@
+import json
 import os
 import random
+import timeit
 from datetime import datetime
-from typing import Tuple, List, Dict, Optional
+from typing import Tuple, List, Dict, Optional, Union
 
+import numpy
 from avatar2 import ARM_CORTEX_M3, Target
 
 from a2h import Avatar2Handler
-from utilities import naming_things
-from . import ExecutionTrace, TraceEntry, ExecutionLogger, MemoryDelta
+from a2h.avatar2handler import SNAPSHOT_MODE_DUMP_IMAGE
+from a2h.instruction_cache import InstructionCache
+from utilities import naming_things, RegionIndex, StageProfiler
+from . import ExecutionTrace, ExecutionLogger
+from .loop_detector import LoopDetector
+from .trace_logging import FLUSH_EVERY_ENTRY
+from .snapshot_diff import calculate_memory_delta
+from .snapshot_store import SnapshotStore, COMPRESSION_NONE
 
-
-def recurse_has_loops(items: list, loop_items: list, amount: int) -> bool:
-    if amount == 0:
-        # Done finding
-        return True
-
-    loop_length = len(loop_items)
-    items_length = len(items)
-    if items_length < amount * loop_length:
-        # Wouldn't fit
-        return False
-
-    # Now two things must be true
-    # The loop items must match the last set
-    candidate_items = items[-loop_length:]
-    if candidate_items == loop_items:
-        return recurse_has_loops(items[0:-loop_length], loop_items, amount - 1)
-    else:
-        # Did not match
-        return False
-
-
-def calculate_memory_delta(before_mem: bytes, after_mem: bytes, ignore: Tuple[int, int], ram_base: int
-                           ) -> Tuple[List[MemoryDelta], List[MemoryDelta]]:
-    """
-    :param before_mem: State of the memory before our changes
-    :param after_mem: State of the memory after our changes (and a small delay)
-    :param ignore: Section of memory to ignore
-    :param ram_base: Base address of the region that is captured.
-    :return:
-    """
-    diffs: List[MemoryDelta] = []
-    ignored: List[MemoryDelta] = []
-    for index, pair in enumerate(zip(before_mem, after_mem)):
-        if pair[0] != pair[1]:
-            md = MemoryDelta(ram_base + index, pair[0], pair[1])
-            if not ignore[0] <= index < ignore[0] + ignore[1]:
-                diffs.append(md)
-            else:
-                ignored.append(md)
-                print("Ignored a diff at 0x%08X due to ignore region." % index)
-    return diffs, ignored
+# Bytes written per transfer when poisoning memory.
+POISON_BLOCK_SIZE = 0x1000
 
 
 def find_bx_lr(target: Target):
@@ -68,6 +37,7 @@ class FirmwareRecorder:
     exit_reason_path: str
 
     a2h: Avatar2Handler
+    instruction_cache_path: Optional[str]
     original_trace: Optional[ExecutionTrace]
     logger: ExecutionLogger
 
@@ -77,15 +47,25 @@ class FirmwareRecorder:
     shadow_realm: Dict[int, int]
     mocked_regions: List[Tuple[int, int]]
     shimmed_regions: List[Tuple[int, int, int]]
+    mock_index: RegionIndex
+    shim_index: RegionIndex
 
     snapshot_region: Tuple[int, int]
     peripheral_region: Tuple[int, int]
 
+    persist_snapshots: bool
+    snapshot_store: Optional[SnapshotStore]
+    anterior_buffer: bytearray
+    posterior_buffer: bytearray
+
+    profiler: StageProfiler
+
     abort_step_timer: int
     abort_grace_steps: int
     abort_after_deviation: bool
     abort_after_dma: bool
     abort_after_loops: int
+    loop_detector: Optional[LoopDetector]
     abort_after_pc: int
     abort_after_iterations: int
     abort_per_step_timeout: int
@@ -102,7 +82,15 @@ class FirmwareRecorder:
             abort_after_loops=-1,
             abort_after_pc=-1,
             abort_at_step=-1,
-            abort_per_step_timeout=-1
+            abort_per_step_timeout=-1,
+            snapshot_mode=SNAPSHOT_MODE_DUMP_IMAGE,
+            persist_snapshots=True,
+            deduplicate_snapshots=True,
+            snapshot_page_directory=None,
+            snapshot_compression=COMPRESSION_NONE,
+            instruction_cache_path=None,
+            trace_flush_every=FLUSH_EVERY_ENTRY,
+            trace_keep_entries=None
     ):
         """
         :param openocd_cfg: Path to the OpenOCD configuration file for the board/chip under test
@@ -120,6 +108,15 @@ class FirmwareRecorder:
         :param abort_after_pc: A specific PC that triggers abort when reached (-1 to disable).
         :param abort_at_step: Critically abort when reaching this step number (-1 to disable) (no grace).
         :param abort_per_step_timeout: If any step takes longer that this amount of seconds, critically abort.
+
+        :param snapshot_mode: How memory snapshots are taken, see SNAPSHOT_MODES in a2h.avatar2handler.
+        :param persist_snapshots: Write every snapshot to the snapshot directory (dump_image always uses a file).
+        :param deduplicate_snapshots: Persist snapshots in a SnapshotStore instead of as one file per image.
+        :param snapshot_page_directory: Page directory of the SnapshotStore, share it between runs to deduplicate more.
+        :param snapshot_compression: Compression of the SnapshotStore pages, see COMPRESSIONS in snapshot_store.
+        :param instruction_cache_path: File to load decoded instructions from and store them in (None to disable).
+        :param trace_flush_every: Flush the streamed trace after this many entries (0 to only flush at the end).
+        :param trace_keep_entries: Only keep this many of the latest trace entries in memory (None to keep all).
         """
 
         avatar_output_directory = os.path.join(work_dir, naming_things.AVATAR_OUTPUT_DIRECTORY)
@@ -143,7 +140,12 @@ class FirmwareRecorder:
 
         # TODO infer architecture or get architecture from parameters, as opposed to using hardcoded value
         architecture = ARM_CORTEX_M3
-        a2h = Avatar2Handler(openocd_cfg, mem_peripheral, mem_ram, avatar_output_directory, architecture)
+        if instruction_cache_path is not None:
+            instruction_cache = InstructionCache.from_file(instruction_cache_path)
+        else:
+            instruction_cache = None
+        a2h = Avatar2Handler(openocd_cfg, mem_peripheral, mem_ram, avatar_output_directory, architecture,
+                             snapshot_mode=snapshot_mode, instruction_cache=instruction_cache)
         a2h.set_mmf_callback(self.on_fault)
 
         if original_trace is None and abort_after_deviation:
@@ -153,11 +155,12 @@ class FirmwareRecorder:
         self.work_dir = work_dir
         self.snapshot_dir = snapshot_dir
         self.exit_reason_path = exit_reason_path
+        self.instruction_cache_path = instruction_cache_path
 
         # Store objects for interaction
         self.a2h = a2h
         self.original_trace = original_trace
-        self.logger = ExecutionLogger(self.work_dir)
+        self.logger = ExecutionLogger(self.work_dir, trace_flush_every, trace_keep_entries)
 
         # Keep track os the state
         self.stopped = True
@@ -167,17 +170,30 @@ class FirmwareRecorder:
         self.shadow_realm = dict()
         self.mocked_regions = mocked_regions
         self.shimmed_regions = shimmed_regions
+        self.mock_index = RegionIndex(mocked_regions, "mocked region")
+        self.shim_index = RegionIndex(shimmed_regions, "shimmed region")
 
         # Track the two interesting memory regions
         self.snapshot_region = mem_ram
         self.peripheral_region = mem_peripheral
 
+        # Snapshots are read into the same two buffers every step
+        self.persist_snapshots = persist_snapshots
+        if persist_snapshots and deduplicate_snapshots:
+            self.snapshot_store = SnapshotStore(snapshot_dir, snapshot_page_directory, compression=snapshot_compression)
+        else:
+            self.snapshot_store = None
+        self.anterior_buffer = bytearray(mem_ram[1])
+        self.posterior_buffer = bytearray(mem_ram[1])
+        self.profiler = StageProfiler()
+
         # Track the abort status and configuration
         self.abort_step_timer = -1
         self.abort_grace_steps = abort_grace_steps
         self.abort_after_deviation = abort_after_deviation
         self.abort_after_dma = abort_after_dma
         self.abort_after_loops = abort_after_loops
+        self.loop_detector = LoopDetector(abort_after_loops) if abort_after_loops != -1 else None
         self.abort_after_pc = abort_after_pc
         self.abort_after_iterations = abort_at_step
         self.abort_per_step_timeout = abort_per_step_timeout
@@ -189,22 +205,22 @@ class FirmwareRecorder:
         with open(self.exit_reason_path, 'a') as exit_reason_file:
             exit_reason_file.write(msg + "\n")
 
-    def test_for_loop(self) -> bool:
-        current_history: List[TraceEntry] = self.logger.execution_trace.entries
-        for i in range(1, 1 + len(current_history) // self.abort_after_loops):
-            search_part = current_history[:-i]
-            loop_part = current_history[-i:]
-            if recurse_has_loops(search_part, loop_part, self.abort_after_loops - 1):
-                return True
-        return False
+    def take_snapshot(self, step: int, dump_name: str, buffer: bytearray) -> Union[bytes, memoryview]:
+        if self.persist_snapshots and self.snapshot_store is None:
+            path = os.path.join(self.snapshot_dir, "%03d_%s" % (step, dump_name))
+        else:
+            path = None
 
-    def has_deviated(self) -> bool:
-        original_trace_entries = self.original_trace.entries
-        current_trace_entries = self.logger.execution_trace.entries
+        snapshot = self.a2h.make_snapshot(self.snapshot_region, path, buffer)
+
+        if self.snapshot_store is not None:
+            self.snapshot_store.put(step, dump_name, snapshot)
+        return snapshot
 
-        current_index = len(current_trace_entries) - 1
-        original_item = original_trace_entries[current_index]
-        current_item = current_trace_entries[current_index]
+    def has_deviated(self) -> bool:
+        current_index = self.logger.entry_count - 1
+        original_item = self.original_trace.entries[current_index]
+        current_item = self.logger.last_entry
 
         if original_item.address != current_item.address or original_item.pc != current_item.pc:
             # TODO reduce aggressiveness if needed?
@@ -213,8 +229,7 @@ class FirmwareRecorder:
         return False
 
     def dma_occurred(self) -> bool:
-        last_item = self.logger.execution_trace.entries[-1]
-        if len(last_item.async_deltas) != 0:
+        if self.logger.dma_summary.has_dma(-1):
             # TODO reduce aggressiveness if needed?
             # For example, at least two mem locations need changing
             return True
@@ -222,7 +237,12 @@ class FirmwareRecorder:
 
     def test_abort_conditions(self, faulting_addr: int, faulting_pc: int):
         # First test the timed aborts, only if we're not already counting down.
-        number_of_events = len(self.logger.execution_trace.entries)
+        number_of_events = self.logger.entry_count
+        # The loop detector has to see every entry, also while counting down.
+        loop = None
+        if self.loop_detector is not None:
+            loop = self.loop_detector.add_entry(self.logger.last_entry)
+
         if self.abort_step_timer == -1:
             # First, check abort_after_deviation
             if self.abort_after_deviation and self.has_deviated():
@@ -239,10 +259,10 @@ class FirmwareRecorder:
                 )
 
             # Third, check abort_after_loops
-            if self.abort_after_loops != -1 and self.test_for_loop():
+            if loop is not None:
                 self.write_log_reason_set_timer(
                     naming_things.REASON_LOOPS,
-                    "Terminating after %d events; looped %d times" % (number_of_events, self.abort_after_loops)
+                    "Terminating after %d events; looped %d times over %d events" % (number_of_events, loop[1], loop[0])
                 )
 
             # Fourth, check abort_after_pc
@@ -268,7 +288,10 @@ class FirmwareRecorder:
         self.abort_step_timer = self.abort_grace_steps
 
     def on_fault(self) -> bool:
+        t_fault = t = self.profiler.start()
+        self.a2h.begin_fault()
         faulting_addr = self.a2h.get_mm_faulting_addr()
+        t = self.profiler.lap("mmfar", t)
 
         if faulting_addr is None:
             self.a2h.target.log.error("MMF cause address is stale, this can cause skipped steps.")
@@ -277,6 +300,10 @@ class FirmwareRecorder:
             self.a2h.target.log.info("MMF cause address is not in the peripheral region. Ignoring.")
             return True  # Successful, we just don't care
 
+        # Everything needed from the register file is fetched at once, instead of one request per register.
+        registers = self.a2h.fetch_registers()
+        t = self.profiler.lap("registers", t)
+
         # DONE figure out how to abort_per_step_timeout
         # https://medium.com/@chaoren/how-to-timeout-in-python-726002bf2291
         # self.event_index += 1 is handled through appending to the history
@@ -284,29 +311,32 @@ class FirmwareRecorder:
         # TODO determine when snapshotting is not interesting (add a parameter later?)
         skip_snapshot = False
 
-        before_mem: Optional[bytes]
-        number_of_events = len(self.logger.execution_trace.entries)
+        before_mem: Optional[Union[bytes, memoryview]]
+        number_of_events = self.logger.entry_count
         if not skip_snapshot:
-            snapshot_name = "%03d_%s" % (number_of_events, naming_things.BEFORE_DUMP_NAME)
-            before_mem = self.a2h.make_snapshot(self.snapshot_region, os.path.join(self.snapshot_dir, snapshot_name))
+            before_mem = self.take_snapshot(number_of_events, naming_things.BEFORE_DUMP_NAME, self.anterior_buffer)
         else:
             before_mem = None
+        t = self.profiler.lap("snapshot_before", t)
 
         # Get the full context at the fault_moment
         stack_frame_location = self.a2h.get_stack_frame_location()
+        t = self.profiler.lap("stack_frame", t)
         context = self.a2h.read_context(stack_frame_location)
         faulting_pc = context['pc']
+        t = self.profiler.lap("context_read", t)
 
         # Parse the instruction that caused the fault
         effect, instruction = self.a2h.get_instruction_effect(faulting_pc)
         try:
-            accessed_addr = effect.compute_memory_address(self.a2h.target, context)
+            accessed_addr = effect.compute_memory_address(registers, context)
         except KeyError as err:
             print(err)
             print("Couldn't process a register...")
             raise KeyError("With %s" % instruction)
         if accessed_addr != faulting_addr:
             raise Exception("The instruction's computed accessed address does not match the fault information.")
+        t = self.profiler.lap("decode", t)
 
         # Replay or spoof the memory operation that caused the fault
         value_to_shim = self.should_be_shimmed(accessed_addr)
@@ -314,17 +344,17 @@ class FirmwareRecorder:
         if should_mock or value_to_shim is not None:
             print("\t\t\t\t\t\t\t\t\tRunning alternate mode")
         if effect.mode == 'str':
-            value = effect.get_register_value(self.a2h.target, context)
+            value = effect.get_register_value(registers, context)
             # Spoof or Replay store
             if value_to_shim is not None:
                 self.shadow_realm[accessed_addr] = value
-                self.a2h.target.write_memory(accessed_addr, effect.size, value_to_shim)
+                self.a2h.write_memory(accessed_addr, effect.size, value_to_shim)
 
             elif should_mock:
                 self.shadow_realm[accessed_addr] = value
 
             else:
-                self.a2h.target.write_memory(accessed_addr, effect.size, value)
+                self.a2h.write_memory(accessed_addr, effect.size, value)
 
         elif effect.mode == 'ldr':
             # Spoof or Replay load
@@ -333,37 +363,38 @@ class FirmwareRecorder:
                     value = self.shadow_realm[accessed_addr]
                 else:
                     self.a2h.avatar.log.warn("Substituting hardware-read value as no shadow value is present.")
-                    value = self.a2h.target.read_memory(accessed_addr, effect.size)
+                    value = self.a2h.read_memory(accessed_addr, effect.size)
 
             elif should_mock:
                 if accessed_addr in self.shadow_realm:
                     value = self.shadow_realm[accessed_addr]
                 else:
                     self.a2h.avatar.log.warn("Substituting hardware-read value as no shadow value is present.")
-                    value = self.a2h.target.read_memory(accessed_addr, effect.size)
+                    value = self.a2h.read_memory(accessed_addr, effect.size)
 
             else:
-                value = self.a2h.target.read_memory(accessed_addr, effect.size)
-            effect.set_register_value(self.a2h.target, context, value)
+                value = self.a2h.read_memory(accessed_addr, effect.size)
+            effect.set_register_value(registers, context, value)
 
         else:
             raise Exception("Faulting condition triggered by a non str/ldr instruction. What!?")
+        t = self.profiler.lap("replay", t)
 
         # self.append_log moved to after second snapshot.
         # Move the program counter and store changed memory values
         context['pc'] += effect.instruction_bytes
-        self.a2h.write_context(stack_frame_location, context)
-
         # Move the actual PC to any BX, LR; instruction to exit the fault handler.
-        self.a2h.target.write_register('pc', self.bx_lr_location)
+        self.a2h.write_back(stack_frame_location, context, self.bx_lr_location)
+        t = self.profiler.lap("context_write", t)
 
-        after_mem: Optional[bytes]
+        after_mem: Optional[Union[bytes, memoryview]]
         if not skip_snapshot:
             # time.sleep(1)
-            snapshot_name = "%03d_%s" % (number_of_events, naming_things.AFTER_DUMP_NAME)
-            after_mem = self.a2h.make_snapshot(self.snapshot_region, os.path.join(self.snapshot_dir, snapshot_name))
+            after_mem = self.take_snapshot(number_of_events, naming_things.AFTER_DUMP_NAME, self.posterior_buffer)
+            t = self.profiler.lap("snapshot_after", t)
             ignore_region = stack_frame_location - self.snapshot_region[0], 4 * len(context)
             mem_delta, ignored = calculate_memory_delta(before_mem, after_mem, ignore_region, self.snapshot_region[0])
+            t = self.profiler.lap("diff", t)
         else:
             mem_delta = None
             ignored = None
@@ -372,9 +403,13 @@ class FirmwareRecorder:
         # Side effect, entry is now indexed properly
         self.logger.add_entry(effect.mode, faulting_pc, value, faulting_addr, mem_delta, ignored)
         # self.log_entry(entry, ignored)
+        t = self.profiler.lap("logging", t)
 
         self.test_abort_conditions(faulting_addr, faulting_pc)
+        self.profiler.lap("abort_checks", t)
 
+        self.profiler.lap("fault", t_fault)
+        self.profiler.count("round_trips", self.a2h.round_trips)
         return True  # Successful
 
     def start(self):
@@ -432,37 +467,69 @@ class FirmwareRecorder:
         self.a2h.target.log.info("Firmware_recorder.py:start() has finished.")
         self.logger.finalize()
 
+        instruction_cache = self.a2h.instruction_cache
+        self.a2h.target.log.info("Instruction cache: %d hits, %d misses, %d instructions." % (
+            instruction_cache.hits, instruction_cache.misses, len(instruction_cache)
+        ))
+        if self.instruction_cache_path is not None:
+            instruction_cache.to_file(self.instruction_cache_path)
+
+        round_trips = self.profiler.counts("round_trips")
+        if len(round_trips) > 0:
+            self.a2h.target.log.info("Debugger round-trips per fault: %.1f mean, %d max over %d faults." % (
+                sum(round_trips) / len(round_trips), max(round_trips), len(round_trips)
+            ))
+        self.profiler.to_file(os.path.join(self.work_dir, naming_things.PROFILE_JSON))
+
     def should_be_mocked(self, accessed_addr) -> bool:
-        for region in self.mocked_regions:
-            if region[0] < 0 or region[1] <= 0:
-                print("Ignoring mocked region at %d of size %d" % (region[0], region[1]))
-                continue
-            if region[0] <= accessed_addr < region[0] + region[1]:
-                return True
-        return False
+        return self.mock_index.contains(accessed_addr)
 
     def should_be_shimmed(self, accessed_addr) -> Optional[int]:
-        for region in self.shimmed_regions:
-            if region[0] < 0 or region[1] <= 0:
-                print("Ignoring shimmed region at %d of size %d" % (region[0], region[1]))
-                continue
-            if region[0] <= accessed_addr < region[0] + region[1]:
-                return region[2]
-        return None
-
-    def poison(self):
-        # stuff = random.randbytes(self.snapshot_region[1])
-        # TODO speed this up (way too slow)
+        region = self.shim_index.find(accessed_addr)
+        return None if region is None else region[2]
+
+    def poison(self, seed: Optional[int] = None, pattern: Optional[int] = None, verify: bool = False):
+        """
+        Fill the snapshot region with garbage, so memory that is written later stands out.
+
+        :param seed: Seed for the random contents, a fresh one is drawn when None.
+        :param pattern: Fill every word with this 32-bit value instead of random contents.
+        :param verify: Read the region back and compare it with what was written.
+        """
+        region_start, region_size = self.snapshot_region
         print("Starting memory poisoning")
-        print("  0.0%", end='')
-        last = 0
-        chunk_size = 4
-        for i in range(0, self.snapshot_region[1], chunk_size):
-            percentage = (100 * i / self.snapshot_region[1])
-            if percentage > last + 0.25:
-                print("\b\b\b\b\b\b%5.1f%%" % percentage, end='')
-                last = percentage
-
-            stuff = random.randint(0, 255)
-            self.a2h.target.write_memory(self.snapshot_region[0] + i, chunk_size, stuff)
-        print("\nMemory poisoning done")
+        t_start = timeit.default_timer()
+
+        if pattern is not None:
+            seed = None
+            expected = (pattern & 0xFFFFFFFF).to_bytes(4, 'little') * (region_size // 4)
+            self.a2h.fill_memory(region_start, pattern, region_size // 4)
+            # Bytes past the last whole word are written one by one.
+            expected += expected[:region_size % 4]
+            for offset in range(4 * (region_size // 4), region_size):
+                self.a2h.write_memory(region_start + offset, 1, expected[offset])
+        else:
+            if seed is None:
+                seed = random.SystemRandom().randrange(1 << 32)
+            expected = numpy.random.default_rng(seed).integers(0, 256, region_size, dtype=numpy.uint8).tobytes()
+            for offset in range(0, region_size, POISON_BLOCK_SIZE):
+                block = expected[offset:offset + POISON_BLOCK_SIZE]
+                self.a2h.write_memory(region_start + offset, 1, block, len(block), raw=True)
+
+        # Record what was written so the run can be reproduced.
+        with open(os.path.join(self.work_dir, naming_things.POISON_JSON), mode='w') as poison_file:
+            json.dump({
+                'region': [region_start, region_size],
+                'seed': seed,
+                'pattern': pattern,
+            }, poison_file, indent=2)
+
+        if verify:
+            written = self.a2h.make_snapshot(self.snapshot_region, buffer=self.anterior_buffer)
+            mismatches = int(numpy.count_nonzero(
+                numpy.frombuffer(written, dtype=numpy.uint8) != numpy.frombuffer(expected, dtype=numpy.uint8)
+            ))
+            if mismatches > 0:
+                raise Exception("Memory poisoning failed, %d bytes differ after writing." % mismatches)
+
+        print("Memory poisoning done in %.2fs" % (timeit.default_timer() - t_start))
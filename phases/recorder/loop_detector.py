@@ -0,0 +1,67 @@
+from collections import deque
+from typing import Deque, Hashable, List, Optional, Tuple
+
+from .execution_trace import TraceEntry
+
+# Longest loop body (in trace entries) that is looked for.
+DEFAULT_MAX_PERIOD = 256
+
+
+def fingerprint(entry: TraceEntry) -> Tuple[int, int, str, int]:
+    return entry.pc, entry.address, entry.instruction, entry.value
+
+
+class LoopDetector:
+    """
+    Detect the end of a trace repeating itself, one entry at a time.
+
+    For every period p up to max_period this keeps the number of trailing entries that equal the entry p steps
+    earlier. The trace ends in n repetitions of a body of length p once that number reaches (n - 1) * p, so every new
+    entry costs O(max_period) no matter how long the trace already is.
+    """
+    repeats: int
+    max_period: int
+    last_loop: Optional[Tuple[int, int]]
+
+    __history: Deque[Hashable]
+    __match_lengths: List[int]
+
+    def __init__(self, repeats: int, max_period: int = DEFAULT_MAX_PERIOD):
+        """
+        :param repeats: Number of times a body has to occur back to back to count as a loop.
+        :param max_period: Longest body that is considered.
+        """
+        if repeats < 2:
+            raise Exception("A loop needs at least two repetitions.")
+        self.repeats = repeats
+        self.max_period = max_period
+        self.last_loop = None
+
+        self.__history = deque(maxlen=max_period)
+        # Index 0 is unused so a period can index its own match length.
+        self.__match_lengths = [0] * (max_period + 1)
+
+    def add(self, item: Hashable) -> Optional[Tuple[int, int]]:
+        """
+        Add the fingerprint of the next trace entry.
+
+        :return: (period, repeat count) of the shortest loop the trace now ends in, or None.
+        """
+        found = None
+        # history[-p] is the item p steps before the new one.
+        for period in range(1, len(self.__history) + 1):
+            if self.__history[-period] == item:
+                match_length = self.__match_lengths[period] + 1
+            else:
+                match_length = 0
+            self.__match_lengths[period] = match_length
+
+            if found is None and match_length >= (self.repeats - 1) * period:
+                found = (period, match_length // period + 1)
+
+        self.__history.append(item)
+        self.last_loop = found
+        return found
+
+    def add_entry(self, entry: TraceEntry) -> Optional[Tuple[int, int]]:
+        return self.add(fingerprint(entry))
@@ -3,9 +3,14 @@ import json
 import os
 from typing import Tuple
 
+from a2h.avatar2handler import SNAPSHOT_MODES, SNAPSHOT_MODE_DUMP_IMAGE
 from phases.analyzer import DmaInfo
 from phases.recorder import FirmwareRecorder, ExecutionTrace
-from utilities import auto_int
+from phases.recorder.snapshot_store import COMPRESSIONS, COMPRESSION_NONE
+from phases.recorder.trace_cache import load_trace_file
+from phases.recorder.trace_logging import FLUSH_EVERY_ENTRY
+from utilities import auto_int, positive_int
+from utilities.storable import peek_type, VALIDATION_CHECKSUM
 
 
 # noinspection DuplicatedCode
@@ -33,7 +38,7 @@ def main():
     parser.add_argument('abort_after_dma', type=bool,
                         help="Abort after DMA is first detected.")
     parser.add_argument('abort_after_loops', type=int,
-                        help="Abort after the same steps have been done 'n' times. (-1=off, 4=default).")
+                        help="Abort after the same steps have been done 'n' times. (-1=off).")
     parser.add_argument('abort_after_pc', type=auto_int,
                         help="Abort after this program counter. (-1=off)")
     parser.add_argument('abort_at_step', type=int,
@@ -44,6 +49,29 @@ def main():
     parser.add_argument('work_dir', type=str, help="Working directory.")
 
     parser.add_argument('--poison', help="Fill the ram region with garbage", action='store_true')
+    parser.add_argument('--poison-seed', dest='poison_seed', type=auto_int, default=None,
+                        help="Seed for the poison contents (default: random, recorded in the working directory).")
+    parser.add_argument('--poison-pattern', dest='poison_pattern', type=auto_int, default=None,
+                        help="Fill every word of the ram region with this value instead of random contents.")
+    parser.add_argument('--poison-verify', dest='poison_verify', action='store_true',
+                        help="Read the ram region back after poisoning and compare it.")
+    parser.add_argument('--snapshot-mode', dest='snapshot_mode', choices=SNAPSHOT_MODES,
+                        default=SNAPSHOT_MODE_DUMP_IMAGE,
+                        help="How RAM snapshots are read from the device, read_memory needs OpenOCD 0.12 or later.")
+    parser.add_argument('--no-snapshot-files', dest='persist_snapshots', action='store_false',
+                        help="Keep RAM snapshots in memory only, do not write them to the snapshot directory.")
+    parser.add_argument('--raw-snapshot-files', dest='deduplicate_snapshots', action='store_false',
+                        help="Write every snapshot as a full image file instead of using the deduplicated store.")
+    parser.add_argument('--snapshot-pages', dest='snapshot_pages', type=str, default=None,
+                        help="Page directory of the snapshot store, can be shared between runs.")
+    parser.add_argument('--snapshot-compression', dest='snapshot_compression', choices=COMPRESSIONS,
+                        default=COMPRESSION_NONE, help="Compression of the pages in the snapshot store.")
+    parser.add_argument('--instruction-cache', dest='instruction_cache', type=str, default=None,
+                        help="File to keep decoded instructions in between runs of the same firmware.")
+    parser.add_argument('--trace-flush-every', dest='trace_flush_every', type=int, default=FLUSH_EVERY_ENTRY,
+                        help="Flush the streamed trace after this many entries (0 to only flush at the end).")
+    parser.add_argument('--trace-keep-entries', dest='trace_keep_entries', type=positive_int, default=None,
+                        help="Only keep this many of the latest trace entries in memory (default: all).")
 
     args = parser.parse_args()
 
@@ -68,11 +96,16 @@ def main():
 
     if args.original_trace_path is None:
         original_trace = None
+    elif peek_type(args.original_trace_path) == DmaInfo.__name__:
+        original_trace = DmaInfo.from_file(args.original_trace_path, validation=VALIDATION_CHECKSUM).execution_trace
+    elif peek_type(args.original_trace_path) == ExecutionTrace.__name__:
+        original_trace = load_trace_file(args.original_trace_path, validation=VALIDATION_CHECKSUM)
     else:
+        # Files written before the header was introduced, try both.
         try:
-            original_trace = ExecutionTrace.from_file(args.original_trace_path)
+            original_trace = load_trace_file(args.original_trace_path, validation=VALIDATION_CHECKSUM)
         except TypeError:
-            dma_info = DmaInfo.from_file(args.original_trace_path)
+            dma_info = DmaInfo.from_file(args.original_trace_path, validation=VALIDATION_CHECKSUM)
             original_trace = dma_info.execution_trace
 
     recorder = FirmwareRecorder(
@@ -84,11 +117,19 @@ def main():
         abort_after_loops=args.abort_after_loops,
         abort_after_pc=args.abort_after_pc,
         abort_at_step=args.abort_at_step,
-        abort_per_step_timeout=args.abort_per_step_timeout
+        abort_per_step_timeout=args.abort_per_step_timeout,
+        snapshot_mode=args.snapshot_mode,
+        persist_snapshots=args.persist_snapshots,
+        deduplicate_snapshots=args.deduplicate_snapshots,
+        snapshot_page_directory=args.snapshot_pages,
+        snapshot_compression=args.snapshot_compression,
+        instruction_cache_path=args.instruction_cache,
+        trace_flush_every=args.trace_flush_every,
+        trace_keep_entries=args.trace_keep_entries
     )
 
     if args.poison:
-        recorder.poison()
+        recorder.poison(args.poison_seed, args.poison_pattern, args.poison_verify)
 
     recorder.start()
 
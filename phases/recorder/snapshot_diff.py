@@ -0,0 +1,73 @@
+from typing import Tuple
+
+import numpy
+
+from .execution_trace import DeltaList
+
+# Size of the blocks that are compared as a whole before looking at individual bytes, must be a multiple of 8.
+DIFF_BLOCK_SIZE = 0x100
+
+
+def find_changed_offsets(before_mem: bytes, after_mem: bytes) -> numpy.ndarray:
+    """
+    Find the offsets of all bytes that differ between two snapshots.
+
+    Whole blocks are compared first (as 64-bit words), only blocks that contain a change are compared byte by byte.
+    :param before_mem: State of the memory before our changes (bytes, bytearray or memoryview)
+    :param after_mem: State of the memory after our changes
+    :return: Sorted array of offsets (relative to the start of the snapshots) that changed.
+    """
+    length = min(len(before_mem), len(after_mem))
+    before = numpy.frombuffer(before_mem, dtype=numpy.uint8, count=length)
+    after = numpy.frombuffer(after_mem, dtype=numpy.uint8, count=length)
+
+    number_of_blocks = length // DIFF_BLOCK_SIZE
+    blocked_length = number_of_blocks * DIFF_BLOCK_SIZE
+
+    words_per_block = DIFF_BLOCK_SIZE // 8
+    before_blocks = before[:blocked_length].view(numpy.uint64).reshape(number_of_blocks, words_per_block)
+    after_blocks = after[:blocked_length].view(numpy.uint64).reshape(number_of_blocks, words_per_block)
+    changed_blocks = numpy.flatnonzero((before_blocks != after_blocks).any(axis=1))
+
+    offsets = []
+    for block in changed_blocks:
+        start = int(block) * DIFF_BLOCK_SIZE
+        end = start + DIFF_BLOCK_SIZE
+        offsets.append(numpy.flatnonzero(before[start:end] != after[start:end]) + start)
+
+    # The tail does not fill an entire block, compare it directly.
+    if blocked_length < length:
+        offsets.append(numpy.flatnonzero(before[blocked_length:] != after[blocked_length:]) + blocked_length)
+
+    if len(offsets) == 0:
+        return numpy.empty(0, dtype=numpy.intp)
+    return numpy.concatenate(offsets)
+
+
+def calculate_memory_delta(before_mem: bytes, after_mem: bytes, ignore: Tuple[int, int], ram_base: int
+                           ) -> Tuple[DeltaList, DeltaList]:
+    """
+    :param before_mem: State of the memory before our changes
+    :param after_mem: State of the memory after our changes (and a small delay)
+    :param ignore: Section of memory to ignore (offset, size) relative to the start of the snapshots
+    :param ram_base: Base address of the region that is captured.
+    :return: A tuple of deltas outside and deltas inside of the ignored section.
+    """
+    offsets = find_changed_offsets(before_mem, after_mem)
+    if len(offsets) == 0:
+        return DeltaList(), DeltaList()
+
+    before = numpy.frombuffer(before_mem, dtype=numpy.uint8)
+    after = numpy.frombuffer(after_mem, dtype=numpy.uint8)
+
+    ignore_mask = (offsets >= ignore[0]) & (offsets < ignore[0] + ignore[1])
+
+    deltas = []
+    for mask in (~ignore_mask, ignore_mask):
+        selected = offsets[mask]
+        deltas.append(DeltaList.from_arrays(selected + ram_base, before[selected], after[selected]))
+    diffs, ignored = deltas
+
+    if len(ignored) > 0:
+        print("Ignored %d diffs due to ignore region." % len(ignored))
+    return diffs, ignored
@@ -0,0 +1,200 @@
+import argparse
+import hashlib
+import json
+import lzma
+import os
+from typing import Dict, List, Optional, Set
+
+from utilities import naming_things
+
+STORE_INFO_FILE = "store.json"
+MANIFEST_DIRECTORY = "manifests"
+
+DEFAULT_PAGE_SIZE = 0x400
+
+COMPRESSION_NONE = "none"
+COMPRESSION_LZMA = "lzma"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSIONS = [COMPRESSION_NONE, COMPRESSION_LZMA, COMPRESSION_ZSTD]
+
+PAGE_EXTENSIONS = {
+    COMPRESSION_NONE: "",
+    COMPRESSION_LZMA: ".xz",
+    COMPRESSION_ZSTD: ".zst",
+}
+
+
+def _compress(data: bytes, compression: str) -> bytes:
+    if compression == COMPRESSION_NONE:
+        return data
+    elif compression == COMPRESSION_LZMA:
+        return lzma.compress(data)
+    elif compression == COMPRESSION_ZSTD:
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    raise Exception("Unknown compression: %s" % compression)
+
+
+def _decompress(data: bytes, compression: str) -> bytes:
+    if compression == COMPRESSION_NONE:
+        return data
+    elif compression == COMPRESSION_LZMA:
+        return lzma.decompress(data)
+    elif compression == COMPRESSION_ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise Exception("Unknown compression: %s" % compression)
+
+
+class SnapshotStore:
+    """
+    Deduplicated storage for memory snapshots.
+
+    Images are split into fixed size pages, every unique page is stored once under its hash (in a page directory
+    that may be shared between runs) and every step gets a small manifest listing the pages of its images.
+    """
+    directory: str
+    page_directory: str
+    page_size: int
+    compression: str
+
+    __known_pages: Set[str]
+    __manifests: Dict[int, Dict[str, Dict[str, any]]]
+
+    def __init__(self, directory: str, page_directory: Optional[str] = None, page_size: int = DEFAULT_PAGE_SIZE,
+                 compression: str = COMPRESSION_NONE):
+        """
+        Open or create a store, an existing store keeps its own page directory, page size and compression.
+
+        :param directory: The snapshot directory of a run.
+        :param page_directory: Directory to keep the pages in (default: 'pages' inside the snapshot directory).
+        :param page_size: Size of the pages images are split into.
+        :param compression: One of COMPRESSIONS, applied to every page individually.
+        """
+        if compression not in COMPRESSIONS:
+            raise Exception("Unknown compression: %s" % compression)
+
+        info_path = os.path.join(directory, STORE_INFO_FILE)
+        if os.path.exists(info_path):
+            with open(info_path, mode='r') as info_file:
+                info = json.load(info_file)
+            page_directory = os.path.normpath(os.path.join(directory, info['pages']))
+            page_size = info['page_size']
+            compression = info['compression']
+        else:
+            if page_directory is None:
+                page_directory = os.path.join(directory, "pages")
+            os.makedirs(directory, exist_ok=True)
+            with open(info_path, mode='w') as info_file:
+                json.dump({
+                    'pages': os.path.relpath(page_directory, directory),
+                    'page_size': page_size,
+                    'compression': compression,
+                }, info_file, indent=2)
+
+        os.makedirs(page_directory, exist_ok=True)
+        os.makedirs(os.path.join(directory, MANIFEST_DIRECTORY), exist_ok=True)
+
+        self.directory = directory
+        self.page_directory = page_directory
+        self.page_size = page_size
+        self.compression = compression
+
+        self.__known_pages = set()
+        self.__manifests = dict()
+
+    @property
+    def page_extension(self) -> str:
+        return PAGE_EXTENSIONS[self.compression]
+
+    def _page_path(self, page_hash: str) -> str:
+        return os.path.join(self.page_directory, page_hash[:2], page_hash + self.page_extension)
+
+    def _manifest_path(self, step: int) -> str:
+        return os.path.join(self.directory, MANIFEST_DIRECTORY, "%03d.json" % step)
+
+    def _store_page(self, page: bytes) -> str:
+        page_hash = hashlib.blake2b(page, digest_size=16).hexdigest()
+        if page_hash in self.__known_pages:
+            return page_hash
+
+        page_path = self._page_path(page_hash)
+        if not os.path.exists(page_path):
+            os.makedirs(os.path.dirname(page_path), exist_ok=True)
+            # Write to a temporary name first so runs sharing the page directory never see a partial page.
+            temporary_path = "%s.%d.tmp" % (page_path, os.getpid())
+            with open(temporary_path, mode='wb') as page_file:
+                page_file.write(_compress(page, self.compression))
+            os.replace(temporary_path, page_path)
+
+        self.__known_pages.add(page_hash)
+        return page_hash
+
+    def load_manifest(self, step: int) -> Dict[str, Dict[str, any]]:
+        if step not in self.__manifests:
+            with open(self._manifest_path(step), mode='r') as manifest_file:
+                self.__manifests[step] = json.load(manifest_file)
+        return self.__manifests[step]
+
+    def put(self, step: int, dump_name: str, data: bytes) -> None:
+        """ Store an image (for example naming_things.BEFORE_DUMP_NAME) of the given step. """
+        view = memoryview(data)
+        pages = [self._store_page(bytes(view[i:i + self.page_size])) for i in range(0, len(view), self.page_size)]
+
+        manifest = self.__manifests.setdefault(step, dict())
+        manifest[dump_name] = {'length': len(view), 'pages': pages}
+        with open(self._manifest_path(step), mode='w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        # Only the manifest of the step that is being recorded needs to stay around.
+        for old_step in [x for x in self.__manifests.keys() if x != step]:
+            del self.__manifests[old_step]
+
+    def get(self, step: int, dump_name: str) -> bytes:
+        """ Reconstruct an image of the given step. """
+        image = self.load_manifest(step)[dump_name]
+        pages = []
+        for page_hash in image['pages']:
+            with open(self._page_path(page_hash), mode='rb') as page_file:
+                pages.append(_decompress(page_file.read(), self.compression))
+        data = b"".join(pages)
+        if len(data) != image['length']:
+            raise Exception("Reconstructed image of step %d has the wrong length." % step)
+        return data
+
+    def steps(self) -> List[int]:
+        names = os.listdir(os.path.join(self.directory, MANIFEST_DIRECTORY))
+        return sorted(int(x.rsplit(".", 1)[0]) for x in names if x.endswith(".json"))
+
+    def export(self, out_dir: str) -> List[str]:
+        """ Write all images as %03d_<dump name> files, the layout of a run without a store. """
+        os.makedirs(out_dir, exist_ok=True)
+        written = []
+        for step in self.steps():
+            for dump_name in self.load_manifest(step).keys():
+                out_path = os.path.join(out_dir, "%03d_%s" % (step, dump_name))
+                with open(out_path, mode='wb') as out_file:
+                    out_file.write(self.get(step, dump_name))
+                written.append(out_path)
+        return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconstruct the snapshot images of a run from its snapshot store.")
+    parser.add_argument('snapshot_dir', type=str, help="The snapshot directory of a run.")
+    parser.add_argument('out_dir', type=str, help="Directory to write the reconstructed images to.")
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.snapshot_dir, STORE_INFO_FILE)):
+        print("%s does not contain a snapshot store." % args.snapshot_dir)
+        exit(1)
+
+    store = SnapshotStore(args.snapshot_dir)
+    written = store.export(args.out_dir)
+    print("Reconstructed %d images (%s, %s) into %s" % (
+        len(written), naming_things.BEFORE_DUMP_NAME, naming_things.AFTER_DUMP_NAME, args.out_dir
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import json
+import os
+import shutil
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from utilities.storable import read_header, validation_mode, VALIDATIONS
+from .execution_trace import ExecutionTrace
+from .trace_columns import read_columns, write_columns
+
+# Columns of a trace file are kept next to it in this directory, with the key of the file they were made from and
+# the validation the file passed.
+SIDECAR_SUFFIX = ".columns"
+SIDECAR_KEY = "key.json"
+
+# Set to 0 to always decode traces from their files.
+CACHE_ENVIRONMENT = "D4A_TRACE_CACHE"
+DEFAULT_MAX_TRACES = 8
+
+FileKey = Tuple[int, int, str]
+
+
+def file_key(path: str) -> Optional[FileKey]:
+    """ (size, mtime, sha256 from the header) of a stored trace, None when it has no content hash to rely on. """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, mode='rb') as in_file:
+        header = read_header(in_file)
+    if header is None or 'sha256' not in header:
+        return None
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns, header['sha256']
+
+
+def _cache_enabled() -> bool:
+    return os.environ.get(CACHE_ENVIRONMENT, "1") != "0"
+
+
+class TraceCache:
+    """
+    Keeps the most recently loaded traces in memory, by path and file key.
+
+    A trace is shared by everyone who loads the same file, so loaded traces must be treated as read-only.
+    """
+    max_traces: int
+
+    __traces: 'OrderedDict[Tuple[str, FileKey], ExecutionTrace]'
+
+    def __init__(self, max_traces: int = DEFAULT_MAX_TRACES):
+        self.max_traces = max_traces
+        self.__traces = OrderedDict()
+
+    def get(self, path: str, load: Callable[[], ExecutionTrace]) -> ExecutionTrace:
+        """
+        :param path: File the trace is loaded from, changes to it invalidate the cached trace.
+        :param load: Loads the trace when it is not cached.
+        """
+        key = file_key(path)
+        if key is None or not _cache_enabled():
+            return load()
+
+        cache_key = (os.path.abspath(path), key)
+        execution_trace = self.__traces.get(cache_key, None)
+        if execution_trace is not None:
+            self.__traces.move_to_end(cache_key)
+            return execution_trace
+
+        execution_trace = load()
+        self.__traces[cache_key] = execution_trace
+        while len(self.__traces) > self.max_traces:
+            self.__traces.popitem(last=False)
+        return execution_trace
+
+    def clear(self):
+        self.__traces.clear()
+
+
+TRACE_CACHE = TraceCache()
+
+
+def _read_sidecar(path: str, key: FileKey, validation: str) -> Optional[ExecutionTrace]:
+    sidecar = path + SIDECAR_SUFFIX
+    key_path = os.path.join(sidecar, SIDECAR_KEY)
+    if not os.path.exists(key_path):
+        return None
+    with open(key_path, mode='r') as key_file:
+        stored = json.load(key_file)
+    if tuple(stored['key']) != key:
+        return None
+
+    execution_trace = read_columns(sidecar)
+    # VALIDATIONS goes from strict to loose, only check again what was not checked when the sidecar was written.
+    if VALIDATIONS.index(validation) < VALIDATIONS.index(stored['validation']):
+        if not execution_trace.validate(validation):
+            raise Exception("Refusing to read invalid file.")
+    return execution_trace
+
+
+def _write_sidecar(path: str, key: FileKey, validation: str, execution_trace: ExecutionTrace) -> None:
+    sidecar = path + SIDECAR_SUFFIX
+    try:
+        write_columns(sidecar, execution_trace)
+        with open(os.path.join(sidecar, SIDECAR_KEY), mode='w') as key_file:
+            json.dump({'key': list(key), 'validation': validation}, key_file)
+    except OSError as e:
+        # The cache is only an optimization, the trace was loaded fine.
+        print("Unable to write the trace cache %s: %s" % (sidecar, e))
+        shutil.rmtree(sidecar, ignore_errors=True)
+
+
+def load_trace_file(path: str, validation: Optional[str] = None) -> ExecutionTrace:
+    """
+    Load a trace written by ExecutionTrace.to_file, through the in-memory cache and the columns next to the file.
+
+    The first load decodes the file and stores its columns next to it, later loads memory-map those columns.
+    Traces from the in-memory cache are not validated again, the columns only when the file was validated less
+    strictly when they were written.
+
+    :param validation: See ExecutionTrace.from_file.
+    """
+    def load() -> ExecutionTrace:
+        key = file_key(path)
+        if key is None or not _cache_enabled():
+            return ExecutionTrace.from_file(path, validation=validation)
+
+        mode = validation_mode(validation)
+        execution_trace = _read_sidecar(path, key, mode)
+        if execution_trace is None:
+            execution_trace = ExecutionTrace.from_file(path, validation=mode)
+            _write_sidecar(path, key, mode, execution_trace)
+        return execution_trace
+
+    return TRACE_CACHE.get(path, load)
@@ -0,0 +1,207 @@
+import os
+import shutil
+from collections.abc import Sequence
+from typing import Dict, Optional, Iterator, BinaryIO
+
+import numpy
+
+from .execution_trace import ExecutionTrace, TraceEntry, DeltaList
+
+INSTRUCTIONS = ["str", "ldr"]
+# Entries ColumnWriter buffers before appending them to the raw column files.
+COLUMN_CHUNK_ENTRIES = 4096
+
+ENTRY_COLUMNS = {
+    'instruction': numpy.uint8,
+    'pc': numpy.uint32,
+    'value': numpy.int64,
+    'address': numpy.uint32,
+}
+DELTA_KINDS = ["async", "ignored"]
+DELTA_COLUMNS = {
+    'offsets': numpy.int64,
+    'run_offsets': numpy.int64,
+    'run_start': numpy.uint32,
+    'run_length': numpy.uint32,
+    'anterior': numpy.uint8,
+    'posterior': numpy.uint8,
+}
+
+
+def _column_path(directory: str, name: str) -> str:
+    return os.path.join(directory, name + ".npy")
+
+
+def _raw_path(directory: str, name: str) -> str:
+    return os.path.join(directory, name + ".raw")
+
+
+def write_columns(directory: str, execution_trace: ExecutionTrace) -> None:
+    """
+    Store a trace as one .npy file per column.
+
+    Entries are stored as instruction, pc, value and address columns. The deltas of entry i are the runs
+    run_offsets[i]:run_offsets[i + 1] (run_start and run_length) with the values offsets[i]:offsets[i + 1]
+    (anterior and posterior), separately for the async and the ignored deltas.
+    """
+    column_writer = ColumnWriter(directory)
+    for entry in execution_trace.entries:
+        column_writer.append(entry)
+    column_writer.close()
+
+
+class ColumnWriter:
+    """
+    Stores a trace like write_columns, entry by entry. The columns are written to raw files in chunks and only become
+    .npy files in close(), so the trace never has to be in memory.
+    """
+    directory: str
+
+    __temporary_directory: str
+    __dtypes: Dict[str, type]
+    __chunks: Dict[str, list]
+    __files: Dict[str, BinaryIO]
+    __totals: Dict[str, int]
+    __buffered: int
+
+    def __init__(self, directory: str):
+        """ :param directory: Directory to store the columns in, it is replaced in close(). """
+        self.directory = directory
+        # Write next to the destination and move it in place, a reader never sees a partially written trace.
+        self.__temporary_directory = "%s.%d.tmp" % (directory.rstrip(os.sep), os.getpid())
+        if os.path.isdir(self.__temporary_directory):
+            shutil.rmtree(self.__temporary_directory)
+        os.makedirs(self.__temporary_directory)
+
+        self.__dtypes = dict(ENTRY_COLUMNS)
+        for kind in DELTA_KINDS:
+            for name, dtype in DELTA_COLUMNS.items():
+                self.__dtypes["%s_%s" % (kind, name)] = dtype
+        self.__chunks = {x: [] for x in self.__dtypes}
+        self.__files = {x: open(_raw_path(self.__temporary_directory, x), mode='wb') for x in self.__dtypes}
+        self.__totals = dict()
+        for kind in DELTA_KINDS:
+            for name in ["offsets", "run_offsets"]:
+                self.__totals[kind + "_" + name] = 0
+                self.__chunks[kind + "_" + name].append(0)
+        self.__buffered = 0
+
+    def append(self, entry: TraceEntry):
+        self.__chunks['instruction'].append(INSTRUCTIONS.index(entry.instruction))
+        self.__chunks['pc'].append(entry.pc)
+        self.__chunks['value'].append(entry.value)
+        self.__chunks['address'].append(entry.address)
+        for kind in DELTA_KINDS:
+            delta_list: DeltaList = getattr(entry, kind + "_deltas")
+            self.__total(kind + "_offsets", len(delta_list))
+            self.__total(kind + "_run_offsets", len(delta_list.run_starts))
+            self.__chunks[kind + "_run_start"].append(delta_list.run_starts.tobytes())
+            self.__chunks[kind + "_run_length"].append(delta_list.run_lengths.tobytes())
+            self.__chunks[kind + "_anterior"].append(bytes(delta_list.anterior_values))
+            self.__chunks[kind + "_posterior"].append(bytes(delta_list.posterior_values))
+
+        self.__buffered += 1
+        if self.__buffered >= COLUMN_CHUNK_ENTRIES:
+            self.__flush()
+
+    def __total(self, name: str, count: int):
+        self.__totals[name] += count
+        self.__chunks[name].append(self.__totals[name])
+
+    def __flush(self):
+        for name, chunk in self.__chunks.items():
+            if name in ENTRY_COLUMNS or name.endswith("offsets"):
+                self.__files[name].write(numpy.array(chunk, dtype=self.__dtypes[name]).tobytes())
+            else:
+                # Runs and values are already bytes in the layout of their column.
+                self.__files[name].write(b"".join(chunk))
+            chunk.clear()
+        self.__buffered = 0
+
+    def close(self):
+        """ Turn the raw files into .npy files and move the columns in place. """
+        self.__flush()
+        for name, raw_file in self.__files.items():
+            raw_file.close()
+            raw_path = _raw_path(self.__temporary_directory, name)
+            dtype = numpy.dtype(self.__dtypes[name])
+            with open(_column_path(self.__temporary_directory, name), mode='wb') as column_file:
+                numpy.lib.format.write_array_header_1_0(column_file, {
+                    'descr': numpy.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': (os.path.getsize(raw_path) // dtype.itemsize,),
+                })
+                with open(raw_path, mode='rb') as in_file:
+                    shutil.copyfileobj(in_file, column_file)
+            os.remove(raw_path)
+
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        os.replace(self.__temporary_directory, self.directory)
+
+
+class LazyEntries(Sequence):
+    """ The entries of a columnar trace, every TraceEntry is only built when it is first accessed. """
+    columns: Dict[str, numpy.ndarray]
+
+    __built: Dict[int, TraceEntry]
+
+    def __init__(self, columns: Dict[str, numpy.ndarray]):
+        self.columns = columns
+        self.__built = dict()
+
+    def __len__(self):
+        return len(self.columns['pc'])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Trace entry index out of range")
+
+        # Entries are cached so the same index always gives the same object, like a list would.
+        entry = self.__built.get(index, None)
+        if entry is None:
+            entry = self.build(index)
+            self.__built[index] = entry
+        return entry
+
+    def build(self, index: int) -> TraceEntry:
+        """ A new entry for the index, that is not cached. """
+        return TraceEntry(
+            INSTRUCTIONS[self.columns['instruction'][index]],
+            int(self.columns['pc'][index]),
+            int(self.columns['value'][index]),
+            int(self.columns['address'][index]),
+            self._deltas("async", index),
+            self._deltas("ignored", index),
+        )
+
+    def _deltas(self, kind: str, index: int) -> DeltaList:
+        start, end = self.columns[kind + "_offsets"][index:index + 2].tolist()
+        run_start, run_end = self.columns[kind + "_run_offsets"][index:index + 2].tolist()
+        return DeltaList.from_run_arrays(
+            self.columns[kind + "_run_start"][run_start:run_end],
+            self.columns[kind + "_run_length"][run_start:run_end],
+            self.columns[kind + "_anterior"][start:end],
+            self.columns[kind + "_posterior"][start:end],
+        )
+
+
+def read_columns(directory: str, mmap_mode: Optional[str] = 'r') -> ExecutionTrace:
+    """ Load a trace stored by write_columns, the columns are memory-mapped and entries are built on access. """
+    names = list(ENTRY_COLUMNS.keys()) + ["%s_%s" % (x, y) for x in DELTA_KINDS for y in DELTA_COLUMNS.keys()]
+    columns = {x: numpy.load(_column_path(directory, x), mmap_mode=mmap_mode) for x in names}
+
+    execution_trace = ExecutionTrace()
+    execution_trace.entries = LazyEntries(columns)
+    return execution_trace
+
+
+def iter_columns(directory: str) -> Iterator[TraceEntry]:
+    """ The entries of a trace stored by write_columns one by one, they are not kept in memory. """
+    entries: LazyEntries = read_columns(directory).entries
+    for index in range(len(entries)):
+        yield entries.build(index)
@@ -0,0 +1,164 @@
+import weakref
+from typing import Dict, List, Iterable, Optional
+
+import numpy
+
+from .dma_summary import summarize_trace
+from .execution_trace import ExecutionTrace, TraceEntry
+from .trace_columns import LazyEntries
+
+
+class DmaStep:
+    """ A step of a trace with asynchronous memory changes, with the bounds of those changes. """
+    __slots__ = ('index', 'low', 'high', 'byte_count')
+
+    index: int
+    # Lowest changed address, and one past the highest.
+    low: int
+    high: int
+    byte_count: int
+
+    def __init__(self, index: int, low: int, high: int, byte_count: int):
+        self.index = index
+        self.low = low
+        self.high = high
+        self.byte_count = byte_count
+
+    def __repr__(self):
+        return 'DMA at step %d: %d bytes in [0x%08X, 0x%08X)' % (self.index, self.byte_count, self.low, self.high)
+
+
+class ColumnLookup:
+    """ The steps of every value of a column, from one stable sort, so the steps of a value are in trace order. """
+    values: numpy.ndarray
+
+    __order: numpy.ndarray
+    __starts: numpy.ndarray
+    __ends: numpy.ndarray
+
+    def __init__(self, column: numpy.ndarray):
+        self.__order = numpy.argsort(column, kind='stable')
+        self.values, self.__starts = numpy.unique(column[self.__order], return_index=True)
+        self.__ends = numpy.append(self.__starts[1:], len(column))
+
+    def indices(self, value: int) -> List[int]:
+        position = int(numpy.searchsorted(self.values, value))
+        if position == len(self.values) or self.values[position] != value:
+            return []
+        return self.__order[self.__starts[position]:self.__ends[position]].tolist()
+
+    def indices_between(self, low: int, high: int) -> List[int]:
+        """ Steps with a value in [low, high], in trace order. """
+        first = int(numpy.searchsorted(self.values, low, side='left'))
+        last = int(numpy.searchsorted(self.values, high, side='right'))
+        if first >= last:
+            return []
+        return numpy.sort(self.__order[self.__starts[first]:self.__ends[last - 1]]).tolist()
+
+
+class TraceIndex:
+    """
+    Lookups over a trace, built in one pass so analyzers do not have to scan the entries again.
+
+    Indices are returned in trace order. The index is a snapshot, use index_trace to get one that is rebuilt when
+    entries were appended. For a trace read from columns the index is built from the pc, address and value columns,
+    entries are only built when they are asked for.
+    """
+    execution_trace: ExecutionTrace
+    length: int
+
+    pcs: numpy.ndarray
+    addresses: numpy.ndarray
+    values: numpy.ndarray
+    dma_steps: List[DmaStep]
+
+    __by_pc: ColumnLookup
+    __by_address: ColumnLookup
+    __by_value: ColumnLookup
+    __positions: Dict[int, int]
+
+    def __init__(self, execution_trace: ExecutionTrace):
+        self.execution_trace = execution_trace
+        self.__positions = dict()
+
+        entries = execution_trace.entries
+        if isinstance(entries, LazyEntries):
+            self.pcs = numpy.asarray(entries.columns['pc'], dtype=numpy.int64)
+            self.addresses = numpy.asarray(entries.columns['address'], dtype=numpy.int64)
+            self.values = numpy.asarray(entries.columns['value'], dtype=numpy.int64)
+        else:
+            self.pcs = numpy.fromiter((x.pc for x in entries), dtype=numpy.int64, count=len(entries))
+            self.addresses = numpy.fromiter((x.address for x in entries), dtype=numpy.int64, count=len(entries))
+            self.values = numpy.fromiter((x.value for x in entries), dtype=numpy.int64, count=len(entries))
+            for index, entry in enumerate(entries):
+                # Entries are looked up by identity, like list.index finds the entry itself (entries have no __eq__).
+                self.__positions[id(entry)] = index
+
+        self.__by_pc = ColumnLookup(self.pcs)
+        self.__by_address = ColumnLookup(self.addresses)
+        self.__by_value = ColumnLookup(self.values)
+
+        dma_summary = summarize_trace(execution_trace)
+        self.dma_steps = []
+        for index in dma_summary.dma_steps:
+            low, high = dma_summary.bounds(index)
+            self.dma_steps.append(DmaStep(index, low, high, dma_summary.delta_count(index)))
+
+        self.length = len(self.pcs)
+
+    def __len__(self):
+        return self.length
+
+    def entry(self, index: int) -> TraceEntry:
+        entry = self.execution_trace.entries[index]
+        self.__positions[id(entry)] = index
+        return entry
+
+    def entries(self, indices: Iterable[int]) -> List[TraceEntry]:
+        return [self.entry(x) for x in indices]
+
+    def index_of(self, entry: TraceEntry) -> int:
+        """
+        Position of an entry of this trace, raises ValueError for other entries like list.index. Entries of a trace
+        read from columns are only known once they were returned by entry() or entries().
+        """
+        index = self.__positions.get(id(entry), None)
+        if index is None or self.execution_trace.entries[index] is not entry:
+            raise ValueError("Entry is not in the trace.")
+        return index
+
+    def indices_at_pc(self, pc: int) -> List[int]:
+        return self.__by_pc.indices(pc)
+
+    def indices_at_address(self, address: int) -> List[int]:
+        return self.__by_address.indices(address)
+
+    def indices_with_value(self, value: int) -> List[int]:
+        return self.__by_value.indices(value)
+
+    def indices_with_values(self, values: Iterable[int], end: Optional[int] = None) -> List[int]:
+        """ Steps that have any of the values, up to and including the step `end`. """
+        indices = set()
+        for value in set(values):
+            indices.update(self.__by_value.indices(value))
+        return sorted(x for x in indices if end is None or x <= end)
+
+    def indices_with_values_between(self, low: int, high: int, end: Optional[int] = None) -> List[int]:
+        """ Steps with a value in [low, high], up to and including the step `end`. """
+        return [x for x in self.__by_value.indices_between(low, high) if end is None or x <= end]
+
+    def dma_steps_between(self, start: int, end: int) -> List[DmaStep]:
+        """ DMA steps with start <= index < end. """
+        return [x for x in self.dma_steps if start <= x.index < end]
+
+
+_indices: 'weakref.WeakKeyDictionary[ExecutionTrace, TraceIndex]' = weakref.WeakKeyDictionary()
+
+
+def index_trace(execution_trace: ExecutionTrace) -> TraceIndex:
+    """ The index of a trace, it is built once and again only when the number of entries changed. """
+    trace_index = _indices.get(execution_trace, None)
+    if trace_index is None or trace_index.length != len(execution_trace.entries):
+        trace_index = TraceIndex(execution_trace)
+        _indices[execution_trace] = trace_index
+    return trace_index
@@ -1,9 +1,18 @@
+import json
 import os
-from typing import List
+import shutil
+from typing import List, Dict, Optional, TextIO, Union, Iterator
 
 from . import ExecutionTrace, MemoryDelta, TraceEntry
+from .execution_trace import DeltaList
+from .trace_columns import read_columns, write_columns, iter_columns, ColumnWriter
+from .trace_cache import TRACE_CACHE, SIDECAR_SUFFIX, load_trace_file
+from .dma_summary import DmaSummary, summarize_trace, attach_summary
 
 RECORDING_JSON = "trace.json"
+RECORDING_JSONL = "trace.jsonl"
+RECORDING_COLUMNS = "trace_columns"
+DMA_SUMMARY = "dma_summary.npz"
 HUMAN_CSV = "trace_hr.csv"
 
 CSV_ITEMS = [
@@ -16,6 +25,10 @@ CSV_ITEMS = [
     ("#ignore", 8, "%d"),
 ]
 
+# Flush the logs after every entry, so a killed recording loses nothing.
+FLUSH_EVERY_ENTRY = 1
+WRITE_BUFFER_SIZE = 0x10000
+
 
 # def csv_reset(base_path: str):
 #     regular = path.join(base_path, RECORDING_CSV)
@@ -62,32 +75,201 @@ CSV_ITEMS = [
 #             "None" if ignored_delta is None else ignored_delta_json,
 #         ))
 
+def entry_to_record(trace_entry: TraceEntry) -> Dict[str, any]:
+    return {
+        'instruction': trace_entry.instruction,
+        'pc': trace_entry.pc,
+        'value': trace_entry.value,
+        'address': trace_entry.address,
+        'async_runs': trace_entry.async_deltas.to_rows(),
+        'ignored_runs': trace_entry.ignored_deltas.to_rows(),
+    }
+
+
+def record_to_entry(record: Dict[str, any]) -> TraceEntry:
+    if 'async_runs' not in record:
+        # Records with one [address, anterior, posterior] row per byte.
+        return TraceEntry(
+            record['instruction'], record['pc'], record['value'], record['address'],
+            [MemoryDelta(*x) for x in record['async_deltas']],
+            [MemoryDelta(*x) for x in record['ignored_deltas']],
+        )
+    return TraceEntry(
+        record['instruction'], record['pc'], record['value'], record['address'],
+        DeltaList.from_rows(record['async_runs']),
+        DeltaList.from_rows(record['ignored_runs']),
+    )
+
+
+def iter_trace_records(path: str) -> Iterator[TraceEntry]:
+    """
+    The entries of a streamed trace one by one, also when the recording died halfway.
+
+    :param path: Path to a RECORDING_JSONL file.
+    """
+    with open(path, mode='r') as jsonl_file:
+        for line in jsonl_file:
+            if not line.endswith("\n"):
+                print("Skipping a partially written trace record in %s" % path)
+                break
+            yield record_to_entry(json.loads(line))
+
+
+def read_trace_records(path: str) -> ExecutionTrace:
+    """
+    Read a streamed trace, also when the recording died halfway.
+
+    :param path: Path to a RECORDING_JSONL file.
+    :return: A trace with every complete record, a partially written last line is skipped.
+    """
+    execution_trace = ExecutionTrace()
+    for entry in iter_trace_records(path):
+        execution_trace.append(entry)
+    return execution_trace
+
+
+def iter_trace(directory: str) -> Iterator[TraceEntry]:
+    """
+    The entries of the trace of a recording one by one, without keeping them in memory.
+
+    The memory-mapped columns are used when present, otherwise the streamed records. The JSON export can only be read
+    as a whole, use load_trace for recordings that only have that.
+    """
+    columns_path = os.path.join(directory, RECORDING_COLUMNS)
+    jsonl_path = os.path.join(directory, RECORDING_JSONL)
+    if os.path.isdir(columns_path):
+        return iter_columns(columns_path)
+    if os.path.exists(jsonl_path):
+        return iter_trace_records(jsonl_path)
+    raise Exception("%s has no trace that can be streamed." % directory)
+
+
+def load_trace(directory: str) -> ExecutionTrace:
+    """
+    Load the trace of a recording.
+
+    The memory-mapped columns are used when present, then the JSON export, and for a recording that did not finish
+    the streamed records. Finished recordings are kept in the trace cache, treat the trace as read-only.
+    """
+    columns_path = os.path.join(directory, RECORDING_COLUMNS)
+    json_path = os.path.join(directory, RECORDING_JSON)
+    jsonl_path = os.path.join(directory, RECORDING_JSONL)
+
+    def load() -> ExecutionTrace:
+        if os.path.isdir(columns_path):
+            execution_trace = read_columns(columns_path)
+            summary_path = os.path.join(directory, DMA_SUMMARY)
+            if os.path.exists(summary_path):
+                dma_summary = DmaSummary.from_file(summary_path)
+                # A summary of another recording in the same directory is computed again when it is needed.
+                if len(dma_summary) == len(execution_trace.entries):
+                    attach_summary(execution_trace, dma_summary)
+            return execution_trace
+        if (os.path.exists(json_path) and os.path.getsize(json_path) > 0) or not os.path.exists(jsonl_path):
+            return load_trace_file(json_path)
+        print("%s is missing or empty, loading the partial trace from %s" % (RECORDING_JSON, RECORDING_JSONL))
+        return read_trace_records(jsonl_path)
+
+    return TRACE_CACHE.get(json_path, load)
+
+
+def load_dma_summary(directory: str) -> DmaSummary:
+    """
+    The DMA summary of a recording. It is computed from the trace for recordings made without one, and when the
+    stored one does not cover the trace, e.g. it is left from an earlier recording in the same directory.
+    """
+    execution_trace = load_trace(directory)
+    summary_path = os.path.join(directory, DMA_SUMMARY)
+    if os.path.exists(summary_path):
+        dma_summary = DmaSummary.from_file(summary_path)
+        if len(dma_summary) == len(execution_trace.entries):
+            attach_summary(execution_trace, dma_summary)
+            return dma_summary
+    return summarize_trace(execution_trace)
+
+
 class ExecutionLogger:
+    """
+    Logs the trace of a recording.
+
+    Every entry is streamed to RECORDING_JSONL as it is added, so a recording that is killed keeps everything up to
+    its last flush. The full trace is only written to RECORDING_JSON by finalize().
+    """
     execution_trace: ExecutionTrace
     directory: str
     human_readable_file: str
     machine_readable_file: str
+    record_file: str
+
+    flush_every: int
+    keep_entries: Optional[int]
 
-    def __init__(self, output_directory: str):
+    __entry_count: int
+    __unflushed: int
+    __csv_handle: Optional[TextIO]
+    __record_handle: Optional[TextIO]
+
+    def __init__(self, output_directory: str, flush_every: int = FLUSH_EVERY_ENTRY,
+                 keep_entries: Optional[int] = None):
+        """
+        :param output_directory: Directory to write the logs to.
+        :param flush_every: Flush the logs after this many entries (0 to only flush in finalize()).
+        :param keep_entries: Only keep this many of the latest entries in memory (None to keep all of them). At least
+            one, the latest entry is used to check the abort conditions.
+        """
+        if keep_entries is not None and keep_entries < 1:
+            raise Exception("At least the latest trace entry has to be kept in memory, got %d." % keep_entries)
         self.execution_trace = ExecutionTrace()
+        # Covers every entry, also the ones that are no longer kept in memory.
+        self.dma_summary = DmaSummary()
         self.directory = output_directory
         self.human_readable_file = os.path.join(self.directory, HUMAN_CSV)
         self.machine_readable_file = os.path.join(self.directory, RECORDING_JSON)
+        self.record_file = os.path.join(self.directory, RECORDING_JSONL)
+
+        self.flush_every = flush_every
+        self.keep_entries = keep_entries
+
+        self.__entry_count = 0
+        self.__unflushed = 0
+        self.__csv_handle = None
+        self.__record_handle = None
+
+    @property
+    def entry_count(self) -> int:
+        """ Number of entries logged so far, including the ones that no longer are in memory. """
+        return self.__entry_count
+
+    @property
+    def last_entry(self) -> TraceEntry:
+        return self.execution_trace.entries[-1]
 
     def initialize(self):
+        # A previous recording in this directory must not be taken for this one if it dies before finalize().
+        for stale in [os.path.join(self.directory, RECORDING_COLUMNS), self.machine_readable_file + SIDECAR_SUFFIX]:
+            if os.path.isdir(stale):
+                shutil.rmtree(stale)
+        summary_path = os.path.join(self.directory, DMA_SUMMARY)
+        if os.path.exists(summary_path):
+            os.remove(summary_path)
+
         header_string = ", ".join(["%*s" % (x[1], x[0]) for x in CSV_ITEMS])
-        with open(self.human_readable_file, mode='w') as csv_file:
-            csv_file.write(header_string)
-            csv_file.write("\n")
+        self.__csv_handle = open(self.human_readable_file, mode='w', buffering=WRITE_BUFFER_SIZE)
+        self.__csv_handle.write(header_string)
+        self.__csv_handle.write("\n")
+        self.__record_handle = open(self.record_file, mode='w', buffering=WRITE_BUFFER_SIZE)
 
         with open(self.machine_readable_file, mode='w') as json_file:
             json_file.write("")
 
     def add_entry(self, instruction: str, pc: int, value: int, address: int,
-                  async_deltas: List[MemoryDelta], ignored_deltas: List[MemoryDelta]):
+                  async_deltas: Union[DeltaList, List[MemoryDelta]],
+                  ignored_deltas: Union[DeltaList, List[MemoryDelta]]):
         trace_entry = TraceEntry(instruction, pc, value, address, async_deltas, ignored_deltas)
-        new_index = len(self.execution_trace.entries)
+        new_index = self.__entry_count
         self.execution_trace.append(trace_entry)
+        self.dma_summary.append(trace_entry)
+        self.__entry_count += 1
 
         args = [new_index, instruction, pc, value, address, len(async_deltas), len(ignored_deltas)]
         sizes = [x[1] for x in CSV_ITEMS]
@@ -95,9 +277,43 @@ class ExecutionLogger:
         formatted = [x[0] % x[1] for x in zip(formats, args)]
         sized = ["%*s" % (x[0], x[1]) for x in zip(sizes, formatted)]
         entry_string = ", ".join(sized)
-        with open(self.human_readable_file, mode='a') as csv_file:
-            csv_file.write(entry_string)
-            csv_file.write("\n")
+        self.__csv_handle.write(entry_string)
+        self.__csv_handle.write("\n")
+
+        self.__record_handle.write(json.dumps(entry_to_record(trace_entry)))
+        self.__record_handle.write("\n")
+
+        self.__unflushed += 1
+        if self.flush_every > 0 and self.__unflushed >= self.flush_every:
+            self.flush()
+
+        # Older entries are on disk already, they can be dropped from memory.
+        if self.keep_entries is not None and len(self.execution_trace.entries) > self.keep_entries:
+            del self.execution_trace.entries[:len(self.execution_trace.entries) - self.keep_entries]
+
+    def flush(self):
+        self.__csv_handle.flush()
+        self.__record_handle.flush()
+        self.__unflushed = 0
 
     def finalize(self):
-        ExecutionTrace.to_file(self.machine_readable_file, self.execution_trace)
+        self.flush()
+        self.__csv_handle.close()
+        self.__record_handle.close()
+
+        columns_path = os.path.join(self.directory, RECORDING_COLUMNS)
+        if self.keep_entries is not None and len(self.execution_trace.entries) < self.__entry_count:
+            # Not every entry is in memory, stream the records into the JSON export and the columns at once.
+            column_writer = ColumnWriter(columns_path)
+
+            def entries() -> Iterator[TraceEntry]:
+                for entry in iter_trace_records(self.record_file):
+                    column_writer.append(entry)
+                    yield entry
+
+            ExecutionTrace.to_file_streamed(self.machine_readable_file, entries())
+            column_writer.close()
+        else:
+            ExecutionTrace.to_file(self.machine_readable_file, self.execution_trace)
+            write_columns(columns_path, self.execution_trace)
+        self.dma_summary.to_file(os.path.join(self.directory, DMA_SUMMARY))
@@ -0,0 +1,131 @@
+import os
+from typing import Optional, Dict, Any
+
+from utilities.storable import read_header, artifact_directory, VALIDATION_CHECKSUM
+from .execution_trace import ExecutionTrace
+from . import trace_logging
+from .trace_cache import load_trace_file
+
+
+def _stored_sha256(path: str) -> Optional[str]:
+    """ The payload hash in the header of a stored trace, None for files without one. """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, mode='rb') as in_file:
+        header = read_header(in_file)
+    if header is None:
+        return None
+    return header.get('sha256', None)
+
+
+def _relative_path(path: str) -> str:
+    """
+    The path relative to the artifact being written, so a work directory can be moved or copied as a whole. Absolute
+    when there is no artifact, or no relative path to it (another drive).
+    """
+    directory = artifact_directory()
+    if directory is None:
+        return path
+    try:
+        return os.path.relpath(path, directory)
+    except ValueError:
+        return path
+
+
+def _resolve_path(path: str, absolute_path: Optional[str]) -> str:
+    """ A stored path resolved against the artifact being read, the absolute path when the trace is not there. """
+    directory = artifact_directory()
+    if os.path.isabs(path) or directory is None:
+        return path
+    resolved = os.path.normpath(os.path.join(directory, path))
+    if not os.path.exists(resolved) and absolute_path is not None and os.path.exists(absolute_path):
+        return absolute_path
+    return resolved
+
+
+class TraceReference:
+    """
+    A trace that is stored in its own file, identified by the path and the sha256 of its content.
+
+    Artifacts store the reference instead of the trace, so several of them can share one trace on disk. The trace is
+    only loaded when it is first accessed. A reference without a path holds a trace that is only in memory, it is
+    embedded when the artifact is stored.
+    """
+    path: Optional[str]
+    sha256: Optional[str]
+
+    __trace: Optional[ExecutionTrace]
+
+    def __init__(self, path: Optional[str], sha256: Optional[str], execution_trace: Optional[ExecutionTrace] = None):
+        self.path = path
+        self.sha256 = sha256
+        self.__trace = execution_trace
+
+    @classmethod
+    def of_trace(cls, execution_trace: ExecutionTrace) -> 'TraceReference':
+        return TraceReference(None, None, execution_trace)
+
+    @classmethod
+    def of_file(cls, path: str) -> 'TraceReference':
+        """ Reference a trace written by ExecutionTrace.to_file. """
+        sha256 = _stored_sha256(path)
+        if sha256 is None:
+            raise Exception("%s has no content hash and can not be referenced." % path)
+        return TraceReference(os.path.abspath(path), sha256)
+
+    @classmethod
+    def of_recording(cls, directory: str) -> 'TraceReference':
+        """
+        Reference the trace of a recording, it is loaded through trace_logging.load_trace.
+
+        Recordings that did not finish have no stored trace to refer to, their trace is loaded and embedded instead.
+        """
+        path = os.path.join(directory, trace_logging.RECORDING_JSON)
+        if _stored_sha256(path) is None:
+            return TraceReference.of_trace(trace_logging.load_trace(directory))
+        return TraceReference.of_file(path)
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.__trace is not None
+
+    @property
+    def trace(self) -> ExecutionTrace:
+        if self.__trace is None:
+            self.__trace = self.__load()
+        return self.__trace
+
+    def __load(self) -> ExecutionTrace:
+        if self.path is None:
+            raise Exception("Trace reference without a trace.")
+        if _stored_sha256(self.path) != self.sha256:
+            raise Exception("%s changed since it was referenced." % self.path)
+
+        # The trace of a recording is also stored as columns, which are memory-mapped instead of decoded.
+        if os.path.basename(self.path) == trace_logging.RECORDING_JSON:
+            return trace_logging.load_trace(os.path.dirname(self.path))
+        return load_trace_file(self.path, validation=VALIDATION_CHECKSUM)
+
+    def is_sane(self) -> bool:
+        if self.path is None:
+            return self.__trace is not None
+        return isinstance(self.path, str) and isinstance(self.sha256, str)
+
+    def to_record(self) -> Dict[str, Any]:
+        """ The path and hash, or the embedded trace for a reference without a path. """
+        if self.path is None:
+            return {'execution_trace': self.trace.to_record()}
+        return {'path': _relative_path(self.path), 'absolute_path': self.path, 'sha256': self.sha256}
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> 'TraceReference':
+        if 'execution_trace' in record:
+            return TraceReference.of_trace(
+                ExecutionTrace.from_record(record['execution_trace'], ExecutionTrace.SCHEMA_VERSION)
+            )
+        return TraceReference(_resolve_path(record['path'], record.get('absolute_path', None)), record['sha256'])
+
+    def __repr__(self):
+        if self.path is None:
+            return 'TraceReference to a trace in memory'
+        return 'TraceReference to %s (sha256 %s)' % (self.path, self.sha256)
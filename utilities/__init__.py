@@ -1,6 +1,8 @@
 from .storable import Storable
 from .timeout import TimeOut
-from .argument_parsing import auto_int
+from .region_index import RegionIndex
+from .profiler import StageProfiler
+from .argument_parsing import auto_int, positive_int
 from .naming_things import setup_directory
 from .ykush_helper import restart_connected_devices
 
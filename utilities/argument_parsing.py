@@ -1,3 +1,4 @@
+import argparse
 import csv
 import json
 from typing import List, Dict
@@ -7,6 +8,13 @@ def auto_int(x):
     return int(x, 0)
 
 
+def positive_int(x):
+    value = int(x)
+    if value < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive number" % x)
+    return value
+
+
 # def parse_dma_info(dma_info_file):
 #     with open(dma_info_file, mode='r') as json_file:
 #         dma_info = json.load(json_file)
@@ -0,0 +1,86 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import jsonpickle
+
+from phases.recorder import ExecutionTrace, TraceEntry, DeltaList, DeltaRun
+from utilities import storable
+from utilities.storable import Storable
+
+
+def synthetic_trace(entry_count: int, deltas_per_entry: int, seed: int = 0) -> ExecutionTrace:
+    """ A trace with entry_count entries that each have a run of deltas_per_entry async deltas. """
+    rng = random.Random(seed)
+    execution_trace = ExecutionTrace()
+    for _ in range(entry_count):
+        address = rng.randrange(0x20000000, 0x20010000)
+        anterior = bytes(rng.randrange(256) for _ in range(deltas_per_entry))
+        posterior = bytes(rng.randrange(256) for _ in range(deltas_per_entry))
+        execution_trace.append(TraceEntry(
+            rng.choice(["str", "ldr"]), rng.randrange(0x08000000, 0x08010000), rng.randrange(1 << 32),
+            rng.randrange(0x40000000, 0x40010000),
+            DeltaList.from_runs([DeltaRun(address, anterior, posterior)]) if deltas_per_entry > 0 else DeltaList(),
+            DeltaList(),
+        ))
+    return execution_trace
+
+
+def _time(function, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(data: Storable, directory: str, repeat: int) -> None:
+    cls = data.__class__
+    path = os.path.join(directory, "benchmark")
+
+    def write_jsonpickle():
+        with open(path, mode='w') as out_file:
+            out_file.write(jsonpickle.encode(data, indent=2))
+
+    def read_jsonpickle():
+        with open(path, mode='r') as in_file:
+            jsonpickle.decode(in_file.read())
+
+    print("%-10s %12s %12s %12s" % ("encoding", "write [s]", "read [s]", "size [B]"))
+    write_time = _time(write_jsonpickle, repeat)
+    read_time = _time(read_jsonpickle, repeat)
+    print("%-10s %12.4f %12.4f %12d" % ("jsonpickle", write_time, read_time, os.path.getsize(path)))
+
+    for encoding in storable.ENCODINGS:
+        if encoding == storable.ENCODING_MSGPACK and storable.msgpack is None:
+            print("%-10s %12s" % (encoding, "not installed"))
+            continue
+        write_time = _time(lambda: cls.to_file(path, data, encoding=encoding), repeat)
+        read_time = _time(lambda: cls.from_file(path), repeat)
+        print("%-10s %12.4f %12.4f %12d" % (encoding, write_time, read_time, os.path.getsize(path)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare jsonpickle with the schema based encodings of Storable.")
+    parser.add_argument('--artifact', type=str, default=None,
+                        help="Existing trace, DMA info or peripheral row to benchmark instead of a synthetic trace.")
+    parser.add_argument('--entries', type=int, default=10000, help="Entries of the synthetic trace.")
+    parser.add_argument('--deltas', type=int, default=4, help="Async deltas per entry of the synthetic trace.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per measurement, the fastest is reported.")
+    args = parser.parse_args()
+
+    if args.artifact is not None:
+        data = Storable.from_file(args.artifact)
+    else:
+        data = synthetic_trace(args.entries, args.deltas)
+
+    with tempfile.TemporaryDirectory() as directory:
+        benchmark(data, directory, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
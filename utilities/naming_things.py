@@ -29,22 +29,28 @@ PHASE_NAMES: List[str] = [
 ]
 
 MEMORY_SNAPSHOT_DIRECTORY = "snapshots"
+SNAPSHOT_PAGES_DIRECTORY = "snapshot_pages"
 AVATAR_OUTPUT_DIRECTORY = "avatar_output"
 
 # File names
 LAST_FLASH_MARKER = "last_flash"
+INSTRUCTION_CACHE_TEMPLATE = "instruction_cache_%s.json"
 
 BEFORE_DUMP_NAME = "anterior.bin"
 AFTER_DUMP_NAME = "posterior.bin"
 EXIT_REASON_FILE = "exit_reason.txt"
+POISON_JSON = "poison.json"
+PROFILE_JSON = "profile.json"
 DMA_INFO_JSON = "dma_info.json"
 DMA_INFO_HR_JSON = "dma_info_hr.json"
+DMA_INCIDENCE_TEMPLATE = "dma_info_incidence_%d.json"
 REPORT_MD = "report.md"
 CSV_LINE_FILE_NAME = "single_csv_line.csv"
 
 # PERIPHERAL_CSV_NAME = "peripherals.csv"
 PERIPHERAL_JSON_NAME = "peripherals.json"
 PERIPHERAL_JSON_HR_NAME = "peripherals_hr.json"
+EPSILON_SWEEP_CSV = "epsilon_sweep.csv"
 
 
 # Exit reason strings
@@ -64,5 +70,13 @@ def setup_directory(base_path: str, phase_id: int) -> str:
     return dir_path
 
 
+def create_instruction_cache_name(firmware_digest: str):
+    return INSTRUCTION_CACHE_TEMPLATE % firmware_digest[:16]
+
+
+def create_dma_incidence_name(number: int):
+    return DMA_INCIDENCE_TEMPLATE % number
+
+
 def create_peripheral_run_name(peripheral_base: int):
     return "run_x%08X" % peripheral_base
@@ -0,0 +1,60 @@
+import json
+import time
+from typing import Dict, List
+
+import numpy
+
+
+def _summarize(samples: List[int]) -> Dict[str, float]:
+    values = numpy.asarray(samples)
+    return {
+        'count': len(samples),
+        'total': int(values.sum()),
+        'p50': float(numpy.percentile(values, 50)),
+        'p95': float(numpy.percentile(values, 95)),
+        'max': int(values.max()),
+    }
+
+
+class StageProfiler:
+    """
+    Collects how long every stage of a repeated piece of work takes, and other per-iteration counts.
+
+    Stages are timed with laps so timing a sequence of stages costs one perf_counter_ns call per stage:
+        t = profiler.start()
+        ...
+        t = profiler.lap('first stage', t)
+    """
+    __timings: Dict[str, List[int]]
+    __counts: Dict[str, List[int]]
+
+    def __init__(self):
+        self.__timings = dict()
+        self.__counts = dict()
+
+    @staticmethod
+    def start() -> int:
+        return time.perf_counter_ns()
+
+    def lap(self, stage: str, since: int) -> int:
+        """ Record the time since `since` for the stage, returns the current time to be used for the next lap. """
+        now = time.perf_counter_ns()
+        self.__timings.setdefault(stage, []).append(now - since)
+        return now
+
+    def count(self, name: str, amount: int) -> None:
+        self.__counts.setdefault(name, []).append(amount)
+
+    def counts(self, name: str) -> List[int]:
+        return self.__counts.get(name, [])
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """ count, total, p50, p95 and max per stage (in nanoseconds) and per count, in the order first recorded. """
+        return {
+            'stages_ns': {k: _summarize(v) for k, v in self.__timings.items()},
+            'counts': {k: _summarize(v) for k, v in self.__counts.items()},
+        }
+
+    def to_file(self, path: str) -> None:
+        with open(path, mode='w') as out_file:
+            json.dump(self.summary(), out_file, indent=2)
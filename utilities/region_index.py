@@ -0,0 +1,56 @@
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+from intervaltree import IntervalTree
+
+
+class RegionIndex:
+    """
+    Address regions compiled into an interval tree for O(log n) point and range lookups.
+
+    Regions are given as (start, size, ...) tuples, anything after the size is returned with the region on a lookup.
+    When regions overlap, the one that came first in the list wins, like a linear scan over the list would.
+    """
+    name: str
+    regions: List[Tuple]
+
+    __tree: IntervalTree
+
+    def __init__(self, regions: Iterable[Sequence[Any]], name: str = "region"):
+        """
+        :param regions: (start, size, ...) tuples, regions with a negative start or an empty size are ignored.
+        :param name: Name of the kind of region, used when reporting ignored regions.
+        """
+        self.name = name
+        self.regions = []
+        self.__tree = IntervalTree()
+
+        for region in regions:
+            region = tuple(region)
+            if region[0] < 0 or region[1] <= 0:
+                print("Ignoring %s at %d of size %d" % (name, region[0], region[1]))
+                continue
+            self.__tree.addi(region[0], region[0] + region[1], (len(self.regions), region))
+            self.regions.append(region)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def find(self, address: int) -> Optional[Tuple]:
+        """ Return the first region that contains the address, or None. """
+        matches = self.__tree[address]
+        if len(matches) == 0:
+            return None
+        return min(x.data for x in matches)[1]
+
+    def contains(self, address: int) -> bool:
+        return len(self.__tree[address]) > 0
+
+    def overlaps(self, start: int, end: int) -> bool:
+        """ Test if any region overlaps the range [start, end). """
+        return start < end and self.__tree.overlaps(start, end)
+
+    def overlapping(self, start: int, end: int) -> List[Tuple]:
+        """ All regions that overlap the range [start, end), in the order they were given. """
+        if start >= end:
+            return []
+        return [x.data[1] for x in sorted(self.__tree[start:end], key=lambda x: x.data[0])]
@@ -1,39 +1,256 @@
 import abc
-from typing import Optional
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+from contextvars import ContextVar
+from typing import Optional, Dict, Type, Any, Iterable
 
 import jsonpickle
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Files written with a schema start with this marker and a one line json header: {"type", "version", "encoding"}.
+HEADER_MARKER = b"#storable "
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+ENCODINGS = [ENCODING_JSON, ENCODING_MSGPACK]
+
+# How much of an object is checked when it is written or read:
+#  full: is_sane on everything.
+#  sampled: is_sane_sampled, e.g. only a sample of the entries of a trace.
+#  checksum: no checks, only the sha256 of the payload stored in the header is compared on reading.
+#            Files without a checksum are validated as sampled.
+VALIDATION_FULL = "full"
+VALIDATION_SAMPLED = "sampled"
+VALIDATION_CHECKSUM = "checksum"
+VALIDATIONS = [VALIDATION_FULL, VALIDATION_SAMPLED, VALIDATION_CHECKSUM]
+
+# When set, this overrides the validation chosen by the call site.
+VALIDATION_ENVIRONMENT = "D4A_VALIDATION"
+DEFAULT_SAMPLE_SIZE = 64
+
+
+def validation_mode(validation: Optional[str] = None) -> str:
+    """ Resolve the validation to use, the environment setting wins over the call site, which wins over full. """
+    validation = os.environ.get(VALIDATION_ENVIRONMENT, None) or validation or VALIDATION_FULL
+    if validation not in VALIDATIONS:
+        raise Exception("Unknown validation: %s (one of %s)" % (validation, ", ".join(VALIDATIONS)))
+    return validation
+
+
+# Directory of the file to_file or from_file is working on, while it converts records.
+_artifact_directory: ContextVar[Optional[str]] = ContextVar('artifact_directory', default=None)
+
+
+def artifact_directory() -> Optional[str]:
+    """ Directory of the file that is being written or read, so records can store paths relative to it. """
+    return _artifact_directory.get()
+
+
+@contextlib.contextmanager
+def _working_on(path: str):
+    token = _artifact_directory.set(os.path.dirname(os.path.abspath(path)))
+    try:
+        yield
+    finally:
+        _artifact_directory.reset(token)
+
+
+def _limit_depth(record: Any, max_depth: int) -> Any:
+    """ Replace everything nested deeper than max_depth by a short description, like jsonpickle's max_depth. """
+    if isinstance(record, dict):
+        if max_depth <= 0:
+            return "{%d items}" % len(record)
+        return {k: _limit_depth(v, max_depth - 1) for k, v in record.items()}
+    if isinstance(record, list):
+        if max_depth <= 0:
+            return "[%d items]" % len(record)
+        return [_limit_depth(x, max_depth - 1) for x in record]
+    return record
+
 
 class Storable(metaclass=abc.ABCMeta):
+    # Subclasses may use __slots__ to keep their instances small.
+    __slots__ = ()
+
+    # Version of the schema of to_record, 0 for classes that are only stored through jsonpickle.
+    SCHEMA_VERSION = 0
+
+    __types: Dict[str, Type['Storable']] = dict()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Storable.__types[cls.__name__] = cls
+
     @abc.abstractmethod
     def is_sane(self) -> bool:
         raise NotImplementedError()
 
+    def to_record(self) -> Dict[str, Any]:
+        """ Plain json compatible contents of the object, for classes with a SCHEMA_VERSION. """
+        raise NotImplementedError()
+
     @classmethod
-    def to_file(cls, path: str, data: 'Storable', max_depth: Optional[int] = None):
+    def from_record(cls, record: Dict[str, Any], version: int) -> 'Storable':
+        raise NotImplementedError()
+
+    def upgrade_decoded(self):
+        """ Called on objects read from files without a header, to fill in what older versions did not store. """
+        pass
+
+    def is_sane_sampled(self, sample_size: int = DEFAULT_SAMPLE_SIZE) -> bool:
+        """ Like is_sane, but may only check about sample_size of the items of large collections. """
+        return self.is_sane()
+
+    def validate(self, validation: str) -> bool:
+        if validation == VALIDATION_FULL:
+            return self.is_sane()
+        if validation == VALIDATION_SAMPLED:
+            return self.is_sane_sampled()
+        return True
+
+    @classmethod
+    def to_file(cls, path: str, data: 'Storable', max_depth: Optional[int] = None, encoding: str = ENCODING_JSON,
+                validation: Optional[str] = None):
+        """
+        :param path: File to write to.
+        :param data: Object to store.
+        :param max_depth: Write a human readable copy that is cut off at this depth, it can not be read back.
+        :param encoding: One of ENCODINGS, msgpack requires the msgpack package.
+        :param validation: One of VALIDATIONS, see validation_mode. Checksum skips the checks when writing.
+        """
         if cls is not data.__class__:
             if cls is Storable.__class__:
                 raise Exception("Don't try to store a storable. Store the correct class instead.")
             else:
                 raise Exception("Output is not the correct class.")
-        if not data.is_sane():
+        if not data.validate(validation_mode(validation)):
             raise Exception("Refusing to write invalid file.")
 
+        if cls.SCHEMA_VERSION == 0:
+            if max_depth is not None:
+                payload = jsonpickle.encode(data, indent=2, max_depth=max_depth)
+            else:
+                payload = jsonpickle.encode(data, indent=2)
+
+            with open(path, mode='w') as out_file:
+                out_file.write(payload)
+            return
+
+        with _working_on(path):
+            record = data.to_record()
         if max_depth is not None:
-            payload = jsonpickle.encode(data, indent=2, max_depth=max_depth)
+            with open(path, mode='w') as out_file:
+                json.dump(_limit_depth(record, max_depth), out_file, indent=2)
+            return
+
+        if encoding == ENCODING_MSGPACK and msgpack is None:
+            raise Exception("The msgpack encoding requires the msgpack package.")
+        if encoding not in ENCODINGS:
+            raise Exception("Unknown encoding: %s" % encoding)
+
+        if encoding == ENCODING_MSGPACK:
+            payload = msgpack.packb(record)
         else:
-            payload = jsonpickle.encode(data, indent=2)
+            payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
 
-        with open(path, mode='w') as out_file:
+        with open(path, mode='wb') as out_file:
+            cls._write_header(out_file, encoding, hashlib.sha256(payload).hexdigest())
             out_file.write(payload)
 
     @classmethod
-    def from_file(cls, path: str) -> 'Storable':
-        with open(path, mode='r') as in_file:
+    def to_file_chunks(cls, path: str, chunks: Iterable[bytes]):
+        """
+        Like to_file for a json payload that is produced in chunks, so the record never has to be in memory.
+
+        The payload goes through a temporary file next to the destination, its checksum is only known at the end.
+        Validating the contents is up to the caller.
+        """
+        if cls.SCHEMA_VERSION == 0:
+            raise Exception("Only classes with a SCHEMA_VERSION can be written in chunks.")
+        payload_path = path + ".payload.tmp"
+        sha256 = hashlib.sha256()
+        with open(payload_path, mode='wb') as payload_file:
+            for chunk in chunks:
+                sha256.update(chunk)
+                payload_file.write(chunk)
+        with open(path, mode='wb') as out_file:
+            cls._write_header(out_file, ENCODING_JSON, sha256.hexdigest())
+            with open(payload_path, mode='rb') as payload_file:
+                shutil.copyfileobj(payload_file, out_file)
+        os.remove(payload_path)
+
+    @classmethod
+    def _write_header(cls, out_file, encoding: str, sha256: str):
+        header = json.dumps({
+            'type': cls.__name__,
+            'version': cls.SCHEMA_VERSION,
+            'encoding': encoding,
+            'sha256': sha256,
+        })
+        out_file.write(HEADER_MARKER + header.encode('ascii') + b"\n")
+
+    @classmethod
+    def from_file(cls, path: str, validation: Optional[str] = None) -> 'Storable':
+        """
+        Read a file written by to_file, files without a header are decoded with jsonpickle.
+
+        :param validation: One of VALIDATIONS, see validation_mode.
+        """
+        validation = validation_mode(validation)
+        with open(path, mode='rb') as in_file:
+            header = read_header(in_file)
             payload = in_file.read()
-        decoded = jsonpickle.decode(payload)
+
+        if validation == VALIDATION_CHECKSUM:
+            if header is None or 'sha256' not in header:
+                validation = VALIDATION_SAMPLED
+            elif hashlib.sha256(payload).hexdigest() != header['sha256']:
+                raise Exception("Checksum mismatch, %s is damaged." % path)
+
+        if header is None:
+            decoded = jsonpickle.decode(payload.decode('utf-8'))
+            if isinstance(decoded, Storable):
+                decoded.upgrade_decoded()
+        else:
+            stored_class = Storable.__types.get(header['type'], None)
+            if stored_class is None or not issubclass(stored_class, cls):
+                raise TypeError("Input is not the correct class.")
+            if header['version'] > stored_class.SCHEMA_VERSION:
+                raise Exception("%s was written by a newer version (%d)." % (path, header['version']))
+            if header['encoding'] == ENCODING_MSGPACK:
+                if msgpack is None:
+                    raise Exception("Reading %s requires the msgpack package." % path)
+                record = msgpack.unpackb(payload, strict_map_key=False)
+            else:
+                record = json.loads(payload.decode('utf-8'))
+            with _working_on(path):
+                decoded = stored_class.from_record(record, header['version'])
+
         if not isinstance(decoded, cls):
             raise TypeError("Input is not the correct class.")
-        if not decoded.is_sane():
+        if not decoded.validate(validation):
             raise Exception("Refusing to read invalid file.")
         return decoded
+
+
+def read_header(in_file) -> Optional[Dict[str, Any]]:
+    """ Read the header of a file opened in binary mode, leaves the file at the payload. None without a header. """
+    start = in_file.read(len(HEADER_MARKER))
+    if start != HEADER_MARKER:
+        in_file.seek(0)
+        return None
+    return json.loads(in_file.readline().decode('ascii'))
+
+
+def peek_type(path: str) -> Optional[str]:
+    """ Name of the Storable class stored in a file, without decoding it. None for files without a header. """
+    with open(path, mode='rb') as in_file:
+        header = read_header(in_file)
+    return None if header is None else header['type']